@@ -67,6 +67,9 @@ def create_app():
     from . import db
     db.init_app(app)
 
+    from . import visibility
+    app.cli.add_command(visibility.rebuild_visibility_command)
+
     from . import assets
     app.register_blueprint(assets.bp)
 
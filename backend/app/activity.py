@@ -41,10 +41,10 @@ def log(user: User):
     curr = db.cursor()
     try:
         curr.execute(sql, (user_id, asset_id, request.remote_addr, log_type, metadata))
+        db.commit()  # the execute is only sent with the commit, so it fails here if it fails
     except Exception as e:
         # Probably just a double request
         pass
-    db.commit()
     return MyResponse(True).to_json()
 
 @needs_db 
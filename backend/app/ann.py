@@ -0,0 +1,74 @@
+import numpy as np
+import math
+
+"""
+
+Approximate nearest neighbor search, NumPy only.
+
+The index is an IVF (inverted file): embeddings are clustered with spherical k-means, and each cluster ("list") holds the chunks closest to its centroid.
+A query scores the centroids, then only the chunks in the best few lists.
+
+Each resource gets its own index (stored in its chunk file; see chunk_store.py), so that a retriever over many resources
+can stack their centroids and probe them all together. Adding or removing a resource from a folder then never means rebuilding anything.
+
+"""
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64  # k-means trains on a sample of at most this times the number of lists
+ASSIGN_BLOCK_SIZE = 4096  # rows at a time, to bound memory when reading from an mmap
+
+
+def normalize_rows(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+
+def default_n_lists(n):
+    return max(1, int(round(math.sqrt(n))))
+
+
+def _assign(vectors, centroids):
+    return np.argmax(vectors @ centroids.T, axis=1)
+
+
+# Returns (centroids, order, list_offsets):
+# - centroids: (n_lists x dim) float32, unit length
+# - order: chunk indices (uint32) grouped by list
+# - list_offsets: (n_lists + 1) ints; list j is order[list_offsets[j]:list_offsets[j+1]]
+def build_ivf(embeddings, n_lists=None, seed=0):
+    n = len(embeddings)
+    n_lists = min(n_lists or default_n_lists(n), n)
+    rng = np.random.default_rng(seed)
+
+    sample_size = min(n, n_lists * KMEANS_SAMPLES_PER_LIST)
+    sample = normalize_rows(embeddings[np.sort(rng.choice(n, sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        nonempty = counts > 0
+        centroids[nonempty] = normalize_rows(sums[nonempty])  # empty lists keep their old centroid
+
+    assignments = np.empty(n, dtype=np.int64)
+    for start in range(0, n, ASSIGN_BLOCK_SIZE):
+        block = normalize_rows(embeddings[start:start+ASSIGN_BLOCK_SIZE])
+        assignments[start:start+len(block)] = _assign(block, centroids)
+
+    order = np.argsort(assignments, kind='stable').astype(np.uint32)
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+    return centroids.astype(np.float32), order, list_offsets
+
+
+# Indices of the n_probe centroids closest to the (unit length) query
+def probe(centroids, query, n_probe):
+    sims = centroids @ query
+    n_probe = min(n_probe, len(sims))
+    if n_probe >= len(sims):
+        return np.argsort(-sims)
+    best = np.argpartition(-sims, n_probe - 1)[:n_probe]
+    return best[np.argsort(-sims[best])]
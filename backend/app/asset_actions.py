@@ -3,11 +3,12 @@ from .auth import SynthUser, User
 from .configs.user_config import ALLOW_PUBLIC_UPLOAD
 import json
 from .auth import get_permissioning_string
-from .db import get_db, needs_db, with_lock, needs_special_db, ProxyDB, PooledCursor
+from .visibility import visibility_index_enabled, get_visibility_join, get_visibility_string, get_listing_total, refresh_asset_visibility, delete_asset_visibility
+from .db import get_db, needs_db, with_lock, needs_special_db, ProxyDB, PooledCursor, escape_string, escape_literal, escape_list
 from .retriever import Retriever
 from .configs.secrets import DB_TYPE
 from .configs.str_constants import CHAT_CONTEXT, SUMMARY_APPLY_JOB, SUMMARY_PAIRWISE_JOB, HAS_EDITED_ASSET_TITLE, HAS_EDITED_ASSET_DESC, PROTECTED_METADATA_KEYS, RETRIEVAL_SOURCE, BOOK_ORDER, RETRIEVAL_SOURCE
-from .jobs import complete_job, job_error_wrapper, start_job
+from .jobs import complete_job, job_error_wrapper, start_job, update_job_progress
 from .configs.user_config import ILLEGAL_SHARE_DOMAINS, MAX_CHAT_RETRIEVER_RESULTS, FRONTEND_URL
 from .prompts.suggest_questions_prompts import get_suggest_questions_system_prompt, get_suggest_questions_prompt, get_suggest_questions_system_prompt_detached
 from .integrations.lm import LM_PROVIDERS, LM, FAST_CHAT_MODEL
@@ -18,6 +19,8 @@ import pickle
 from .reducer import Reducer
 import tempfile
 from .storage_interface import upload_asset_file, delete_resources_from_storage
+from .retriever_cache import RESOURCE_RETRIEVER_CACHE
+from .source_tree_cache import SOURCE_TREE_CACHE
 import os
 
 # DO NOT IMPORT ANYTHING FROM templates.py (if needed, do dynamic import)
@@ -55,7 +58,7 @@ def get_asset_metadata(user: User, asset_id, keys=None, limit=None, offset=None,
 
     key_text = ""
     if keys is not None and len(keys) > 0:
-        key_list = [f"`key`='{db.escape_string(str(x))}'" for x in keys]
+        key_list = [f"`key`='{escape_string(str(x))}'" for x in keys]
         key_text = f" AND ({' OR '.join(key_list)})"
 
     order_by_clause = "ORDER BY `time_uploaded` " + ("ASC" if reverse else "DESC")
@@ -99,7 +102,7 @@ def get_asset_metadata(user: User, asset_id, keys=None, limit=None, offset=None,
     protected_text = ""
     if not for_all_users:
         if user and len(protected_key_list) > 0:
-            protected_text = f" AND (`user_id`='{db.escape_string(user.user_id)}' OR `key` NOT IN {protected_key_list_text})"
+            protected_text = f" AND (`user_id`='{escape_string(user.user_id)}' OR `key` NOT IN {protected_key_list_text})"
         elif len(protected_key_list):
             protected_text = f" AND `key` NOT IN {protected_key_list_text}"
 
@@ -148,7 +151,7 @@ def save_asset_metadata(user: User, asset_id, key, value, needs_attention=False,
         WHERE `key`=%s AND `asset_id`=%s
         """
         if not replace_all:
-            sql += f" AND `user_id`='{db.escape_string(replace_for_user)}'"
+            sql += f" AND `user_id`='{escape_string(replace_for_user)}'"
         curr.execute(sql, (key, asset_id))
 
     sql = """
@@ -170,7 +173,7 @@ def add_bulk_asset_metadata(user: User, asset_id, key, values, needs_attention=F
         WHERE `key`=%s AND `asset_id`=%s
         """
         if not replace_all:
-            sql += f" AND `user_id`='{db.escape_string(replace_for_user)}'"
+            sql += f" AND `user_id`='{escape_string(replace_for_user)}'"
         curr.execute(sql, (key, asset_id))
 
     # Prepare bulk insert
@@ -197,6 +200,18 @@ def delete_asset_metadata_by_id(metadata_id, db: ProxyDB=None):
     curr.execute(sql, (metadata_id,))
 
 
+# Not permissioned in any way!
+@needs_db
+def delete_asset_metadata_by_ids(metadata_ids, db: ProxyDB=None):
+    if not len(metadata_ids):
+        return
+    sql = """
+        DELETE FROM asset_metadata WHERE `id` IN %s
+    """
+    curr = db.cursor()
+    curr.execute(sql, (tuple(metadata_ids),))
+
+
 """
 
 It sets gives the permissions using joint_asset_id to its recursive children.
@@ -299,6 +314,8 @@ def propagate_joint_permissions(user: User, parent_asset_id, db=None):
 
     curr = db.cursor()
 
+    touched_ids = set()  # assets whose permissions might have changed, for the visibility index
+
     def insert_permission(can_edit, public, email_domain, user_id, new_asset_id, new_joint_id):
         sql = """
         INSERT INTO asset_permissions (`can_edit`, `public`, `email_domain`, `user_id`, `asset_id`, `joint_asset_id`)
@@ -319,6 +336,7 @@ def propagate_joint_permissions(user: User, parent_asset_id, db=None):
 
         """
 
+        touched_ids.add(current_asset_id)
         curr_asset = get_asset(user, current_asset_id)
 
         sources = get_sources(user, current_asset_id, needs_edit_permission=True, ignore_parent_permissions=True, db=db)
@@ -423,6 +441,7 @@ def propagate_joint_permissions(user: User, parent_asset_id, db=None):
                     WHERE `id`=%s
                     """
                     curr.execute(sql, (perm['c_id']))
+                    touched_ids.add(perm['c_asset_id'])
                 else:
                     # But if there is, record it so we don't add it again.
                     perms_to_children[creator_perm_key].append(perm['c_asset_id'])
@@ -458,6 +477,7 @@ def propagate_joint_permissions(user: User, parent_asset_id, db=None):
             find_assets(source_id, [*branch_ids, source_id])
 
     find_assets(parent_asset_id, [parent_asset_id])
+    refresh_asset_visibility(touched_ids, db=db, no_commit=True)
 
 
 # Not permissioned!
@@ -538,6 +558,8 @@ def delete_asset_resources(resources, db: ProxyDB=None):
 def delete_asset_retrieval_resources(resources, db: ProxyDB=None):
     if len(resources):
         delete_resources_from_storage(resources)
+        for res in resources:
+            RESOURCE_RETRIEVER_CACHE.invalidate(res['resource_id'])
         sql = """
             DELETE FROM asset_retrieval_storage
             WHERE `id` IN %s
@@ -609,6 +631,7 @@ def delete_asset(asset_row, db=None):
     WHERE `asset_id` = %s OR `joint_asset_id` = %s
     """
     curr.execute(sql, (asset_id, asset_id))
+    delete_asset_visibility(asset_id, db=db, no_commit=True)
 
     # Delete asset retrieval storage (and from AWS)
     sql = """
@@ -692,6 +715,8 @@ def upload_asset(user: User, asset_id, title, llm_description, preview_desc, tem
 
     curr.execute(sql, (user.user_id, title, llm_description, preview_desc, template, author, group_id))
     asset_id = curr.lastrowid
+    if group_id is not None:
+        refresh_asset_visibility([asset_id], db=db, no_commit=True)  # the group's permissions apply
 
     return True, asset_id
 
@@ -788,9 +813,9 @@ def get_retriever_cache_name(retriever_type_name, asset_id):
 
 # Returns None if failed
 # retriever_type_name can be used to give an asset new/multiple retrievers (ex., when you don't need embeddings)
-# Note: force_create and cache were from an era in which retrievers were cached in memory; currently, they are not.
+# Note: force_create and cache were from an era in which whole retrievers were cached in memory; currently, only resource retrievers are (see retriever_cache.py).
 @needs_db
-def get_or_create_retriever(user: User, asset_row, asset_resources, retriever_type_name="retriever", retriever_options={}, force_create=False, no_cache=False, db=None):
+def get_or_create_retriever(user: User, asset_row, asset_resources, retriever_type_name="retriever", retriever_options={}, force_create=False, no_cache=False, progress_callback=None, db=None):
     
     retriever_name = get_retriever_cache_name(retriever_type_name, asset_row['id']) 
     # LOCK - using database lock
@@ -811,7 +836,7 @@ def get_or_create_retriever(user: User, asset_row, asset_resources, retriever_ty
             curr.execute("SET GLOBAL TRANSACTION ISOLATION LEVEL READ COMMITTED;")
 
         try:
-            retriever = Retriever(user, asset_resources, **retriever_options)
+            retriever = Retriever(user, asset_resources, progress_callback=progress_callback, **retriever_options)
         except NoCreateError:  # probably: no_create was signaled, but a creation was necessary. 
             retriever = None
 
@@ -830,9 +855,9 @@ def get_asset_resources(user, asset_row, exclude=[], db=None):
 
 
 @needs_db
-def make_retriever(user, asset_row, retriever_type_name="retriever", retriever_options={}, force_create=False, no_cache=False, job_id=None, except_text=None, exclude=[], db=None):
+def make_retriever(user, asset_row, retriever_type_name="retriever", retriever_options={}, force_create=False, no_cache=False, job_id=None, except_text=None, exclude=[], progress_callback=None, db=None):
     asset_resources = get_asset_resources(user, asset_row, exclude=exclude)
-    ret = get_or_create_retriever(user, asset_row, asset_resources, retriever_type_name=retriever_type_name, retriever_options=retriever_options, force_create=force_create, no_cache=no_cache, db=db)
+    ret = get_or_create_retriever(user, asset_row, asset_resources, retriever_type_name=retriever_type_name, retriever_options=retriever_options, force_create=force_create, no_cache=no_cache, progress_callback=progress_callback, db=db)
     if except_text and ret is None:
         raise Exception(except_text)
     
@@ -848,7 +873,9 @@ def make_retriever_job(user_obj, job_id, *args, **kwargs):
     @job_error_wrapper(job_id)
     def do_job():
         # In a job, don't have access to the cache.
-        ret = make_retriever(user, *args, db=db, **kwargs)
+        # Progress updates come from the retriever's threads, so they get their own connections rather than sharing db.
+        report_progress = lambda progress: update_job_progress(job_id, round(progress, 2))
+        ret = make_retriever(user, *args, db=db, progress_callback=report_progress, **kwargs)
 
     do_job()
 
@@ -984,6 +1011,9 @@ def set_sources(user: User, asset_id, new_resource_ids, additive=False, db=None)
             args.extend([asset_id, RETRIEVAL_SOURCE, rid])
         curr.execute(sql, args)
         propagate_joint_permissions(user, asset_id, db=db, no_commit=True)
+
+    # Other processes notice the change through the cache's fingerprint
+    SOURCE_TREE_CACHE.invalidate(asset_id)
     # auto commits with needs db
 
 
@@ -1039,9 +1069,18 @@ def get_sources(user: User, asset_id, needs_edit_permission=False, ordered=False
 
     return results
 
+# Whether search_assets lists in its default order (newest first) with these options; only that order can be paged with after
+def uses_default_asset_order(search="", recent_activity=False, alphabetical=False, folders_first=False, sub_manifest=None):
+    if search or recent_activity or alphabetical or sub_manifest:
+        return False
+    return not (folders_first and int(folders_first) != 0)
+
+
 # Returns (results, total) (total = 0 if ignore_total=True)
 # IF YOU NEED TOTAL (get_total=True) PASS exclusive=True TO KEEP TOTAL VALUE FROM GETTING CORRUPTED
-@needs_db
+# (unless visibility_index_enabled(), in which case the total is counted separately and any connection will do)
+# Read only: listings can be a moment behind (see get_db)
+@needs_special_db(read_only=True)
 def search_assets(
                 user: User,
                 search="",  # Broken up into search terms and scored
@@ -1064,18 +1103,21 @@ def search_assets(
                     # Also: special tag "Others" (true by default) decides whether we include untagged.
                 needs_edit_permission=False,
                 exclude_ids: list=[],  # list of asset ids to exclude from search
+                after: list=None,  # [time_uploaded, id] of the last asset of the previous page; pages by key rather than offset. Only for the default order.
                 db=None
             ):
 
-    search = db.escape_string(str(search)) if search else ""
+    search = escape_string(str(search)) if search else ""
     limit = str(int(limit))
     offset = str(int(offset))
     if not user and recent_activity:
         raise UserIsNoneError("Cannot get recent activity without a user")
 
-    only_templates_string = "" if not only_templates else "AND (" + " OR ".join([f"a.template = '{db.escape_string(x)}'" for x in only_templates]) + ")"
+    only_templates_string = "" if not only_templates else "AND (" + " OR ".join([f"a.template = '{escape_string(x)}'" for x in only_templates]) + ")"
 
-    order_by_clause = "time_uploaded DESC"
+    use_visibility = visibility_index_enabled()
+
+    order_by_clause = "time_uploaded DESC, id DESC"  # id breaks ties, so that paging with after is exact
     if recent_activity:
         order_by_clause = "timestamp DESC"
     elif alphabetical:
@@ -1103,20 +1145,20 @@ def search_assets(
                     SELECT `value`
                     FROM asset_metadata
                     WHERE `key`='{RETRIEVAL_SOURCE}'
-                    AND `asset_id`={db.escape_string(str(sub_manifest))}
+                    AND `asset_id`={escape_literal(sub_manifest)}
                 )
             """
     elif group_ids and len(group_ids) > 0:
-        sub_manifest_clause = f"AND assets.group_id IN ({','.join([db.escape_string(str(x)) for x in group_ids])})"
+        sub_manifest_clause = f"AND assets.group_id IN ({escape_list(group_ids)})"
     elif include_group_ids and len(include_group_ids) > 0: 
-        sub_manifest_clause = f"AND (assets.group_id IS NULL OR assets.group_id IN ({','.join([db.escape_string(str(x)) for x in include_group_ids])}))"
+        sub_manifest_clause = f"AND (assets.group_id IS NULL OR assets.group_id IN ({escape_list(include_group_ids)}))"
     elif groups_only:
         sub_manifest_clause = "AND assets.group_id IS NOT NULL"
     elif not recent_activity and not include_groups and not include_purchased_groups:
         sub_manifest_clause = "AND assets.group_id IS NULL"
     
     if exclude_ids and len(exclude_ids) > 0:
-        exclusion_list_str = ",".join([db.escape_string(str(x)) for x in exclude_ids])
+        exclusion_list_str = escape_list(exclude_ids)
         sub_manifest_clause += f" AND (assets.id NOT IN ({exclusion_list_str}))"
 
     tagging_join = ""
@@ -1124,7 +1166,7 @@ def search_assets(
     if filter_tags_on_groups and len(filter_tags_on_groups) > 0:
         pairs = []
         for group in filter_tags_on_groups:
-            not_tag_list = [f"'{db.escape_string(k)}'" for k, x in filter_tags_on_groups[group].items() if not x]
+            not_tag_list = [f"'{escape_string(k)}'" for k, x in filter_tags_on_groups[group].items() if not x]
             if len(not_tag_list):
                 not_tag_list_string = ",".join(not_tag_list)
                 pairs.append((not_tag_list_string, group))
@@ -1137,13 +1179,13 @@ def search_assets(
                 if 'Others' not in group_obj or group_obj['Others']:  # Some special behavior for a special tag
                     include_others = "atag.value IS NULL OR "
                 
-                tagging_where += f" AND ({include_others}atag.value NOT IN ({pair[0]}) OR a.group_id IS NULL OR a.group_id != {pair[1]})"
+                tagging_where += f" AND ({include_others}atag.value NOT IN ({pair[0]}) OR a.group_id IS NULL OR a.group_id != {escape_literal(pair[1])})"
             tagging_where = f"AND (1=1 {tagging_where})"
 
     search_clause = f"SELECT *, 1 AS score FROM assets WHERE 1=1 {sub_manifest_clause}"
     if len(search) > 0:
 
-        search_query = db.escape_string(search)
+        search_query = escape_string(search)
         order_by_clause = "score DESC, " + order_by_clause
 
         search_clause = f"""
@@ -1162,22 +1204,45 @@ def search_assets(
         GROUP BY assets.id
         ORDER BY {order_by_clause}
         """
-    
+
+    # Only the unsearched clause can be paged by key, which is why it's the only order allowed
+    paged_search_clause = search_clause
+    if after:
+        if not uses_default_asset_order(search, recent_activity, alphabetical, folders_first, sub_manifest):
+            raise ValueError("Paging with after needs the default order")
+        after_time = escape_literal(after[0])
+        paged_search_clause += f" AND (assets.time_uploaded < {after_time} OR (assets.time_uploaded = {after_time} AND assets.id < {int(after[1])}))"
+
+    # The permissions join and conditions of a body: via_group says whether the asset's group's permissions count rather than its own
+    # With the visibility index, these come from asset_visibility rather than asset_permissions (see visibility.py)
+    def get_permissions_parts(via_group, get_public=True):
+        if use_visibility:
+            join = get_visibility_join(user, get_public=get_public, via_group=via_group)
+            edit_string = get_visibility_string(user, edit_permission=True)
+            where_string = get_visibility_string(user, user_uploads_only=my_uploads, get_public=get_public, edit_permission=needs_edit_permission)
+        else:
+            ap_join_on = "a.group_id = ap.group_id" if via_group else "a.id = ap.asset_id"
+            join = f"LEFT JOIN asset_permissions ap ON {ap_join_on}"
+            edit_string = get_permissioning_string(user, edit_permission=True)
+            where_string = get_permissioning_string(user, user_uploads_only=my_uploads, get_public=get_public, edit_permission=needs_edit_permission)
+        return join, edit_string, where_string
+
     # Factored this out so we could do a join for groups when appropriate.
-    def get_main_search_query(use_calc, ap_join_on, redefine=False, purchased_groups=False):
+    def get_main_search_query(use_calc, via_group, redefine=False, purchased_groups=False):
         purchased_groups_join = "LEFT JOIN asset_groups ag ON ag.id = a.group_id AND ag.product_id IS NOT NULL" if purchased_groups else ""
+        permissions_join, edit_string, where_string = get_permissions_parts(via_group, get_public=(not isolated))
         return f"""
         SELECT {"SQL_CALC_FOUND_ROWS" if use_calc else ""} a.*,
             MAX(CASE
-                WHEN ({get_permissioning_string(user, edit_permission=True)})
+                WHEN ({edit_string})
                 THEN 1
                 ELSE 0
             END) AS has_edit_permission
         FROM a
-        LEFT JOIN asset_permissions ap ON {ap_join_on}
+        {permissions_join}
         {tagging_join}
         {purchased_groups_join}
-        WHERE ({get_permissioning_string(user, user_uploads_only=my_uploads, get_public=(not isolated), edit_permission=needs_edit_permission)})
+        WHERE ({where_string})
         {"AND ag.product_id IS NOT NULL" if purchased_groups_join else ""}
         {only_templates_string}
         {tagging_where}
@@ -1185,8 +1250,9 @@ def search_assets(
         """
     
     # Same goes here, though it's a modified query.
-    def get_ra_search_query(use_calc, ap_join_on, redefine=True, purchased_groups=False):
+    def get_ra_search_query(use_calc, via_group, redefine=True, purchased_groups=False):
         purchased_groups_join = "LEFT JOIN asset_groups ag ON ag.id = a.group_id AND ag.product_id IS NOT NULL" if purchased_groups else ""
+        permissions_join, edit_string, where_string = get_permissions_parts(via_group)
         sql = ""
         if redefine:
             sql += f"""
@@ -1205,15 +1271,15 @@ def search_assets(
         SELECT {"SQL_CALC_FOUND_ROWS" if use_calc else ""} DISTINCT a.*,
             MAX(
             CASE
-                WHEN ({get_permissioning_string(user, edit_permission=True)})
+                WHEN ({edit_string})
                 THEN 1
                 ELSE 0
             END) AS has_edit_permission
         FROM a
-        LEFT JOIN asset_permissions ap ON {ap_join_on}
+        {permissions_join}
         {tagging_join}
         {purchased_groups_join}
-        WHERE ({get_permissioning_string(user, user_uploads_only=my_uploads, edit_permission=needs_edit_permission)})
+        WHERE ({where_string})
         {"AND ag.product_id IS NOT NULL" if purchased_groups_join else ""}
         {only_templates_string}
         {tagging_where}
@@ -1238,15 +1304,14 @@ def search_assets(
     """
 
     # DO PREAMBLE
-    preamble = ""
-    if recent_activity:
-        preamble = f"""WITH ass as (
-            {search_clause}
-        ),"""
-    else:
-        preamble = f"""
+    def get_preamble(clause):
+        if recent_activity:
+            return f"""WITH ass as (
+                {clause}
+            ),"""
+        return f"""
         WITH a as (
-            {search_clause}
+            {clause}
         )
         """
 
@@ -1260,36 +1325,37 @@ def search_assets(
     regular_sql = ""
 
     need_general_groups = groups_only or include_groups or (group_ids and len(group_ids)) or (include_group_ids and len(include_group_ids))
+    # The visibility index counts the total separately instead of with SQL_CALC_FOUND_ROWS
+    use_calc = not ignore_total and not use_visibility
     if include_purchased_groups or need_general_groups:
-        group_sql = correct_sql_fn(not ignore_total, "a.group_id = ap.group_id", purchased_groups=(include_purchased_groups and not need_general_groups))
+        group_sql = correct_sql_fn(use_calc, True, purchased_groups=(include_purchased_groups and not need_general_groups))
 
     if not group_ids or not len(group_ids):
-        regular_sql = correct_sql_fn(not ignore_total and not group_sql, "a.id = ap.asset_id", redefine=(not group_sql))
+        regular_sql = correct_sql_fn(use_calc and not group_sql, False, redefine=(not group_sql))
 
-    sql = ""  # Will become the actual sql run.
+    body_sql = ""  # With the preamble, will become the actual sql run.
     
     if group_sql and regular_sql:
         # group sql is first because it has the CALC when appropriate.
-        sql = f"""
-        {preamble}
+        body_sql = f"""
         {group_sql}
         UNION
         """
         if recent_activity and not group_sql:
-            sql += f"""WITH {regular_sql}"""  # need to include the with because no preamble.
+            body_sql += f"""WITH {regular_sql}"""  # need to include the with because no preamble.
         else:
-            sql += regular_sql
+            body_sql += regular_sql
     elif group_sql:
-        sql = f"""
-        {preamble}
+        body_sql = f"""
         {group_sql}"""
     else:
-        sql = f"""
-        {preamble}
+        body_sql = f"""
         {regular_sql}"""
 
     # Now do the ending.
-    sql += f"""
+    sql = f"""
+    {get_preamble(paged_search_clause)}
+    {body_sql}
     ORDER BY {order_by_clause}
     LIMIT {limit}
     OFFSET {offset}
@@ -1298,7 +1364,10 @@ def search_assets(
     curr.execute(sql)
     res = curr.fetchall()  # list of dictionaries
     total = 0
-    if not ignore_total:  # and this is why we use the exclusive connection ... need to be the only one on it here.
+    if not ignore_total and use_visibility:
+        # Counted over the whole listing, not just what's after the page key
+        total = get_listing_total(f"{get_preamble(search_clause)} {body_sql}", db)
+    elif not ignore_total:  # and this is why we use the exclusive connection ... need to be the only one on it here.
         curr.execute("SELECT FOUND_ROWS()")
         total = curr.fetchone()['FOUND_ROWS()']
     return res, total
@@ -1,9 +1,11 @@
 from datetime import datetime, timedelta
 from flask import (
     Blueprint,
+    Response,
     request,
     send_file
 )
+import hashlib
 import os
 from flask_cors import cross_origin
 from .exceptions import RetrieverEmbeddingsError, UserIsNoneError
@@ -13,8 +15,9 @@ from .configs.str_constants import *
 from .configs.user_config import RETRIEVER_JOB_TIMEOUT
 from .integrations.lm import DEFAULT_CHAT_MODEL, FAST_LONG_CONTEXT_MODEL, FAST_CHAT_MODEL, BALANCED_CHAT_MODEL
 from .db import get_db
+from .visibility import visibility_index_enabled
 from .template_response import MyResponse
-from .retriever import Chunk, Retriever
+from .retriever import Chunk, Retriever, find_stored_retrievers, stored_retriever_info
 from .integrations.lm import LM_PROVIDERS, LM, get_safe_retrieval_context_length, LMStreamResponse
 from .auth import User, token_optional, token_required, get_permissioning_string
 import json
@@ -26,9 +29,9 @@ from .asset_actions import (
     get_asset, make_retriever, set_sources,
     make_retriever_job, mark_asset_title_as_updated, mark_asset_desc_as_updated, upload_asset,
     get_asset_metadata, get_permissions, save_chat, set_asset_permissions,
-    search_assets, propagate_joint_permissions, get_sources, delete_asset,
+    search_assets, uses_default_asset_order, propagate_joint_permissions, get_sources, delete_asset,
     suggest_questions, get_assets, start_summary_apply_job, start_summary_reduce_job,
-    get_book_order, set_book_order, get_asset_resource, add_resource_from_text
+    get_book_order, set_book_order, get_asset_resource, add_resource_from_text, get_asset_resources
 )
 from .user import get_user_chat_model_code, get_user_templates, get_user_allowed_new_upload, inc_upload_counter
 from concurrent.futures import ThreadPoolExecutor
@@ -128,6 +131,10 @@ def manifest(user: User):
     else:
         get_total = True
 
+    # Keyset paging: the next_after of the previous page (only for the default order; cheaper than a big offset)
+    after = request.args.get('after')
+    after = json.loads(after) if after else None
+
     try:
         # The total is ignored by default, actually.
         results, total = search_assets(user, search=search, limit=limit,
@@ -136,13 +143,19 @@ def manifest(user: User):
                                     group_ids=[group_id] if group_id else [], my_uploads=my_uploads, isolated=isolated,
                                     folders_first=folders_first, include_groups=include_groups, include_group_ids=include_group_ids,
                                     alphabetical=alphabetical, filter_tags_on_groups=filter_tags_on_groups, ignore_total=(not get_total),
-                                    needs_edit_permission=needs_edit_permission, exclude_ids=exclude_ids, exclusive_conn=get_total)
+                                    needs_edit_permission=needs_edit_permission, exclude_ids=exclude_ids, after=after,
+                                    exclusive_conn=(get_total and not visibility_index_enabled()))
 
     except UserIsNoneError:
         print("User is none error in /manifest; ignoring.", file=sys.stderr)
         results, total = [], 0
-    
-    return MyResponse(True, {'results': results, 'total': total}).to_json()
+    except ValueError as e:
+        return MyResponse(False, reason=str(e), status=400).to_json()
+
+    next_after = None
+    if len(results) and len(results) == int(limit) and uses_default_asset_order(search, recent_activity, alphabetical, folders_first, sub_manifest):
+        next_after = [str(results[-1]['time_uploaded']), results[-1]['id']]
+    return MyResponse(True, {'results': results, 'total': total, 'next_after': next_after}).to_json()
 
 
 # doubles as edit endpoint
@@ -812,11 +825,12 @@ def make_retriever_endpoint(user: User):
     return response
 
 
-@bp.route('/get-retriever-status', methods=('POST',))
+# GET (with id as a query arg) gets an ETag, so that polling clients can revalidate rather than getting the whole retriever info again
+@bp.route('/get-retriever-status', methods=('GET', 'POST'))
 @cross_origin()
 @token_optional
 def get_retriever_status(user: User):
-    id = request.json.get('id')
+    id = request.args.get('id') if request.method == 'GET' else request.json.get('id')
 
     asset_row = get_asset(user, id)
     if not asset_row:
@@ -848,7 +862,31 @@ def get_retriever_status(user: User):
             return MyResponse(True, {'retriever_job': res}).to_json()
 
     # No jobs / job is running... but is there really not an existing retriever?
+    # Answered from the stored retrievers' info if possible, without loading them (checked on the primary if the replica doesn't have them yet)
+    # (Synthetic resources aren't stored, so those still go through make_retriever.)
+    asset_resources = get_asset_resources(user, asset_row, db=db)
+    if not any(res['id'] == -1 for res in asset_resources):
+        probe_db = get_db(read_only=True)
+        chosen = find_stored_retrievers(asset_resources, db=probe_db)
+        if chosen is None:
+            probe_db = db
+            chosen = find_stored_retrievers(asset_resources, db=probe_db)
+        if chosen is None:
+            return MyResponse(True).to_json()
+
+        # Changes whenever the resources or which stored retrievers would be used do
+        etag = hashlib.sha1(json.dumps([sorted(chosen.items()), asset_resources], sort_keys=True, default=str).encode()).hexdigest()
+        if request.method == 'GET' and request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            info = stored_retriever_info(asset_resources, chosen, db=probe_db)
+            response = MyResponse(True, {'retriever': info}).to_json() if info else None
+        if response:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
 
+    # Stored in a format without enough info (or synthetic), so it has to be loaded after all
     ret_options = {
         'no_create': True
     }
@@ -967,7 +1005,7 @@ def source_of(user: User):
         LEFT JOIN asset_permissions ap ON a.id = ap.asset_id OR a.group_id = ap.group_id
         WHERE {get_permissioning_string(user)}
         GROUP BY a.id
-        LIMIT {db.escape_string(limit)}
+        LIMIT {int(limit)}
     """
 
     curr = db.cursor()
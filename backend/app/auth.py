@@ -1,5 +1,5 @@
 from flask import request
-from app.db import needs_db
+from app.db import needs_db, escape_string
 from functools import wraps
 from .configs.user_config import PERMISSIONING
 from .template_response import MyResponse
@@ -98,7 +98,7 @@ def token_optional(f):
 # The assets table (or substitute) must include a `creator_id` column
 # Assumes table aliases (corrected ones can be passed as args)
 # The line follows the "WHERE " clause
-@needs_db
+# Doesn't touch the database (db is accepted for older callers)
 def get_permissioning_string(user: User, get_public=True, user_uploads_only=False, edit_permission=False, assets_alias="a", asset_permissions_alias="ap", db=None):
     
     if PERMISSIONING == 'demo': 
@@ -110,11 +110,11 @@ def get_permissioning_string(user: User, get_public=True, user_uploads_only=Fals
     elif not user:
         raise UserIsNoneError("Request for non-public data but no user")
 
-    escaped_email = user.email
+    escaped_email = escape_string(user.email)
     
-    email_domain = db.escape_string(escaped_email.split("@")[1]) if is_valid_email(escaped_email) else "localhost"  # localhost is somewhat of an arbitrary choice.
+    email_domain = escape_string(user.email.split("@")[1]) if is_valid_email(user.email) else "localhost"  # localhost is somewhat of an arbitrary choice.
 
-    user_id = db.escape_string(user.user_id)
+    user_id = escape_string(user.user_id)
     if user_uploads_only:
         return f"""{assets_alias}.creator_id LIKE '{user_id}'"""
     if edit_permission:
@@ -1,32 +1,63 @@
 import sys
 from flask import Response
 import json
-import random
 from .configs.str_constants import DIVIDER_TEXT, CHAT_ERROR_TEXT
 import concurrent.futures
 import time
 import queue
 from .integrations.lm import LM, LM_PROVIDERS, DEFAULT_CHAT_MODEL
+from .lm_scheduler import get_scheduler, is_rate_limit_error, INTERACTIVE, BACKGROUND
+from .configs.user_config import LM_SCHEDULER_MAX_CONCURRENCY
 
 """
 
 This is designed to simply call the lm function in a multi-threaded way, no matter the function
 There are usually ways to give batched calls directly to the API, but this should be easier for now.
 
+How many calls are actually in flight is up to the model's scheduler (see lm_scheduler.py), which is shared across the process;
+max_threads here only bounds how many of this batch's calls can be waiting on it at once.
+New calls are submitted as old ones finish (a sliding window), so one slow call never holds up the rest.
+
 These functions do NOT do any streaming.
 
 """
 
 # Used by batched_lm and stream_progress_batched_lm
-def _batched_lm_worker(data, index, lm: LM, system_prompt, delay=None, make_json=False):
+def _batched_lm_worker(data, index, lm: LM, system_prompt, delay=None, make_json=False, priority=BACKGROUND):
     """Thread worker function"""
-    # Delay before starting the function
-    if not delay:
-        # Random delay so that if a bunch of batches go out quickly, they plausibly happen at different times.
-        delay = random.random() / 3  # between 0 and .33 seconds.
-    time.sleep(delay)    
+    if delay:
+        time.sleep(delay)
     # Call the target function
-    return lm.run(data, system_prompt=system_prompt, make_json=make_json), index
+    scheduler = get_scheduler(lm)
+    result = scheduler.run(
+        lambda: lm.run(data, system_prompt=system_prompt, make_json=make_json),
+        priority=priority,
+        prompt_txt=data if isinstance(data, str) else ""
+    )
+    return result, index
+
+
+# Runs fn(index, data) for everything in data_list with at most max_threads at once, taking from data_list only as room frees up
+# Yields (result, index, data) in order of completion
+def _sliding_window(data_list, fn, max_threads):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        in_flight = {}  # future -> (index, data)
+        data_iter = enumerate(data_list)
+        exhausted = False
+        while True:
+            while not exhausted and len(in_flight) < max_threads:
+                try:
+                    index, data = next(data_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                in_flight[executor.submit(fn, index, data)] = (index, data)
+            if not in_flight:
+                break
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, data = in_flight.pop(future)
+                yield future.result(), index, data
 
 
 """
@@ -40,15 +71,10 @@ Yields tuples of result, index pairs
 """
 
 # data_list can be a generator
-def stream_batched_lm(data_list, max_threads=10, system_prompt=None, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], make_json=False):
-        
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-
-        futures = [executor.submit(_batched_lm_worker, data, index, lm, system_prompt=system_prompt, make_json=make_json) for index, data in enumerate(data_list)]
-        
-        for future in concurrent.futures.as_completed(futures):
-            result, index = future.result()
-            yield result, index
+def stream_batched_lm(data_list, max_threads=LM_SCHEDULER_MAX_CONCURRENCY, system_prompt=None, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], make_json=False, priority=INTERACTIVE):
+    work = lambda index, data: _batched_lm_worker(data, index, lm, system_prompt=system_prompt, make_json=make_json, priority=priority)[0]
+    for result, index, _ in _sliding_window(data_list, work, max_threads):
+        yield result, index
 
 """
 
@@ -60,34 +86,13 @@ This function uses a streaming callback to store its work - usually a database e
 
 """
 
-def stream_progress_batched_lm(data_list, get_lm_part=lambda x:x, get_sys_part=lambda x:None, streamingCallback=None, max_threads=10, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], mini_batch_size=20):
-
-    # mini batches to avoid putting all of data_list in memory
-    def batch_effect(mini_batch):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-            futures = [executor.submit(_batched_lm_worker, get_lm_part(data), index+offset, lm, system_prompt=get_sys_part(data)) for index, data in enumerate(mini_batch)]
-
-            for future in concurrent.futures.as_completed(futures):
-                result, index = future.result()
-                if streamingCallback:
-                    streamingCallback(result, index, mini_batch[index-offset])
-                yield index
-
-    mini_batch = []
-    offset = 0
-    for data in data_list:
-        mini_batch.append(data)
-        if len(mini_batch) < mini_batch_size:
-            continue
-
-        for effect in batch_effect(mini_batch):
-            yield effect
-        mini_batch = []
-        offset += mini_batch_size
-    
-    if len(mini_batch) > 0:
-        for effect in batch_effect(mini_batch):
-            yield effect
+# data_list can be a generator; it's only read as calls finish, so it never has to be in memory all at once.
+def stream_progress_batched_lm(data_list, get_lm_part=lambda x:x, get_sys_part=lambda x:None, streamingCallback=None, max_threads=LM_SCHEDULER_MAX_CONCURRENCY, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL], priority=BACKGROUND):
+    work = lambda index, data: _batched_lm_worker(get_lm_part(data), index, lm, system_prompt=get_sys_part(data), priority=priority)[0]
+    for result, index, data in _sliding_window(data_list, work, max_threads):
+        if streamingCallback:
+            streamingCallback(result, index, data)
+        yield index
 
 # Returns response - generator yielding comma separated index values.
 def stream_progress_batched_lm_resp(*args, **kwargs):
@@ -131,12 +136,19 @@ def _threaded_stream_lm(q, prompt, _index=0, stream_lm: LM=LM_PROVIDERS[DEFAULT_
     # Send only the remaining kwargs (includes sources)
     q.put((_index, json.dumps(prompt_kwargs)))
 
+    # Streams hold a slot for as long as they run, so they don't feed the scheduler's latency measurements
+    scheduler = get_scheduler(stream_lm)
+    scheduler.acquire(priority=INTERACTIVE)
+    rate_limited = False
     try:
         for stream_resp in stream_lm.stream(prompt, system_prompt=system_prompt, context=context, **extra_kwargs):
             q.put((_index, stream_resp.text))
     except Exception as e:
+        rate_limited = is_rate_limit_error(e)
         print(f"Chat LM exception: {e}", file=sys.stderr)
         q.put((_index, CHAT_ERROR_TEXT))
+    finally:
+        scheduler.release(rate_limited=rate_limited)
     q.put((-1, ''))
 
 
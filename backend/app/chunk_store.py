@@ -0,0 +1,263 @@
+import numpy as np
+import mmap
+import json
+import struct
+import pickle
+import tempfile
+import os
+import sys
+from .ann import build_ivf
+
+"""
+
+The chunk store is the on-disk format for a ResourceRetriever.
+
+A single file (so that it can be uploaded as one object and stored in one asset_retrieval_storage row) laid out as:
+
+    [text blob][offsets (uint64, n+1)][padding][embeddings (float32, n x dim, C-contiguous)][ANN index (optional)][footer JSON][footer length (uint64)][MAGIC]
+
+- The text blob is every chunk's utf-8 text, back to back; chunk i is text_blob[offsets[i]:offsets[i+1]].
+- The embeddings matrix is aligned so that it can be memory-mapped directly with np.memmap.
+- The ANN index is an IVF over the embeddings (see ann.py): centroids (float32, aligned) and the chunk order (uint32); the list offsets are in the footer.
+- The footer is read first (from the end of the file) and says where everything else is.
+
+Texts go first so that the file can be written in one streaming pass, with embeddings spooled to a side file until the end.
+
+Old retrievers were a file of pickled Chunk objects, one after another; see convert_pickle_file.
+
+"""
+
+MAGIC = b'ABBEYCS1'
+FORMAT_VERSION = 1
+EMBEDDING_DTYPE = np.dtype('<f4')
+OFFSET_DTYPE = np.dtype('<u8')
+ORDER_DTYPE = np.dtype('<u4')
+ALIGNMENT = 64  # bytes; embeddings matrix starts on this boundary
+TRAILER_SIZE = 8 + len(MAGIC)  # footer length + magic
+
+
+def is_chunk_store(path):
+    try:
+        with open(path, 'rb') as fhand:
+            fhand.seek(0, os.SEEK_END)
+            if fhand.tell() < TRAILER_SIZE:
+                return False
+            fhand.seek(-len(MAGIC), os.SEEK_END)
+            return fhand.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def _pad_to(fhand, alignment):
+    extra = (-fhand.tell()) % alignment
+    if extra:
+        fhand.write(b'\0' * extra)
+
+
+# Writes a chunk store in one pass.
+# Usage: add() each chunk in order (with or without embeddings), then finish().
+# Embeddings can also be given after the fact, in order, with add_embeddings() – this is for when the texts are known before the embeddings are.
+class ChunkStoreWriter():
+    def __init__(self, path=None) -> None:
+        if path is None:
+            path = tempfile.NamedTemporaryFile(delete=False).name
+        self.path = path
+        self.fhand = open(self.path, 'wb')
+        self.offsets = [0]
+        self.names = []
+        self.dim = None
+        self.n_embedded = 0
+        self.emb_spool = None  # a side file for embeddings until we know where they go
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, txt, source_name, embedding=None):
+        data = txt.encode('utf-8')
+        self.fhand.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+        self.names.append(source_name)
+        if embedding is not None:
+            self.add_embeddings([embedding])
+
+    # Takes a list (or 2D array) of embeddings for the next chunks in order
+    def add_embeddings(self, embeddings):
+        arr = np.asarray(embeddings, dtype=EMBEDDING_DTYPE)
+        if not arr.size:
+            return
+        if arr.ndim != 2:
+            raise ValueError(f"Embeddings must be a list of vectors; got array with shape {arr.shape}")
+        if self.dim is None:
+            self.dim = arr.shape[1]
+            self.emb_spool = tempfile.TemporaryFile()
+        elif arr.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension changed from {self.dim} to {arr.shape[1]}")
+        self.emb_spool.write(np.ascontiguousarray(arr).tobytes())
+        self.n_embedded += len(arr)
+
+    # If index_min_chunks is set and there are at least that many embedded chunks, an ANN index is built too.
+    def finish(self, index_min_chunks=None):
+        n = len(self.names)
+        has_embeddings = self.dim is not None
+        if has_embeddings and self.n_embedded != n:
+            raise ValueError(f"Chunk store has {n} chunks but {self.n_embedded} embeddings")
+
+        offsets_offset = self.offsets[-1]
+        self.fhand.write(np.asarray(self.offsets, dtype=OFFSET_DTYPE).tobytes())
+
+        emb_offset = None
+        if has_embeddings:
+            _pad_to(self.fhand, ALIGNMENT)
+            emb_offset = self.fhand.tell()
+            self.emb_spool.seek(0)
+            while True:
+                buf = self.emb_spool.read(1 << 20)
+                if not buf:
+                    break
+                self.fhand.write(buf)
+            self.emb_spool.close()
+            self.emb_spool = None
+
+        ivf = None
+        if has_embeddings and index_min_chunks is not None and n >= index_min_chunks:
+            self.fhand.flush()
+            embeddings = np.memmap(self.path, dtype=EMBEDDING_DTYPE, mode='r', offset=emb_offset, shape=(n, self.dim))
+            centroids, order, list_offsets = build_ivf(embeddings)
+            del embeddings
+            _pad_to(self.fhand, ALIGNMENT)
+            ivf = {
+                'n_lists': len(centroids),
+                'centroids_offset': self.fhand.tell(),
+                'list_offsets': [int(x) for x in list_offsets]
+            }
+            self.fhand.write(centroids.astype(EMBEDDING_DTYPE).tobytes())
+            ivf['order_offset'] = self.fhand.tell()
+            self.fhand.write(order.astype(ORDER_DTYPE).tobytes())
+
+        footer = {
+            'version': FORMAT_VERSION,
+            'n': n,
+            'dim': self.dim if has_embeddings else 0,
+            'dtype': EMBEDDING_DTYPE.str,
+            'text_offset': 0,
+            'offsets_offset': offsets_offset,
+            'emb_offset': emb_offset,
+            'ivf': ivf,
+            'names': self.names
+        }
+        footer_bytes = json.dumps(footer).encode('utf-8')
+        self.fhand.write(footer_bytes)
+        self.fhand.write(struct.pack('<Q', len(footer_bytes)))
+        self.fhand.write(MAGIC)
+        self.fhand.close()
+        return self.path
+
+    # On error; gets rid of the partial file
+    def abort(self):
+        try:
+            self.fhand.close()
+            if self.emb_spool:
+                self.emb_spool.close()
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# Read-only view over a chunk store file. Nothing is unpickled and nothing is read until asked for.
+# The embeddings are a read-only np.memmap; texts are sliced from an mmap of the file.
+class ChunkStore():
+    def __init__(self, path) -> None:
+        self.path = path
+        self.fhand = open(path, 'rb')
+        try:
+            self.fhand.seek(-TRAILER_SIZE, os.SEEK_END)
+            footer_len_bytes = self.fhand.read(8)
+            if self.fhand.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"File {path} is not a chunk store")
+            footer_len = struct.unpack('<Q', footer_len_bytes)[0]
+            self.fhand.seek(-(TRAILER_SIZE + footer_len), os.SEEK_END)
+            footer = json.loads(self.fhand.read(footer_len))
+        except:
+            self.fhand.close()
+            raise
+
+        self.n = footer['n']
+        self.dim = footer['dim']
+        self.names = footer['names']
+        self.mm = mmap.mmap(self.fhand.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = np.frombuffer(self.mm, dtype=OFFSET_DTYPE, count=self.n + 1, offset=footer['offsets_offset'])
+        self.embeddings = None
+        if footer['emb_offset'] is not None and self.n:
+            self.embeddings = np.memmap(path, dtype=np.dtype(footer['dtype']), mode='r', offset=footer['emb_offset'], shape=(self.n, self.dim))
+
+        # ANN index, if there is one
+        self.ivf_centroids = None
+        self.ivf_order = None
+        self.ivf_list_offsets = None
+        ivf = footer.get('ivf')
+        if ivf:
+            self.ivf_centroids = np.frombuffer(self.mm, dtype=EMBEDDING_DTYPE, count=ivf['n_lists'] * self.dim, offset=ivf['centroids_offset']).reshape(ivf['n_lists'], self.dim)
+            self.ivf_order = np.frombuffer(self.mm, dtype=ORDER_DTYPE, count=self.n, offset=ivf['order_offset'])
+            self.ivf_list_offsets = np.array(ivf['list_offsets'])
+
+    def has_index(self):
+        return self.ivf_centroids is not None
+
+    def __len__(self):
+        return self.n
+
+    def text(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i+1])
+        return self.mm[start:end].decode('utf-8')
+
+    def text_length(self, i):
+        return int(self.offsets[i+1] - self.offsets[i])
+
+    def close(self):
+        # Views into the mmap must be dropped before it can be closed
+        self.offsets = None
+        self.embeddings = None
+        self.ivf_centroids = None
+        self.ivf_order = None
+        try:
+            self.mm.close()
+        except BufferError:
+            # Someone's still holding a view; the mmap will be closed when it's garbage collected.
+            pass
+        self.fhand.close()
+
+
+# Converts the legacy format (a file of pickled Chunk objects) to a chunk store.
+# Returns the path of the new file.
+def convert_pickle_file(old_path, new_path=None):
+    writer = ChunkStoreWriter(new_path)
+    try:
+        with open(old_path, 'rb') as fhand:
+            while True:
+                try:
+                    chunk = pickle.load(fhand)
+                except EOFError:
+                    break
+                writer.add(chunk.txt, chunk.source_name, embedding=chunk.embedding)
+        return writer.finish()
+    except:
+        print(f"Failed to convert legacy chunk file {old_path}", file=sys.stderr)
+        writer.abort()
+        raise
+
+
+# Writes a copy of a chunk store with an ANN index (if it's big enough). Returns the path of the new file.
+def rebuild_with_index(path, index_min_chunks, new_path=None):
+    store = ChunkStore(path)
+    writer = ChunkStoreWriter(new_path)
+    try:
+        for i in range(len(store)):
+            writer.add(store.text(i), store.names[i])
+        if store.embeddings is not None:
+            writer.add_embeddings(store.embeddings)
+        return writer.finish(index_min_chunks=index_min_chunks)
+    except:
+        writer.abort()
+        raise
+    finally:
+        store.close()
@@ -15,6 +15,21 @@ DB_PORT = int(secrets.DB_PORT) if secrets.DB_PORT else 3306
 DB_TYPE = secrets.DB_TYPE or 'local'  # 'local' or 'deployed' --> changes how app deals with transaction settings
 DB_NAME = secrets.DB_NAME or 'learn'
 
+# Read replicas, used for some read-only queries (see db_pooler.py); credentials default to the primary's
+DB_REPLICAS = []
+if secrets.DB_REPLICA_ENDPOINTS:
+    for endpoint in secrets.DB_REPLICA_ENDPOINTS.split(','):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        host, _, port = endpoint.partition(':')
+        DB_REPLICAS.append({
+            'host': host,
+            'port': int(port) if port else DB_PORT,
+            'user': secrets.DB_REPLICA_USERNAME or DB_USERNAME,
+            'password': secrets.DB_REPLICA_PASSWORD or DB_PASSWORD
+        })
+
 # An auth secret is required in any multi user setup that uses custom auth
 if 'auth' in SETTINGS and 'providers' in SETTINGS['auth'] and len(SETTINGS['auth']['providers']) and not ('system' in SETTINGS['auth'] and SETTINGS['auth']['system'] == 'custom'):
     if not secrets.CUSTOM_AUTH_SECRET:
@@ -38,3 +53,20 @@ POOLER_CONNECTION_PARAMS = {
     'port': 6379,
     'db': 1,  # Note that this is different from 0, the one used above for celery.
 }
+
+POOLER_USE_MSGPACK = True  # Messages to/from the db pooler are msgpack instead of JSON, if msgpack is installed
+
+# The db pooler's MySQL connections (see db_pooler.py)
+POOLER_MIN_CONNECTIONS = 4  # kept open even when idle
+POOLER_MAX_CONNECTIONS = 24  # shared and exclusive together
+POOLER_DB_IDS_PER_CONNECTION = 4  # once every shared connection has this many users, another is opened (if there's room)
+POOLER_THREADS = 48  # should be comfortably more than POOLER_MAX_CONNECTIONS, since threads wait on connections
+POOLER_IDLE_TIMEOUT = 5 * 60  # in seconds, before an unused connection (beyond the minimum) is closed
+POOLER_PING_INTERVAL = 60  # in seconds, how long a connection can sit idle before it's health checked
+POOLER_ABANDONED_TIMEOUT = 60 * 60  # in seconds, before a db connection that hasn't been used or closed is forgotten (along with its cursors)
+POOLER_METRICS_KEY = 'db_pooler_metrics'  # redis key (in the pooler's redis db) where the pooler publishes its metrics as JSON
+POOLER_REPLICA_MIN_CONNECTIONS = 2  # per replica
+POOLER_REPLICA_MAX_CONNECTIONS = 16  # per replica
+POOLER_REPLICA_MAX_LAG = 2  # in seconds; a replica further behind than this isn't used, and reads go to the primary
+POOLER_FETCH_BATCH_ROWS = 1000  # max rows per message when streaming results from the pooler (see PooledCursor.stream)
+POOLER_FETCH_BATCH_BYTES = 1024 * 1024  # roughly the max size of those rows
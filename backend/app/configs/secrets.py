@@ -26,6 +26,9 @@ DB_PASSWORD = os.environ.get("DB_PASSWORD")
 DB_PORT = os.environ.get("DB_PORT")
 DB_NAME = os.environ.get("DB_NAME")
 DB_TYPE = os.environ.get("DB_TYPE")  # 'local' or 'deployed' --> changes how app deals with transaction settings
+DB_REPLICA_ENDPOINTS = os.environ.get("DB_REPLICA_ENDPOINTS")  # Optional read replicas, comma separated, like host1:3306,host2
+DB_REPLICA_USERNAME = os.environ.get("DB_REPLICA_USERNAME")
+DB_REPLICA_PASSWORD = os.environ.get("DB_REPLICA_PASSWORD")
 
 # For boto3 access
 AWS_ACCESS_KEY = os.environ.get("AWS_ACCESS_KEY")
@@ -4,6 +4,7 @@ from ..integrations.lm import make_code_from_setting
 from ..integrations.tts import TTS_PROVIDERS
 from ..integrations.web import SEARCH_PROVIDERS
 import os
+import tempfile
 
 BACKEND_VERSION = '0.13.1'  # Viewable when a user goes to the root "/" endpoint of the backend
 
@@ -52,10 +53,49 @@ FRONTEND_URL = str(SETTINGS['services']['frontend']['public_url']).rstrip('/') i
 
 MAX_PDF_PAGES = 250  # SHOULD MATCH FRONTEND - the maximum size of a PDF a user can upload.
 
+FOLDER_EXPORT_MAX_WORKERS = 8  # Files fetched at once when a folder is downloaded as a zip (also about how many sit on disk at a time)
+FOLDER_EXPORT_CHUNK_SIZE = 256 * 1024  # bytes read at a time from each file into the zip that's streamed out
+
 MAX_CHAT_RETRIEVER_RESULTS = 7  # When a retriever query is made (without max chunks, or when the full context won't fit in the model), this gives the maximum number of chunks that the query will return in most circumstances. 
 
 RETRIEVER_JOB_TIMEOUT = 30  # in minutes, the max time we'll wait for a retriever to be created (e.g., a document to be processed)
 
+JOB_WRITER_MAX_ROWS = 500  # Job results are written in batches of at most this many rows (see JobWriter in jobs.py)
+JOB_WRITER_MAX_BYTES = 4 * 1024 * 1024  # and about this many bytes (should be well under MySQL's max_allowed_packet)
+JOB_WRITER_FLUSH_INTERVAL = 2  # in seconds, the longest buffered job results and progress wait before being written
+
+RETRIEVER_CACHE_MAX_ENTRIES = 512  # The max number of loaded resource retrievers kept around by each process (see retriever_cache.py)
+RETRIEVER_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # The max total size of those retrievers' chunk files on disk
+
+SOURCE_TREE_CACHE_MAX_ENTRIES = 2048  # The max number of resolved retrieval source trees (folders and such) kept by each process (see source_tree_cache.py)
+SOURCE_TREE_CACHE_TTL = 120  # in seconds; entries are also checked against the database before use
+
+NOTEBOOK_COMPACT_EVERY = 50  # Notebook saves (block ops) between rewrites of the full notebook (see templates/notebook.py)
+NOTEBOOK_CACHE_MAX_ENTRIES = 256  # The max number of notebooks kept in memory by each process
+
+RETRIEVER_ANN_MIN_RESOURCE_CHUNKS = 64  # Resources with at least this many chunks get an approximate nearest neighbor index (see ann.py)
+RETRIEVER_ANN_MIN_CHUNKS = 20_000  # Retrievers with fewer chunks than this (across all resources) are searched by brute force
+RETRIEVER_ANN_PROBE_FRACTION = .1  # The fraction of the ANN index searched per query; higher = better recall, slower
+
+EMBEDDING_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'abbey_embedding_cache.sqlite3')  # Local embedding cache shared by all processes on the machine (see embedding_cache.py)
+EMBEDDING_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024  # Max size of that cache; set to 0 to disable it
+
+CRAWLER_DB_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'abbey_crawler_dbs')  # Local copies of crawler databases, shared by all processes on the machine (see CrawlerDBCache in templates/crawler.py)
+CRAWLER_DB_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Max total size of those copies
+CRAWLER_DB_MAX_PENDING_COMMITS = 50  # A crawler database open for writing is uploaded when it's closed, or after this many commits, whichever's first
+
+CRAWL_MAX_IN_FLIGHT = 8  # Scrapes running at once for a crawler's scrape queue job (see ScrapeQueueCrawler in templates/crawler.py)
+CRAWL_MAX_PER_DOMAIN = 2  # Of those, the most that can be for the same domain
+CRAWL_DOMAIN_DELAY = 2  # in seconds, the least time between starting scrapes on the same domain
+CRAWL_CLAIM_BATCH = 50  # Queue items taken at a time
+CRAWL_FLUSH_EVERY = 10  # Scrape results are saved to the crawler database this many at a time
+CRAWL_FLUSH_INTERVAL = 30  # in seconds, the longest a finished scrape waits to be saved
+
+LM_SCHEDULER_INITIAL_CONCURRENCY = 10  # Bulk LM calls in flight per model to start with; adapts from there (see lm_scheduler.py)
+LM_SCHEDULER_MAX_CONCURRENCY = 64  # The most bulk LM calls in flight per model per process
+LM_SCHEDULER_INTERACTIVE_RESERVE = .2  # The fraction of those slots background jobs can't use, to keep room for interactive calls
+LM_SCHEDULER_MAX_RETRIES = 4  # Times a call is retried after a rate limit error
+
 # Domains a user cannot give permissions to on an asset (a user can share with someone@gmail.com, but not all users with a gmail.com email domain – but can give permissions to everyone with a us.ai domain name, or a superspecial.com domain name email.)
 ILLEGAL_SHARE_DOMAINS = [
     'gmail.com',
@@ -76,6 +116,12 @@ MAX_EMAIL_WAIT = 10  # The number of seconds that needs to go by after a previou
 # Controls whether actual permissioning applies or everyone is allowed to see everything
 PERMISSIONING = "real"  # "real" | "demo"
 
+# Listings (search_assets, search_groups) check permissions with the asset_visibility and group_visibility tables rather than asset_permissions (see visibility.py).
+# Off by default: the tables start out empty. Run "flask rebuild-visibility" once, then turn this on.
+ASSET_VISIBILITY_INDEX = False
+LISTING_TOTAL_CACHE_TTL = 60  # seconds that a listing's total count is reused
+LISTING_TOTAL_CACHE_MAX_ENTRIES = 10_000
+
 # If someone isn't logged in (such as for a demo)
 # we can allow users to edit certain templates
 OVERRIDE_ALLOWED_TEMPLATES = []  # None | ['temp1', 'temp2']
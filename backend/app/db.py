@@ -3,73 +3,174 @@ from flask import current_app, g
 from .configs.secrets import *
 import warnings
 from .utils import get_unique_id
-from .configs.conn_config import POOLER_CONNECTION_PARAMS
+from .configs.conn_config import POOLER_CONNECTION_PARAMS, POOLER_USE_MSGPACK, POOLER_METRICS_KEY, POOLER_FETCH_BATCH_ROWS, POOLER_FETCH_BATCH_BYTES
 import redis
 import json
 import time
 from functools import wraps
+from threading import Lock
 
 
 REDIS_TIMEOUT = 30  # in seconds
-def exec_via_redis(redis: redis.Redis, options):
-    response_key = f"response:{get_unique_id()}"
-    options['response_key'] = response_key
-    message = json.dumps(options)
-    redis.rpush('sql_queue', message)
-    receipt = redis.blpop(response_key, timeout=REDIS_TIMEOUT)
+
+"""
+
+Protocol with the pooler (db_pooler.py, a separate process):
+
+Every message is a batch: {'db_id': ..., 'response_key': ..., 'commands': [...]}, run in order by the pooler against one connection.
+The reply (pushed to response_key) has the result of each command; if a command fails, the ones after it are skipped (except cleanup, like closing cursors).
+
+Commands whose results nobody needs (getting a connection, making a cursor, execute, closing a cursor) are deferred by the client
+and go out with the next command whose result is needed – so execute + fetchone is one message, and so is execute + commit.
+Errors from a deferred command are raised by whatever sends it.
+
+Messages are msgpack if it's installed (and POOLER_USE_MSGPACK is set), otherwise JSON; the pooler replies in kind.
+Each round trip is a single pipelined rpush + blpop over a connection from one Redis connection pool per process.
+
+"""
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+USE_MSGPACK = POOLER_USE_MSGPACK and msgpack is not None
+
+
+def encode_message(obj):
+    if USE_MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj)
+
+
+def decode_message(message):
+    if USE_MSGPACK:
+        return msgpack.unpackb(message, raw=False)
+    return json.loads(message)
+
+
+"""
+
+Escaping for SQL that's put together as a string (for parts that can't be %s parameters, like permissioning strings and IN lists).
+
+It's done here rather than by the pooler so that it costs no round trip; the result is the same as pymysql's connection.escape_string,
+which (with the server's default sql_mode, i.e. without NO_BACKSLASH_ESCAPES) is a fixed table of backslash escapes.
+
+"""
+
+_ESCAPE_TABLE = [chr(x) for x in range(128)]
+_ESCAPE_TABLE[0] = "\\0"
+_ESCAPE_TABLE[ord("\\")] = "\\\\"
+_ESCAPE_TABLE[ord("\n")] = "\\n"
+_ESCAPE_TABLE[ord("\r")] = "\\r"
+_ESCAPE_TABLE[ord("\032")] = "\\Z"
+_ESCAPE_TABLE[ord('"')] = '\\"'
+_ESCAPE_TABLE[ord("'")] = "\\'"
+
+
+# For use inside quotes
+def escape_string(text: str):
+    return text.translate(_ESCAPE_TABLE)
+
+
+# A value as it would be bound as a parameter: numbers as is, None as NULL, and anything else as a quoted, escaped string
+def escape_literal(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    return f"'{escape_string(str(value))}'"
+
+
+# For IN (...) lists
+def escape_list(values):
+    return ",".join([escape_literal(x) for x in values])
+
+
+# redis-py connection pools are thread safe and reset themselves after a fork
+REDIS_POOL = redis.ConnectionPool(**POOLER_CONNECTION_PARAMS)
+def get_redis() -> redis.Redis:
+    return redis.Redis(connection_pool=REDIS_POOL)
+
+
+# Sends a batch of commands; returns the list of their results, or None if wait is False (fire and forget)
+def exec_via_redis(r: redis.Redis, db_id, commands, wait=True):
+    options = {
+        'db_id': db_id,
+        'commands': commands,
+        'response_key': f"response:{get_unique_id()}" if wait else None
+    }
+    message = encode_message(options)
+    if not wait:
+        r.rpush('sql_queue', message)
+        return None
+    pipe = r.pipeline(transaction=False)
+    pipe.rpush('sql_queue', message)
+    pipe.blpop(options['response_key'], timeout=REDIS_TIMEOUT)
+    _, receipt = pipe.execute()
     if not receipt:
-        raise TimeoutError(f"Redis timeout occurred for command with options:\n {options}")
-    message = receipt[1]
-    full = json.loads(message)
+        raise TimeoutError(f"Redis timeout occurred for commands:\n {commands}")
+    full = decode_message(receipt[1])
     if full['error_status']:
         raise Exception(f"Error passed from db pool: {full['error_text']}")
     return full['data']
 
 
+# Latest metrics published by the pooler (connections, utilisation, wait times, queue depth), or None
+def get_pooler_metrics():
+    metrics = get_redis().get(POOLER_METRICS_KEY)
+    return json.loads(metrics) if metrics else None
+
+
+def make_command(command_type, name='', curr_id=None, args=[], kwargs={}):
+    return {
+        'type': command_type,
+        'name': name,
+        'curr_id': curr_id,
+        'args': list(args),
+        'kwargs': kwargs
+    }
+
+
 NO_CALL = {'lastrowid', 'rowcount'}  # these attributes don't return functions, but rather their attribute values, as expected
+DEFERRED_FUNCTIONS = {'execute', 'executemany', 'close'}  # cursor functions whose return values we don't wait for
 class PooledCursor():
     id: str
     db_id: str
-    def __init__(self, db_id) -> None:
-        self.db_id = db_id
+    conn: 'PooledConn'
+    def __init__(self, conn: 'PooledConn') -> None:
+        self.conn = conn
+        self.db_id = conn.id
         self.id = get_unique_id()
-        self.redis = redis.Redis(**POOLER_CONNECTION_PARAMS)
-        # Create new cursor
-        options = {
-            'type': 'new_cursor',
-            'name': '',
-            'db_id': self.db_id,
-            'curr_id': self.id,
-            'kwargs': {},
-            'args': []
-        }
-        exec_via_redis(self.redis, options)
+        # Create new cursor (goes out with the next command that needs a response)
+        self.conn.defer(make_command('new_cursor', curr_id=self.id))
 
     # Forwards curr.functions
     def forward(self, name, *args, **kwargs):
-        options = {
-            'type': 'cursor_function',
-            'name': name,
-            'db_id': self.db_id,
-            'curr_id': self.id,
-            'kwargs': kwargs,
-            'args': args
-        }
-        message = exec_via_redis(self.redis, options)
-        return message
-
-    # Get attributes (not functions). Note that these are split up due to the JSON message passing limitations (we couldn't "get" a complex object, like a function).
+        command = make_command('cursor_function', name=name, curr_id=self.id, args=args, kwargs=kwargs)
+        if name in DEFERRED_FUNCTIONS:
+            self.conn.defer(command)
+            return None
+        return self.conn.run(command)
+
+    # Lazily yields the rows of the last execute, fetched from the pooler in batches of up to max_rows / about max_bytes, rather than a round trip per row.
+    # The first batch is small so that the first row comes back quickly.
+    def stream(self, max_rows=POOLER_FETCH_BATCH_ROWS, max_bytes=POOLER_FETCH_BATCH_BYTES, first_batch_rows=10):
+        batch_rows = min(first_batch_rows, max_rows)
+        while True:
+            batch = self.conn.run(make_command('fetch_batch', curr_id=self.id, kwargs={'max_rows': batch_rows, 'max_bytes': max_bytes}))
+            for row in batch['rows']:
+                yield row
+            if batch['done']:
+                break
+            batch_rows = max_rows
+
+    # Get attributes (not functions). Note that these are split up due to the message passing limitations (we couldn't "get" a complex object, like a function).
     def get(self, name):
-        options = {
-            'type': 'cursor_attribute',
-            'name': name,
-            'db_id': self.db_id,
-            'curr_id': self.id,
-            'kwargs': {},
-            'args': []
-        }
-        return exec_via_redis(self.redis, options)
-    
+        return self.conn.run(make_command('cursor_attribute', name=name, curr_id=self.id))
+
     def __getattr__(self, name):
         if name in NO_CALL:
             return self.get(name)
@@ -79,52 +180,65 @@ class PooledCursor():
         return method
 
 
+CLEANUP_COMMANDS = {'new_connection', 'new_cursor', 'close_connection'}  # along with closing cursors, these are safe to send without waiting for the result
 class PooledConn():
     id: str
     r: redis.Redis
-    def __init__(self, consistent_conn=False, exclusive_conn=False) -> None:
+    def __init__(self, consistent_conn=False, exclusive_conn=False, read_only=False) -> None:
         self.id = get_unique_id()
-        self.r = redis.Redis(**POOLER_CONNECTION_PARAMS)
-        options = {
-            'type': 'new_connection',
-            'name': '',
-            'db_id': self.id,
-            'curr_id': None,
-            'kwargs': {'consistent': consistent_conn, 'exclusive': exclusive_conn},
-            'args': []
-        }
-        exec_via_redis(self.r, options)
+        self.r = get_redis()
+        self.lock = Lock()
+        self.pending = []
+        self.opened = False  # whether the pooler has been told about this connection yet
+        self.closed = False
+        self.defer(make_command('new_connection', kwargs={'consistent': consistent_conn, 'exclusive': exclusive_conn, 'read_only': read_only}))
+
+    def defer(self, command):
+        with self.lock:
+            self.pending.append(command)
+
+    # Sends whatever's pending along with command; returns command's result
+    def run(self, command):
+        return self._send([command])[-1]
+
+    def flush(self):
+        if self.pending:
+            self._send([])
+
+    def _send(self, commands, wait=True):
+        with self.lock:
+            batch = self.pending + commands
+            self.pending = []
+            self.opened = True
+        return exec_via_redis(self.r, self.id, batch, wait=wait)
+
+    # Whether anything pending could fail in a way someone should hear about (i.e., a deferred execute)
+    def has_unconfirmed_work(self):
+        with self.lock:
+            return any(not _is_cleanup(x) for x in self.pending)
 
     def close(self):
-        options = {
-            'type': 'close_connection',
-            'name': '',
-            'db_id': self.id,
-            'curr_id': None,
-        }
-        exec_via_redis(self.r, options)
+        if self.closed:
+            return
+        self.closed = True
+        with self.lock:
+            if not self.opened and all(_is_cleanup(x) for x in self.pending):
+                # The pooler never heard about us
+                self.pending = []
+                return
+        # If all that's left is cleanup, nobody needs to wait for it
+        wait = self.has_unconfirmed_work()
+        self._send([make_command('close_connection')], wait=wait)
 
     def commit(self):
-        options = {
-            'type': 'commit',
-            'name': '',
-            'db_id': self.id,
-            'curr_id': None,
-            'kwargs': {},
-            'args': []
-        }
-        exec_via_redis(self.r, options)
+        self.run(make_command('commit'))
 
     def escape_string(self, text):
-        options = {
-            'type': 'escape_string',
-            'name': '',
-            'db_id': self.id,
-            'curr_id': None,
-            'kwargs': {},
-            'args': [text]
-        }
-        return exec_via_redis(self.r, options)
+        return escape_string(text)
+
+
+def _is_cleanup(command):
+    return command['type'] in CLEANUP_COMMANDS or (command['type'] == 'cursor_function' and command['name'] == 'close')
 
 
 # Every call to get_db returns a new ProxyDB object, which itself (re-)uses a PooledDB redis connection + identity
@@ -137,12 +251,12 @@ class ProxyDB():
         self.cursors = []        
 
     def cursor(self) -> PooledCursor:
-        new_cursor = PooledCursor(self.pooled_conn.id)
+        new_cursor = PooledCursor(self.pooled_conn)
         self.cursors.append(new_cursor)
         return new_cursor
     
     def escape_string(self, text):
-        return self.pooled_conn.escape_string(text)
+        return escape_string(text)
     
     def close_cursors(self, exempt=[]):
         for curr in self.cursors:
@@ -150,11 +264,18 @@ class ProxyDB():
             if curr.id not in exempt:
                 curr.close()
         self.cursors = [x for x in self.cursors if x.id in exempt]
+        # The closes themselves can wait for the next message, but a deferred execute shouldn't fail silently
+        if self.pooled_conn.has_unconfirmed_work():
+            self.pooled_conn.flush()
 
     def close(self):
         self.close_cursors()
         self.pooled_conn.close()
 
+    # Sends anything deferred right away, so that a failed execute raises here (for callers that catch it)
+    def flush(self):
+        self.pooled_conn.flush()
+
     def commit(self, close_cursors=True, close=False):
         self.pooled_conn.commit()
         if close:
@@ -166,14 +287,14 @@ class ProxyDB():
 # Wrapper for non-endpoint functions that require use of the db
 def needs_db(func):
     @wraps(func)
-    def wrapper(*args, db: ProxyDB=None, new_conn=False, exclusive_conn=False, consistent_conn=False, no_commit=False, **kwargs):
+    def wrapper(*args, db: ProxyDB=None, new_conn=False, exclusive_conn=False, consistent_conn=False, read_only=False, no_commit=False, **kwargs):
         # Close connection iff the connection is fresh
         needs_close = False
         # We want to close cursors, but can't close a calling function's cursors if they are sharing the database
         exempt_cursor_ids = []
         if not db:
-            real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn)
-            needs_close = new_conn or exclusive_conn or consistent_conn  # don't want to close if it's the global connection (g.db)
+            real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, read_only=read_only)
+            needs_close = new_conn or exclusive_conn or consistent_conn  # don't want to close if it's a global connection (g.db / g.read_db)
         else:
             real_db = db
             exempt_cursor_ids.extend([x.id for x in db.cursors])
@@ -190,17 +311,17 @@ def needs_db(func):
     return wrapper
 
 # If you can figure out how to deduplicate this code with the above, I will give you $20.
-def needs_special_db(new_conn=False, exclusive_conn=False, consistent_conn=False, no_close=False):
+def needs_special_db(new_conn=False, exclusive_conn=False, consistent_conn=False, read_only=False, no_close=False):
     def decorator(func):
         @wraps(func)
-        def wrapper(*args, db: ProxyDB=None, new_conn=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, no_commit=False, **kwargs):
+        def wrapper(*args, db: ProxyDB=None, new_conn=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, read_only=read_only, no_commit=False, **kwargs):
             # Close connection iff the connection is fresh
             needs_close = False
             # We want to close cursors, but can't close a calling function's cursors if they are sharing the database
             exempt_cursor_ids = []
             if not db:
-                real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn)
-                needs_close = new_conn or exclusive_conn or consistent_conn  # don't want to close if it's the global connection (g.db)
+                real_db = get_db(new_connection=new_conn, exclusive_conn=exclusive_conn, consistent_conn=consistent_conn, read_only=read_only)
+                needs_close = new_conn or exclusive_conn or consistent_conn  # don't want to close if it's a global connection (g.db / g.read_db)
             else:
                 real_db = db
                 exempt_cursor_ids.extend([x.id for x in db.cursors])
@@ -232,7 +353,7 @@ def db_polling_lock(name, db: ProxyDB = None):
     while True:
         if time.time() - start > timeout:
             return False
-        sql = f"SELECT IS_FREE_LOCK('{db.escape_string(name)}') as 'lock';"
+        sql = f"SELECT IS_FREE_LOCK('{escape_string(name)}') as 'lock';"
         curr.execute(sql)
         res = curr.fetchone()
         if res['lock']:
@@ -243,7 +364,7 @@ def db_polling_lock(name, db: ProxyDB = None):
     while True:
         if time.time() - start > timeout:
             return False
-        sql = f"SELECT GET_LOCK('{db.escape_string(name)}', .1) as 'lock';"
+        sql = f"SELECT GET_LOCK('{escape_string(name)}', .1) as 'lock';"
         curr.execute(sql)
         res = curr.fetchone()
         if res['lock']:
@@ -280,13 +401,19 @@ def with_lock(lock_name, db):
     return decorator
 
 
-def get_db(new_connection=False, consistent_conn=False, exclusive_conn=False) -> ProxyDB:
+# read_only connections may go to a read replica, so they can be a little behind (see POOLER_REPLICA_MAX_LAG), and can't write.
+# Use them for heavy reads that don't need to see what was just written.
+def get_db(new_connection=False, consistent_conn=False, exclusive_conn=False, read_only=False) -> ProxyDB:
     try:
         # TODO: consistent connection can have its own global variable
         if new_connection or consistent_conn or exclusive_conn:
-            new_conn = PooledConn(consistent_conn=consistent_conn, exclusive_conn=exclusive_conn)
+            new_conn = PooledConn(consistent_conn=consistent_conn, exclusive_conn=exclusive_conn, read_only=read_only and not exclusive_conn)
             new_db = ProxyDB(new_conn)
             return new_db
+        if read_only:
+            if 'read_db' not in g:
+                g.read_db = PooledConn(read_only=True)
+            return ProxyDB(g.read_db)
         if 'db' not in g:
             g.db = PooledConn()
         return ProxyDB(g.db)
@@ -294,7 +421,7 @@ def get_db(new_connection=False, consistent_conn=False, exclusive_conn=False) ->
         # Usually means working outside of application context
         # Typtically undesirable to get here, but in some cases need it
         warnings.warn(f"Tried to use existing connection for database, but RuntimeError occurred: {str(e)}.")
-        new_conn = PooledConn()
+        new_conn = PooledConn(read_only=read_only)
         return ProxyDB(new_conn)
 
 
@@ -312,5 +439,17 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+# The request's global connections (g.db, g.read_db) are closed along with the app context, which also sends any cursor closes still pending
+def close_global_db(e=None):
+    for key in ['db', 'read_db']:
+        conn = g.pop(key, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception as e:
+                warnings.warn(f"Couldn't close global db connection: {e}")
+
+
 def init_app(app):
+    app.teardown_appcontext(close_global_db)
     app.cli.add_command(init_db_command)
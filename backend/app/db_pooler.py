@@ -1,17 +1,25 @@
-from .configs.conn_config import DB_ENDPOINT, DB_NAME, DB_PASSWORD, DB_PORT, DB_USERNAME, POOLER_CONNECTION_PARAMS
+from .configs.conn_config import (
+    DB_ENDPOINT, DB_NAME, DB_PASSWORD, DB_PORT, DB_USERNAME, POOLER_CONNECTION_PARAMS,
+    POOLER_MIN_CONNECTIONS, POOLER_MAX_CONNECTIONS, POOLER_DB_IDS_PER_CONNECTION, POOLER_THREADS,
+    POOLER_IDLE_TIMEOUT, POOLER_PING_INTERVAL, POOLER_ABANDONED_TIMEOUT, POOLER_METRICS_KEY,
+    DB_REPLICAS, POOLER_REPLICA_MIN_CONNECTIONS, POOLER_REPLICA_MAX_CONNECTIONS, POOLER_REPLICA_MAX_LAG
+)
 import redis
 import pymysql
 from pymysql.constants import CLIENT
 import sys
 import json
 from concurrent.futures import ThreadPoolExecutor
-import random
-from threading import Lock, Timer
+from threading import Lock, Condition, Timer, Thread
 from .utils import make_json_serializable
 import atexit
 from functools import wraps
-from queue import Queue, Empty
+from collections import deque
 import time
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 """
 
@@ -19,12 +27,22 @@ NOTE: this all runs in a separate process from the rest of the server.
 
 There is NEVER a reason to import any of it into the server.
 
+The pool:
+- Each db_id (a PooledConn in db.py) is assigned a MySQL connection when it's made, and keeps it until it's closed.
+- Shared connections take any number of db_ids; a new db_id goes to the least loaded one, and a new connection is opened once they're all at POOLER_DB_IDS_PER_CONNECTION (up to POOLER_MAX_CONNECTIONS).
+- Exclusive connections take one db_id at a time, on a lease that runs out once the db_id has been idle for LOCK_TIMEOUT (each command renews it).
+  Whatever the holder didn't commit is rolled back before the connection goes to anyone else; a db_id whose lease ran out gets errors, not a new connection.
+- A maintenance thread pings idle connections (replacing dead ones), closes connections that have been idle too long (down to POOLER_MIN_CONNECTIONS),
+  forgets db_ids (and their cursors) that haven't been used in POOLER_ABANDONED_TIMEOUT, and publishes metrics to redis at POOLER_METRICS_KEY.
+
+Read replicas (DB_REPLICAS) each get a pool of their own. A read_only db_id goes to the least loaded replica whose replication lag is at most POOLER_REPLICA_MAX_LAG,
+or to the primary if there isn't one. Replica connections are read only at the session level.
+
 """
 
 # Initialize Redis connection
 r = redis.Redis(**POOLER_CONNECTION_PARAMS)
 
-# Create the connection pool
 db_params = {
     'host': DB_ENDPOINT,
     'user': DB_USERNAME,
@@ -34,290 +52,765 @@ db_params = {
     'client_flag': CLIENT.MULTI_STATEMENTS,
     'cursorclass': pymysql.cursors.DictCursor
 }
-N_POOL = 10
-N_EXCL = 2
 
-def get_new_conn():
-    return pymysql.connect(**db_params)
+def get_replica_params(replica):
+    return {
+        **db_params,
+        'host': replica['host'],
+        'user': replica['user'],
+        'passwd': replica['password'],
+        'port': replica['port'],
+        'init_command': "SET SESSION TRANSACTION READ ONLY"
+    }
 
-# We're gonna try to get out of using a lock on this list...
-CONNECTIONS = [None] * (N_POOL + N_EXCL)
-CONNECTION_LOCKS = [Lock() for _ in range(N_POOL + N_EXCL)]
+def get_new_conn(params=db_params):
+    return pymysql.connect(**params)
 
-# Connection factory with retry mechanism
-def initialize_connections(max_retries=10, retry_delay=1):
-    for attempt in range(max_retries):
-        try:
-            for i in range(N_POOL + N_EXCL):
-                if CONNECTIONS[i] is None or not CONNECTIONS[i].open:
-                    CONNECTIONS[i] = get_new_conn()
-            break
-        except (pymysql.OperationalError, pymysql.InterfaceError) as e:
-            if attempt == max_retries - 1:
-                raise
-            time.sleep(retry_delay)
 
-# Exclusive connections
-AVAILABLE_EXCL_CONNS = Queue(maxsize=N_EXCL)  # queues are thread safe
-for i in range(N_EXCL):
-    AVAILABLE_EXCL_CONNS.put(N_POOL + i)
-
-def is_exclusive_lock(db_index):
-    return db_index >= N_POOL
-
-ID_TO_CONN_LOCK = Lock()
-ID_TO_CONN_INDEX = {}  # btw, this might be a small memory leak, since stuff isn't being taken out.
-
-# Note that every id here has a unique cursor, unlike with connections.
-ID_TO_CURR_LOCK = Lock()
-ID_TO_CURR = {}  # this is directly to the object and not the cursor because cursors are not provisioned.
+LOCK_TIMEOUT = 5  # in seconds, for both DBs and other global variables.
+MAINTENANCE_INTERVAL = 5  # in seconds
+WAIT_SAMPLES = 1000  # recent lock waits kept for metrics
 
 
 # ----------------------------------------------------
 
 
-LOCK_TIMEOUT = 5  # in seconds, for both DBs and other global variables.
+# One MySQL connection in the pool
+class PoolConnection():
+    index: int
+    conn: pymysql.Connection
+    lock: Lock
+    def __init__(self, pool: 'Pool', index, exclusive=False) -> None:
+        self.pool = pool
+        self.index = index
+        self.exclusive = exclusive
+        self.conn = get_new_conn(pool.params)
+        self.lock = Lock()
+        self.db_ids = set()  # done with the pool's lock
+        self.created = time.time()
+        self.last_used = self.created
+        self.busy_time = 0  # seconds spent holding the lock (for utilisation)
+        self.n_commands = 0
+        self.healthy = True
+
+    def close(self):
+        try:
+            self.conn.close()
+        except:
+            pass
+
 
 # Acquires lock, gives access to the db object, then gets out of the way
+# With a db_id, also checks that the db_id still holds the connection, if it's exclusive (its lease might have run out while it waited)
 class DB():
-    index: int
+    pool_conn: PoolConnection
     db: pymysql.Connection
-    lock: Lock
-    def __init__(self, index) -> None:
-        self.index = index
-        self.lock = CONNECTION_LOCKS[self.index]
+    def __init__(self, pool_conn: PoolConnection, db_id=None) -> None:
+        self.pool_conn = pool_conn
+        self.db_id = db_id
 
     def __enter__(self) -> pymysql.Connection:
-        if self.lock.acquire(timeout=LOCK_TIMEOUT):
-            self.db = CONNECTIONS[self.index]
+        start = time.time()
+        if self.pool_conn.lock.acquire(timeout=LOCK_TIMEOUT):
+            self.acquired = time.time()
+            self.pool_conn.pool.record_wait(self.acquired - start)
+            if self.db_id is not None and self.pool_conn.exclusive and self.db_id not in self.pool_conn.db_ids:
+                self.pool_conn.lock.release()
+                raise Exception(self.pool_conn.pool.lease_expired_message(self.db_id))
+            self.db = self.pool_conn.conn
             return self.db
         else:
+            self.pool_conn.pool.record_wait(time.time() - start)
             raise Exception(f"Could not acquire lock for new cursor within {LOCK_TIMEOUT} seconds; suspected deadlock.")
-            
+
     def __exit__(self, *_):
-        self.lock.release()
+        now = time.time()
+        self.pool_conn.busy_time += now - self.acquired
+        self.pool_conn.last_used = now
+        self.pool_conn.n_commands += 1
+        self.pool_conn.lock.release()
+
+
+# What the pool knows about a db_id
+class DbIdEntry():
+    def __init__(self, pool_conn: PoolConnection) -> None:
+        self.pool_conn = pool_conn
+        self.last_seen = time.time()
+        self.cursor_ids = set()
+
+
+class Pool():
+    def __init__(self, min_connections, max_connections, db_ids_per_connection, params=db_params, name='primary') -> None:
+        self.name = name
+        self.params = params
+        self.lag = 0  # replication lag in seconds (None if unknown or not replicating); stays 0 for the primary
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.db_ids_per_connection = db_ids_per_connection
+        self.lock = Lock()
+        self.available = Condition(self.lock)  # notified when an exclusive connection frees up
+        self.connections = {}  # index -> PoolConnection
+        self.n_opening = 0  # connections being opened (counted towards the max)
+        self.next_index = 0
+        self.db_ids = {}  # db_id -> DbIdEntry
+        self.expired_db_ids = {}  # db_id -> when its exclusive lease ran out (until it's closed or reaped)
+        self.cursors = {}  # curr_id -> (cursor, cursor lock, db_id)
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+        self.waits_lock = Lock()
+        self.n_reconnects = 0
+        self.n_reaped_db_ids = 0
+
+    # Connection factory with retry mechanism
+    def fill(self, max_retries=10, retry_delay=1):
+        for attempt in range(max_retries):
+            try:
+                while len(self._shared()) < self.min_connections:
+                    self._open(exclusive=False)
+                break
+            except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+                if attempt == max_retries - 1:
+                    raise
+                time.sleep(retry_delay)
+
+    def record_wait(self, seconds):
+        with self.waits_lock:
+            self.waits.append(seconds)
+
+    # Should be done with the lock
+    def _shared(self):
+        return [x for x in self.connections.values() if not x.exclusive]
+
+    # Should be done with the lock
+    def _has_room(self):
+        return len(self.connections) + self.n_opening < self.max_connections
+
+    # Opens a connection without holding the lock (it can take a while); returns it
+    def _open(self, exclusive):
+        with self.lock:
+            index = self.next_index
+            self.next_index += 1
+            self.n_opening += 1
+        try:
+            pool_conn = PoolConnection(self, index, exclusive=exclusive)
+        finally:
+            with self.lock:
+                self.n_opening -= 1
+        with self.lock:
+            self.connections[index] = pool_conn
+        return pool_conn
+
+    def assign(self, db_id, exclusive=False):
+        if exclusive:
+            pool_conn = self._assign_exclusive(db_id)
+            self._schedule_lease_check(db_id, LOCK_TIMEOUT)
+            return pool_conn
+        return self._assign_shared(db_id)
+
+    def _schedule_lease_check(self, db_id, delay):
+        timer = Timer(delay, self._check_lease, args=[db_id])
+        timer.daemon = True
+        timer.start()
+
+    # An exclusive lease runs out once the db_id has gone LOCK_TIMEOUT without a command (and isn't in the middle of one)
+    # Its uncommitted work is rolled back, and the connection goes back to the pool
+    def _check_lease(self, db_id):
+        with self.lock:
+            entry: DbIdEntry = self.db_ids.get(db_id)
+        if entry is None:
+            return  # released
+        pool_conn = entry.pool_conn
+        idle = 0
+        if pool_conn.lock.acquire(blocking=False):
+            try:
+                idle = time.time() - max(entry.last_seen, pool_conn.last_used)
+                with self.lock:
+                    still_held = self.db_ids.get(db_id) is entry
+                if not still_held:
+                    return
+                if idle >= LOCK_TIMEOUT:
+                    print(f"Exclusive lease for db_id {db_id} ran out after {round(idle, 1)} idle seconds; rolling back", file=sys.stderr)
+                    self._rollback(pool_conn)
+                    self._forget(db_id, expired=True)
+                    return
+            finally:
+                pool_conn.lock.release()
+        self._schedule_lease_check(db_id, max(LOCK_TIMEOUT - idle, .1))
+
+    def lease_expired_message(self, db_id):
+        return f"The exclusive lease for db_id {db_id} ran out after {LOCK_TIMEOUT} idle seconds; anything it hadn't committed was rolled back."
+
+    # Undoes whatever the connection's holder didn't commit. Should be done with the connection's lock.
+    def _rollback(self, pool_conn: PoolConnection):
+        try:
+            pool_conn.conn.rollback()
+        except Exception as e:
+            # Don't hand out a session that might still have the transaction; health checks reconnect it
+            print(f"Couldn't roll back connection {pool_conn.index} ({e}); closing it", file=sys.stderr)
+            pool_conn.close()
+            pool_conn.healthy = False
+
+    def _assign_shared(self, db_id):
+        with self.lock:
+            shared = [x for x in self._shared() if x.healthy]
+            least = min(shared, key=lambda x: (len(x.db_ids), x.busy_time), default=None)
+            if least is not None and (len(least.db_ids) < self.db_ids_per_connection or not self._has_room()):
+                return self._add_db_id(db_id, least)
+            must_open = least is None
+        try:
+            pool_conn = self._open(exclusive=False)
+        except Exception:
+            if must_open:
+                raise
+            print(f"Couldn't open another connection; doubling up instead.", file=sys.stderr)
+            return self._assign_shared_existing(db_id)
+        with self.lock:
+            return self._add_db_id(db_id, pool_conn)
+
+    def _assign_shared_existing(self, db_id):
+        with self.lock:
+            least = min(self._shared(), key=lambda x: (not x.healthy, len(x.db_ids), x.busy_time))
+            return self._add_db_id(db_id, least)
+
+    def _assign_exclusive(self, db_id):
+        deadline = time.time() + LOCK_TIMEOUT
+        with self.lock:
+            while True:
+                idle = [x for x in self.connections.values() if x.exclusive and not x.db_ids and x.healthy]
+                if idle:
+                    return self._add_db_id(db_id, idle[0])
+                if self._has_room():
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.available.wait(timeout=remaining):
+                    raise Exception("No available exclusive connections within the timeout period")
+        pool_conn = self._open(exclusive=True)
+        with self.lock:
+            return self._add_db_id(db_id, pool_conn)
+
+    # Should be done with the lock
+    def _add_db_id(self, db_id, pool_conn: PoolConnection):
+        pool_conn.db_ids.add(db_id)
+        self.db_ids[db_id] = DbIdEntry(pool_conn)
+        return pool_conn
+
+    # Returns the PoolConnection for a db_id (which renews an exclusive lease).
+    # A db_id the pool doesn't know (e.g., one that was reaped as abandoned) gets a new shared connection,
+    # except one whose exclusive lease ran out: its later commands would go to a different session than its writes.
+    def get(self, db_id) -> PoolConnection:
+        with self.lock:
+            entry: DbIdEntry = self.db_ids.get(db_id)
+            if entry is not None:
+                entry.last_seen = time.time()
+                return entry.pool_conn
+            if db_id in self.expired_db_ids:
+                raise Exception(self.lease_expired_message(db_id))
+        print(f"Unknown db_id {db_id}; assigning it a connection", file=sys.stderr)
+        return self._assign_shared(db_id)
+
+    # Releases the db_id and closes any cursors it left open
+    def release(self, db_id):
+        with self.lock:
+            entry: DbIdEntry = self.db_ids.get(db_id)
+            self.expired_db_ids.pop(db_id, None)
+        if entry is None:
+            return
+        if entry.pool_conn.exclusive:
+            # The next holder shouldn't inherit an open transaction (closing a connection of its own would've rolled it back, too)
+            try:
+                with DB(entry.pool_conn):
+                    self._rollback(entry.pool_conn)
+            except Exception as e:
+                print(f"Couldn't roll back db_id {db_id} on release: {e}", file=sys.stderr)
+                entry.pool_conn.close()
+                entry.pool_conn.healthy = False
+        self._forget(db_id)
+
+    def _forget(self, db_id, expired=False):
+        with self.lock:
+            entry: DbIdEntry = self.db_ids.pop(db_id, None)
+            if entry is None:
+                return
+            entry.pool_conn.db_ids.discard(db_id)
+            cursors = [self.cursors.pop(curr_id) for curr_id in entry.cursor_ids if curr_id in self.cursors]
+            if expired:
+                self.expired_db_ids[db_id] = time.time()
+            if entry.pool_conn.exclusive:
+                self.available.notify()
+        for curr, _, _ in cursors:
+            try:
+                curr.close()
+            except:
+                pass
+
+    def add_cursor(self, db_id, curr_id, curr):
+        with self.lock:
+            self.cursors[curr_id] = (curr, Lock(), db_id)
+            entry: DbIdEntry = self.db_ids.get(db_id)
+            if entry is not None:
+                entry.cursor_ids.add(curr_id)
+
+    # Returns (cursor, cursor lock)
+    def get_cursor(self, curr_id):
+        with self.lock:
+            curr, curr_lock, _ = self.cursors[curr_id]
+            return curr, curr_lock
+
+    def remove_cursor(self, curr_id):
+        with self.lock:
+            _, _, db_id = self.cursors.pop(curr_id, (None, None, None))
+            entry: DbIdEntry = self.db_ids.get(db_id)
+            if entry is not None:
+                entry.cursor_ids.discard(curr_id)
+
+    # Pings a connection, replacing it if it's dead. Should be done with the connection's lock.
+    def check_health(self, pool_conn: PoolConnection):
+        try:
+            pool_conn.conn.ping(reconnect=True)
+            pool_conn.healthy = True
+        except Exception as e:
+            print(f"Connection {pool_conn.index} failed health check ({e}); replacing it", file=sys.stderr)
+            try:
+                pool_conn.conn = get_new_conn(self.params)
+                pool_conn.healthy = True
+                self.n_reconnects += 1
+            except Exception as e:
+                print(f"Couldn't replace connection {pool_conn.index}: {e}", file=sys.stderr)
+                pool_conn.healthy = False
+        pool_conn.last_used = time.time()
+
+    # For replicas: measures replication lag on an idle connection
+    def check_lag(self):
+        with self.lock:
+            candidates = [x for x in self.connections.values() if x.healthy]
+        lag = None
+        for pool_conn in candidates:
+            if not pool_conn.lock.acquire(blocking=False):
+                continue
+            try:
+                with pool_conn.conn.cursor() as curr:
+                    try:
+                        curr.execute("SHOW REPLICA STATUS")
+                    except pymysql.MySQLError:
+                        curr.execute("SHOW SLAVE STATUS")  # before MySQL 8.0.22
+                    row = curr.fetchone()
+                if not row:
+                    lag = 0  # not replicating from anything, so it can't be behind
+                else:
+                    lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))  # None if replication is stopped
+            except Exception as e:
+                print(f"Couldn't check replication lag on {self.name}: {e}", file=sys.stderr)
+            finally:
+                pool_conn.lock.release()
+            break
+        else:
+            if candidates:
+                return  # everything's busy; keep the last measurement
+        if (lag is None) != (self.lag is None):
+            print(f"Replica {self.name} is {'unavailable' if lag is None else 'available'} for reads", file=sys.stderr)
+        self.lag = lag
+
+    def maintain(self):
+        now = time.time()
+
+        # Abandoned db_ids
+        with self.lock:
+            abandoned = [db_id for db_id, entry in self.db_ids.items() if now - entry.last_seen > POOLER_ABANDONED_TIMEOUT]
+            for db_id in [k for k, v in self.expired_db_ids.items() if now - v > POOLER_ABANDONED_TIMEOUT]:
+                del self.expired_db_ids[db_id]
+        for db_id in abandoned:
+            self.release(db_id)
+        self.n_reaped_db_ids += len(abandoned)
+
+        # Idle connections
+        with self.lock:
+            to_close = []
+            n_shared = len(self._shared())
+            for pool_conn in list(self.connections.values()):
+                if pool_conn.db_ids or now - pool_conn.last_used < POOLER_IDLE_TIMEOUT:
+                    continue
+                if not pool_conn.exclusive:
+                    if n_shared <= self.min_connections:
+                        continue
+                    n_shared -= 1
+                del self.connections[pool_conn.index]
+                to_close.append(pool_conn)
+            to_ping = [x for x in self.connections.values() if now - x.last_used > POOLER_PING_INTERVAL or not x.healthy]
+        for pool_conn in to_close:
+            pool_conn.close()
+
+        # Health checks (skipping anything in use)
+        for pool_conn in to_ping:
+            if pool_conn.lock.acquire(blocking=False):
+                try:
+                    self.check_health(pool_conn)
+                finally:
+                    pool_conn.lock.release()
+
+        # Back up to the minimum, if connections were lost
+        try:
+            self.fill(max_retries=1)
+        except Exception as e:
+            print(f"Couldn't refill the pool: {e}", file=sys.stderr)
+
+    # Utilisation is the fraction of time since the last call that each connection was in use
+    def metrics(self, since):
+        now = time.time()
+        elapsed = max(now - since, 1e-9)
+        with self.waits_lock:
+            waits = sorted(self.waits)
+        with self.lock:
+            connections = []
+            for pool_conn in self.connections.values():
+                connections.append({
+                    'index': pool_conn.index,
+                    'exclusive': pool_conn.exclusive,
+                    'healthy': pool_conn.healthy,
+                    'db_ids': len(pool_conn.db_ids),
+                    'commands': pool_conn.n_commands,
+                    'utilisation': round(min(pool_conn.busy_time / elapsed, 1), 4)
+                })
+                pool_conn.busy_time = 0
+            n_db_ids = len(self.db_ids)
+            n_cursors = len(self.cursors)
+        return {
+            'time': now,
+            'name': self.name,
+            'lag': self.lag,
+            'connections': connections,
+            'db_ids': n_db_ids,
+            'cursors': n_cursors,
+            'wait_time': {
+                'avg': sum(waits) / len(waits) if waits else 0,
+                'p95': waits[int(len(waits) * .95)] if waits else 0,
+                'max': waits[-1] if waits else 0
+            },
+            'reconnects': self.n_reconnects,
+            'reaped_db_ids': self.n_reaped_db_ids
+        }
+
+    def close_all(self):
+        with self.lock:
+            cursors = [x[0] for x in self.cursors.values()]
+            connections = list(self.connections.values())
+        for curr in cursors:
+            try:
+                curr.close()
+            except:
+                pass
+        for pool_conn in connections:
+            pool_conn.close()
 
-    # This should be done with the lock
-    def reconnect(self):
-        CONNECTIONS[self.index] = get_new_conn()
 
-    
-# Something slightly different: since the database locks can be pre-provisioned, it can use ready-made locks.
-# Here, however, we need to create and manage locks. This class can only have one (global) object, which is locked (well-enough for python, I think).
-class CursorLocks():
-    global_lock: Lock
+POOL = Pool(POOLER_MIN_CONNECTIONS, POOLER_MAX_CONNECTIONS, POOLER_DB_IDS_PER_CONNECTION)
+REPLICA_POOLS = [
+    Pool(POOLER_REPLICA_MIN_CONNECTIONS, POOLER_REPLICA_MAX_CONNECTIONS, POOLER_DB_IDS_PER_CONNECTION, params=get_replica_params(x), name=f"replica {x['host']}:{x['port']}")
+    for x in DB_REPLICAS
+]
+
+
+# Which pool each db_id is in; anything unknown is in the primary pool.
+class Router():
     def __init__(self) -> None:
-        self.locks = {}
-        self.global_lock = Lock()
+        self.lock = Lock()
+        self.db_id_to_pool = {}
+
+    def get_pool(self, db_id) -> Pool:
+        with self.lock:
+            return self.db_id_to_pool.get(db_id, POOL)
+
+    def _read_pools(self):
+        fresh = [x for x in REPLICA_POOLS if x.lag is not None and x.lag <= POOLER_REPLICA_MAX_LAG]
+        return sorted(fresh, key=lambda x: len(x.db_ids))
+
+    def assign(self, db_id, exclusive=False, read_only=False):
+        pool = POOL
+        if read_only and not exclusive:
+            for replica in self._read_pools():
+                try:
+                    replica.assign(db_id)
+                    pool = replica
+                    break
+                except Exception as e:
+                    print(f"Couldn't assign to {replica.name} ({e}); trying elsewhere", file=sys.stderr)
+        if pool is POOL:
+            POOL.assign(db_id, exclusive=exclusive)
+        else:
+            with self.lock:
+                self.db_id_to_pool[db_id] = pool
 
-    def get_lock(self, cursor_id):
-        with self.global_lock:
-            if cursor_id not in self.locks:
-                self.locks[cursor_id] = Lock()
-            return self.locks[cursor_id]
-    def lock(self, id):
-        return self.get_lock(id)
-    
-cursor_locks = CursorLocks()
+    def release(self, db_id):
+        with self.lock:
+            pool = self.db_id_to_pool.pop(db_id, POOL)
+        pool.release(db_id)
+
+    # Forgets db_ids their pools have reaped
+    def prune(self):
+        with self.lock:
+            for db_id, pool in list(self.db_id_to_pool.items()):
+                with pool.lock:
+                    if db_id not in pool.db_ids:
+                        del self.db_id_to_pool[db_id]
+
+ROUTER = Router()
 
 
 # ----------------------------------------------------
 
 
-def command_wrapper(func):
+# Runs one command; on a connection error, reconnects and retries once
+def retry_on_disconnect(func):
     @wraps(func)
-    def wrapper(response_key, db_id, *args, **kwargs):
-        error_status = False
-        error_text = ""
-        data = None
+    def wrapper(db_id, *args, **kwargs):
         try:
-            data = func(db_id, *args, **kwargs)
+            return func(db_id, *args, **kwargs)
         except (pymysql.OperationalError, pymysql.InterfaceError) as e:
             try:
-                db_index = None
-                with ID_TO_CONN_LOCK:
-                    db_index = ID_TO_CONN_INDEX[db_id]
-                with DB(db_index) as db:
+                pool_conn = ROUTER.get_pool(db_id).get(db_id)
+                with DB(pool_conn, db_id) as db:
                     db.ping(reconnect=True)
-                data = func(db_id, *args, **kwargs) # and then retry the thing
             except Exception as e:
-                error_status = True
-                error_text = f"Error trying to reconnect: {e}"
-        except Exception as e:
-            error_status = True
-            error_text = f"Exception in db pool ({func}): {repr(e)}. DB ID was: {db_id}. Args were: {args}. Kwargs were: {kwargs}."
-        finally:
-            r.rpush(response_key, json.dumps({
-                'error_status': error_status,
-                'error_text': error_text,
-                'data': make_json_serializable(data)
-            }))  # apparently thread safe
-
+                raise Exception(f"Error trying to reconnect: {e}")
+            return func(db_id, *args, **kwargs) # and then retry the thing
     return wrapper
 
 
-def release_exclusive_connection(db_id):
-    with ID_TO_CONN_LOCK:
-        index = ID_TO_CONN_INDEX.pop(db_id, None)
-    if index is not None and is_exclusive_lock(index):
-        AVAILABLE_EXCL_CONNS.put_nowait(index)
-
-
 # Not really making a "new" connection, rather just assigning a db_id to something in the pool.
-@command_wrapper
+# 'consistent' needs nothing special: a db_id keeps the same connection for as long as it's open.
+@retry_on_disconnect
 def make_new_connection(db_id, kwargs):
-    index = random.randrange(0, N_POOL)
-    
-    if 'read_only' in kwargs:
-        # TODO
-        pass
-    if 'exclusive' in kwargs and kwargs['exclusive']:
-        try:
-            index = AVAILABLE_EXCL_CONNS.get(timeout=LOCK_TIMEOUT)
-        except Empty:
-            raise Exception("No available exclusive connections within the timeout period")
-        Timer(LOCK_TIMEOUT, release_exclusive_connection, args=[db_id]).start()
-    # A consistent new connection always gives the same connection across ProxyDB connections
-    elif 'consistent' in kwargs and kwargs['consistent']:
-        index = N_POOL - 1
-
-    # give a random connection
-    with ID_TO_CONN_LOCK:
-        ID_TO_CONN_INDEX[db_id] = index
-
+    ROUTER.assign(db_id, exclusive=bool(kwargs.get('exclusive')), read_only=bool(kwargs.get('read_only')))
     return True
 
 
-@command_wrapper
+@retry_on_disconnect
 def close_connection(db_id):
-    with ID_TO_CONN_LOCK:
-        index = ID_TO_CONN_INDEX[db_id]
-    if index is not None:
-        if is_exclusive_lock(index):
-            release_exclusive_connection(db_id)  # does the popping here
-        else:
-            with ID_TO_CONN_LOCK:
-                ID_TO_CONN_INDEX.pop(db_id)
+    ROUTER.release(db_id)
     return True
 
 
-@command_wrapper
+@retry_on_disconnect
 def make_new_cursor(db_id, curr_id):
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]  # Find the appropriate index, so we can get the lock
-    
-    with DB(db_index) as db:
+    pool = ROUTER.get_pool(db_id)
+    pool_conn = pool.get(db_id)
+    with DB(pool_conn, db_id) as db:
         curr = db.cursor()
-        with ID_TO_CURR_LOCK:
-            ID_TO_CURR[curr_id] = curr
+    pool.add_cursor(db_id, curr_id, curr)
     return True
 
 
-@command_wrapper
-def escape_string(db_id, args) -> None:
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]  # Find the appropriate index, so we can get the lock
-    
-    with DB(db_index) as db:
-        escaped = db.escape_string(*args)
-        
-    return escaped
-
-
-@command_wrapper
+@retry_on_disconnect
 def commit_db(db_id) -> None:
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]
-    with DB(db_index) as db:
+    pool_conn = ROUTER.get_pool(db_id).get(db_id)
+    with DB(pool_conn, db_id) as db:
         db.commit()
     return True
 
 
 # 'do_call' arg = this is a function, push the result of the function call to Redis.
-@command_wrapper
+@retry_on_disconnect
 def use_cursor(db_id, do_call: bool, curr_id, name, args, kwargs) -> None:
-    
-    db_index = None
-    with ID_TO_CONN_LOCK:
-        db_index = ID_TO_CONN_INDEX[db_id]  # Find the appropriate index, so we can get the lock
-    
+    pool = ROUTER.get_pool(db_id)
+    pool_conn = pool.get(db_id)
     result = None
-    with DB(db_index):  # We have the lock for the connection
-        curr_lock = cursor_locks.get_lock(curr_id)  # Find the appropriate cursor lock
+    with DB(pool_conn, db_id):  # We have the lock for the connection
+        curr, curr_lock = pool.get_cursor(curr_id)
         with curr_lock:  # We have the lock for the cursor
-            curr = None
-            with ID_TO_CURR_LOCK:
-                curr = ID_TO_CURR[curr_id]
             attr = getattr(curr, name)
             if do_call:
                 result = attr(*args, **kwargs)
             else:
                 result = attr
-            # If we're closing the cursor, also remove it from ID_TO_CURR
+            # If we're closing the cursor, also forget about it
             if name == 'close':
-                with ID_TO_CURR_LOCK:
-                    del ID_TO_CURR[curr_id]
-
-            
+                pool.remove_cursor(curr_id)
     return result
 
+# Rough size of a row in a message
+def _row_size(row):
+    size = 0
+    for val in row.values():
+        size += len(val) if isinstance(val, (str, bytes)) else 8
+    return size + 16 * len(row)
+
+
+# Fetches rows until there are max_rows of them or they add up to about max_bytes (always at least one, if there's one left)
+# Returns {'rows': [...], 'done': True if the results ran out}
+@retry_on_disconnect
+def fetch_batch(db_id, curr_id, max_rows, max_bytes):
+    pool = ROUTER.get_pool(db_id)
+    pool_conn = pool.get(db_id)
+    rows = []
+    size = 0
+    done = False
+    with DB(pool_conn, db_id):
+        curr, curr_lock = pool.get_cursor(curr_id)
+        with curr_lock:
+            while len(rows) < max_rows and size < max_bytes:
+                row = curr.fetchone()
+                if row is None:
+                    done = True
+                    break
+                rows.append(row)
+                size += _row_size(row)
+    return {'rows': rows, 'done': done}
+
 # ----------------------------------------------------
 
 def clean_up():
-    for curr in ID_TO_CURR.values():
-        try:
-            curr.close()
-        except:
-            pass
-    for conn in CONNECTIONS:
-        conn: pymysql.Connection
-        try:
-            conn.close()
-        except:
-            pass
+    for pool in [POOL, *REPLICA_POOLS]:
+        pool.close_all()
 
 atexit.register(clean_up)
 
 
 # ----------------------------------------------------
 
-    
-# Initialize MySQL Connection Pool
+
+def run_command(db_id, command):
+    command_type = command['type']
+    command_name = command.get('name', '')
+    args = command.get('args', [])
+    kwargs = command.get('kwargs', {})
+    curr_id = command.get('curr_id')
+
+    if command_type == 'new_connection':
+        return make_new_connection(db_id, kwargs)
+    elif command_type == 'close_connection':
+        return close_connection(db_id)
+    elif command_type == 'new_cursor':
+        return make_new_cursor(db_id, curr_id)
+    elif command_type == 'commit':
+        return commit_db(db_id)
+    elif command_type == 'cursor_function':
+        return use_cursor(db_id, True, curr_id, command_name, args, kwargs)
+    elif command_type == 'cursor_attribute':
+        return use_cursor(db_id, False, curr_id, command_name, args, kwargs)
+    elif command_type == 'fetch_batch':
+        return fetch_batch(db_id, curr_id, kwargs['max_rows'], kwargs['max_bytes'])
+    raise Exception(f"Unknown command type {command_type}")
+
+
+# Cleanup still runs after an earlier command in the batch fails, so that nothing is leaked
+def is_cleanup(command):
+    return command['type'] == 'close_connection' or (command['type'] == 'cursor_function' and command.get('name') == 'close')
+
+
+# Batches received but not yet started, and how long the started ones waited (for metrics)
+QUEUE_STATS_LOCK = Lock()
+QUEUE_STATS = {'pending': 0, 'queue_waits': deque(maxlen=WAIT_SAMPLES)}
+
+
+# Runs a batch of commands in order (see db.py for the protocol)
+# Replies with a list of results in the same encoding as the message, unless there's no response_key (fire and forget)
+def run_batch(message_bytes, received_at=None):
+    if received_at is not None:
+        with QUEUE_STATS_LOCK:
+            QUEUE_STATS['pending'] -= 1
+            QUEUE_STATS['queue_waits'].append(time.time() - received_at)
+
+    use_msgpack = not message_bytes.startswith(b'{')  # JSON messages are always objects
+    try:
+        batch = decode_message(message_bytes, use_msgpack)
+    except Exception as e:
+        print(f"Couldn't decode message to db pooler: {e}", file=sys.stderr)
+        return
+    db_id = batch['db_id']
+    commands = batch['commands']
+    response_key = batch.get('response_key')
+
+    error_status = False
+    error_text = ""
+    results = []
+    for i, command in enumerate(commands):
+        if error_status and not is_cleanup(command):
+            continue
+        try:
+            results.append(run_command(db_id, command))
+        except Exception as e:
+            results.append(None)
+            if error_status:
+                continue  # already reporting the first error
+            error_status = True
+            error_text = f"Exception in db pool ({command['type']} {command.get('name', '')}, command {i+1} of {len(commands)}): {repr(e)}. DB ID was: {db_id}. Args were: {command.get('args')}. Kwargs were: {command.get('kwargs')}."
+
+    if response_key:
+        r.rpush(response_key, encode_message({
+            'error_status': error_status,
+            'error_text': error_text,
+            'data': make_json_serializable(results)
+        }, use_msgpack))  # apparently thread safe
+    elif error_status:
+        print(error_text, file=sys.stderr)
+
+
+def encode_message(obj, use_msgpack):
+    if use_msgpack:
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj)
+
+
+def decode_message(message, use_msgpack):
+    if use_msgpack:
+        return msgpack.unpackb(message, raw=False)
+    return json.loads(message)
+
+
+# ----------------------------------------------------
+
+
+def publish_metrics(since):
+    metrics = POOL.metrics(since)
+    metrics['replicas'] = [x.metrics(since) for x in REPLICA_POOLS]
+    with QUEUE_STATS_LOCK:
+        queue_waits = list(QUEUE_STATS['queue_waits'])
+        metrics['pending_batches'] = QUEUE_STATS['pending']
+    metrics['queue_wait_time'] = {
+        'avg': sum(queue_waits) / len(queue_waits) if queue_waits else 0,
+        'max': max(queue_waits) if queue_waits else 0
+    }
+    metrics['queue_depth'] = r.llen('sql_queue')
+    r.set(POOLER_METRICS_KEY, json.dumps(metrics), ex=MAINTENANCE_INTERVAL * 6)
+
+
+def maintenance_loop():
+    last_published = time.time()
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        for pool in [POOL, *REPLICA_POOLS]:
+            try:
+                pool.maintain()
+                if pool is not POOL:
+                    pool.check_lag()
+            except Exception as e:
+                print(f"Exception occurred in DB pool maintenance ({pool.name}): {e}", file=sys.stderr)
+        ROUTER.prune()
+        try:
+            now = time.time()
+            publish_metrics(last_published)
+            last_published = now
+        except Exception as e:
+            print(f"Couldn't publish DB pool metrics: {e}", file=sys.stderr)
+
+
 def listen_for_commands():
     print("The db pooler is listening...")
-    MAX_THREADS = 10
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
+    with ThreadPoolExecutor(max_workers=POOLER_THREADS) as executor:
         while True:
             try:
                 _, message = r.blpop('sql_queue')  # blocking
-                command = json.loads(message)
-                command_type = command['type']
-                command_name = command['name']
-                args = command.get('args', [])
-                kwargs = command.get('kwargs', {})
-                db_id = command['db_id']
-                curr_id = command['curr_id']
-                response_key = command['response_key']
-
-                if command_type == 'new_connection':
-                    executor.submit(make_new_connection, response_key, db_id, kwargs)
-                elif command_type == 'close_connection':
-                    executor.submit(close_connection, response_key, db_id)
-                elif command_type == 'new_cursor':
-                    executor.submit(make_new_cursor, response_key, db_id, curr_id)
-                elif command_type == 'commit':
-                    executor.submit(commit_db, response_key, db_id)
-                elif command_type == 'escape_string':
-                    executor.submit(escape_string, response_key, db_id, args)
-                elif command_type == 'cursor_function':
-                    executor.submit(use_cursor, response_key, db_id, True, curr_id, command_name, args, kwargs)
-                elif command_type == 'cursor_attribute':
-                    executor.submit(use_cursor, response_key, db_id, False, curr_id, command_name, args, kwargs)
+                with QUEUE_STATS_LOCK:
+                    QUEUE_STATS['pending'] += 1
+                executor.submit(run_batch, message, time.time())
             except Exception as e:
                 print(f"Exception occurred in DB pooler main loop: {e}", file=sys.stderr)
 
-initialize_connections()
+POOL.fill()
+for replica in REPLICA_POOLS:
+    try:
+        replica.fill(max_retries=1)
+        replica.check_lag()
+    except Exception as e:
+        replica.lag = None  # not used for reads until maintenance finds it healthy
+        print(f"Couldn't connect to {replica.name}: {e}", file=sys.stderr)
+Thread(target=maintenance_loop, daemon=True).start()
 listen_for_commands()
@@ -0,0 +1,212 @@
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+import time
+import math
+import os
+import sys
+from .configs.user_config import EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_BYTES
+
+"""
+
+Content-addressed cache of embeddings, shared by every process on the machine (and so across resources and users).
+
+The same text gets embedded over and over: the same PDF uploaded by different people, re-chunking after a failed consistency check, forced re-creation, repeated queries...
+Entries are keyed by (embedding_fn_code, hash of the text as the provider would actually embed it), so that a hit is the exact same embedding that the provider would return.
+
+Backed by a local SQLite file. The total size is kept in a one-row table by triggers; once it goes over the max, least-recently-used entries are evicted.
+Any error with the cache is treated as a miss – it should never be the reason an embedding fails.
+
+"""
+
+EMBEDDING_DTYPE = np.dtype('<f4')
+EVICT_TO_FRACTION = .9  # when over the max, evict down to this fraction of it
+TOUCH_INTERVAL = 60 * 60  # seconds; a hit only updates an entry's last_used if it's older than this, to save writes
+
+
+def _normalize(txt):
+    # Matches what the providers in integrations/embed.py do before embedding
+    return txt.replace("\n", " ")
+
+
+def make_key(embedding_fn_code, txt):
+    h = hashlib.sha256()
+    h.update(embedding_fn_code.encode('utf-8'))
+    h.update(b'\0')
+    h.update(_normalize(txt).encode('utf-8'))
+    return h.digest()
+
+
+class EmbeddingCache():
+    def __init__(self, path, max_bytes) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def enabled(self):
+        return self.path and self.max_bytes > 0
+
+    # One connection per thread (and per process, in case of a fork)
+    def _get_conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                embedding BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used);
+            CREATE TABLE IF NOT EXISTS totals (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                nbytes INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO totals (id, nbytes) VALUES (0, 0);
+            CREATE TRIGGER IF NOT EXISTS embeddings_insert AFTER INSERT ON embeddings
+                BEGIN UPDATE totals SET nbytes = nbytes + NEW.nbytes WHERE id = 0; END;
+            CREATE TRIGGER IF NOT EXISTS embeddings_delete AFTER DELETE ON embeddings
+                BEGIN UPDATE totals SET nbytes = nbytes - OLD.nbytes WHERE id = 0; END;
+        """)
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    def _count(self, hits, misses, errors=0):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.errors += errors
+
+    # Returns a list the same length as texts, with an np array for each hit and None for each miss
+    def get_many(self, embedding_fn_code, texts):
+        results = [None for _ in texts]
+        if not self.enabled() or not texts:
+            return results
+        keys = [make_key(embedding_fn_code, txt) for txt in texts]
+        try:
+            conn = self._get_conn()
+            found = {}
+            unique_keys = list(set(keys))
+            max_vars = 500  # stay well under SQLite's limit on query parameters
+            for start in range(0, len(unique_keys), max_vars):
+                batch = unique_keys[start:start+max_vars]
+                placeholders = ",".join(["?"] * len(batch))
+                rows = conn.execute(f"SELECT key, embedding, last_used FROM embeddings WHERE key IN ({placeholders})", batch).fetchall()
+                for key, embedding, last_used in rows:
+                    found[key] = (embedding, last_used)
+
+            now = time.time()
+            to_touch = []
+            for i, key in enumerate(keys):
+                if key in found:
+                    embedding, last_used = found[key]
+                    results[i] = np.frombuffer(embedding, dtype=EMBEDDING_DTYPE)
+                    if last_used < now - TOUCH_INTERVAL:
+                        to_touch.append((now, key))
+            if to_touch:
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", to_touch)
+            n_hits = sum(1 for x in results if x is not None)
+            self._count(n_hits, len(texts) - n_hits)
+        except sqlite3.Error as e:
+            print(f"Embedding cache read failed: {e}", file=sys.stderr)
+            self._count(0, len(texts), errors=1)
+            return [None for _ in texts]
+        return results
+
+    # Embeddings that are missing or empty are skipped
+    def put_many(self, embedding_fn_code, texts, embeddings):
+        if not self.enabled() or not texts:
+            return
+        now = time.time()
+        rows = []
+        for txt, emb in zip(texts, embeddings):
+            if emb is None or not len(emb):
+                continue
+            data = np.asarray(emb, dtype=EMBEDDING_DTYPE).tobytes()
+            rows.append((make_key(embedding_fn_code, txt), data, len(data), now))
+        if not rows:
+            return
+        try:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Same key = same text = same embedding, so an existing entry can be left alone
+                conn.executemany("INSERT OR IGNORE INTO embeddings (key, embedding, nbytes, last_used) VALUES (?, ?, ?, ?)", rows)
+                self._evict(conn)
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            print(f"Embedding cache write failed: {e}", file=sys.stderr)
+            self._count(0, 0, errors=1)
+
+    # Should be done inside a transaction
+    def _evict(self, conn):
+        total = conn.execute("SELECT nbytes FROM totals WHERE id = 0").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * EVICT_TO_FRACTION
+        while total > target:
+            n_entries, size = conn.execute("SELECT COUNT(*), SUM(nbytes) FROM embeddings").fetchone()
+            if not n_entries:
+                break
+            avg_size = size / n_entries
+            n_to_remove = max(1, math.ceil((total - target) / avg_size))
+            conn.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (n_to_remove,))
+            total = conn.execute("SELECT nbytes FROM totals WHERE id = 0").fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors
+            }
+        if self.enabled():
+            try:
+                stats['bytes'] = self._get_conn().execute("SELECT nbytes FROM totals WHERE id = 0").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return stats
+
+
+EMBEDDING_CACHE = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_BYTES)
+
+
+# Drop-in for embed_obj.embed(texts): cached embeddings are returned as is, and only the misses go to the provider.
+# Identical texts in the same call are only embedded once.
+def cached_embed(embed_obj, texts):
+    results = EMBEDDING_CACHE.get_many(embed_obj.code, texts)
+
+    to_embed = []  # unique missing texts
+    positions = {}  # missing text -> indices in results
+    for i, (txt, emb) in enumerate(zip(texts, results)):
+        if emb is None:
+            if txt not in positions:
+                positions[txt] = []
+                to_embed.append(txt)
+            positions[txt].append(i)
+
+    if to_embed:
+        new_embeddings = embed_obj.embed(to_embed)
+        for txt, emb in zip(to_embed, new_embeddings):
+            for i in positions[txt]:
+                results[i] = emb
+
+        # Don't cache a batch where the provider clearly missed some texts (see ResourceRetriever._embed_batch)
+        lengths = set(len(emb) for emb in new_embeddings if emb is not None)
+        if len(new_embeddings) == len(to_embed) and len(lengths) == 1:
+            EMBEDDING_CACHE.put_many(embed_obj.code, to_embed, new_embeddings)
+
+    return results
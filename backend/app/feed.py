@@ -34,7 +34,7 @@ def art_history(user: User):
     ORDER BY RAND()
     LIMIT 1
     """
-    db = get_db()
+    db = get_db(read_only=True)
     curr = db.cursor()
     curr.execute(sql)
     res = curr.fetchone()
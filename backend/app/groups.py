@@ -3,7 +3,7 @@ from flask import (
     request
 )
 from flask_cors import cross_origin
-from .db import get_db, needs_db, ProxyDB
+from .db import get_db, needs_db, needs_special_db, ProxyDB, escape_string
 from .template_response import MyResponse
 from .auth import token_optional, User, get_permissioning_string, token_required
 from .configs.str_constants import PREVIEW_FILE
@@ -14,6 +14,7 @@ from .activity import get_group_activity, get_group_progress, get_aggregated_act
 from .configs.str_constants import ASSET_STATE
 from .templates.section import get_section_state
 from .asset_actions import get_sources, get_assets_in_group
+from .visibility import visibility_index_enabled, get_visibility_join, get_visibility_string, get_listing_total, refresh_asset_visibility, refresh_group_visibility
 
 
 bp = Blueprint('groups', __name__, url_prefix="/groups")
@@ -27,11 +28,12 @@ MAX_GROUPS_LIMIT = 20
 # If ids is set (and no search text), we get tags; otherwise, no (for performance reasons)
 # include_for_sale = allow products provided they are permissioned (i.e. purchased)
 # iff_for_sale = include all products (subject to search/offset/limit/ids), and only products
-@needs_db
+# Reads go to a replica when there's a fresh one (see get_db)
+@needs_special_db(read_only=True)
 def search_groups(user: User, search, offset, limit, ids=None, get_total=True, iff_for_sale=False, include_for_sale=False, include_hidden=False, db=None):
     curr = db.cursor()
 
-    search = db.escape_string(search) if search else ""
+    search = escape_string(search) if search else ""
 
     order_by_clause = "a.score DESC, a.title ASC"
 
@@ -84,10 +86,17 @@ def search_groups(user: User, search, offset, limit, ids=None, get_total=True, i
         """
 
     # Different permissioning string based on whether we're getting products for sale (i.e., the user doesn't have access to them)
-    permissioning_clause = f"""
-        LEFT JOIN asset_permissions ap ON a.id = ap.group_id
-        WHERE ({get_permissioning_string(user)})
-    """
+    use_visibility = visibility_index_enabled()
+    if use_visibility:
+        permissioning_clause = f"""
+            {get_visibility_join(user, groups=True, visibility_alias="gv")}
+            WHERE ({get_visibility_string(user, visibility_alias="gv")})
+        """
+    else:
+        permissioning_clause = f"""
+            LEFT JOIN asset_permissions ap ON a.id = ap.group_id
+            WHERE ({get_permissioning_string(user)})
+        """
     if iff_for_sale and include_for_sale:
         permissioning_clause += " AND a.product_id IS NOT NULL"
     elif iff_for_sale:
@@ -98,13 +107,18 @@ def search_groups(user: User, search, offset, limit, ids=None, get_total=True, i
     if not include_hidden:
         permissioning_clause += " AND (a.hidden IS NULL OR a.hidden != 1)"
 
-    sql = f"""
+    # With the visibility index, the total is counted separately (see get_listing_total)
+    use_calc = get_total and not use_visibility
+    body_sql = f"""
         WITH a as (
             {search_clause}
         )
-        SELECT SQL_CALC_FOUND_ROWS DISTINCT a.*
+        SELECT {"SQL_CALC_FOUND_ROWS" if use_calc else ""} DISTINCT a.*
         FROM a
         {permissioning_clause}
+        """
+    sql = f"""
+        {body_sql}
         ORDER BY {order_by_clause}
         LIMIT {limit}
         OFFSET {offset}
@@ -114,7 +128,9 @@ def search_groups(user: User, search, offset, limit, ids=None, get_total=True, i
     results = curr.fetchall()
 
     total = 0
-    if get_total:
+    if get_total and use_visibility:
+        total = get_listing_total(body_sql, db)
+    elif get_total:
         curr.execute("SELECT FOUND_ROWS()")
         total = curr.fetchone()['FOUND_ROWS()']
 
@@ -176,6 +192,9 @@ def add_group_permission_by_product_id(user: User, product_id, db: ProxyDB=None)
     curr = db.cursor()
     curr.execute(sql, (user.email, product_id))
 
+    curr.execute("SELECT `id` FROM asset_groups WHERE `product_id` = %s", (product_id,))
+    refresh_group_visibility([x['id'] for x in curr.fetchall()], db=db, no_commit=True)
+
 
 
 @bp.route("/manifest", methods=['GET'])
@@ -201,7 +220,7 @@ def manifest(user: User):
     else:
         get_total = True
 
-    results, total = search_groups(user, search, offset, limit, get_total=get_total, exclusive_conn=get_total)
+    results, total = search_groups(user, search, offset, limit, get_total=get_total, exclusive_conn=(get_total and not visibility_index_enabled()))
     resp = {'results': results}
     if get_total:
         resp['total'] = total
@@ -236,7 +255,7 @@ def get_promoted_(user: User):
     SELECT * FROM asset_groups
     WHERE `promoted`=1
     """
-    db = get_db()
+    db = get_db(read_only=True)
     curr = db.cursor()
     curr.execute(sql)
     res = curr.fetchall()
@@ -568,4 +587,5 @@ def test_study_1_refresh(user: User, group):
         """
         curr.execute(sql, (None,))
 
+    refresh_asset_visibility(to_add | to_remove, db=db, no_commit=True)
     db.commit()
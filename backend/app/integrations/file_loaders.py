@@ -11,6 +11,13 @@ from unstructured.partition.pptx import partition_pptx
 from unstructured.partition.tsv import partition_tsv
 import fitz
 import json
+import os
+import sys
+import tempfile
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
 
 # These integrations are DIFFERENT in pattern from the others.
 # Each integration handles a different kind of file, rather than a different vendor
@@ -26,86 +33,149 @@ class RawChunk():
 
 """
 
-Takes string and returns list of strings
+Takes string (or a stream of strings) and returns chunks of it
 
 The algorithm:
 - Split on the first separator
 - Combine chunks in order if possible (i.e., resulting chunk isn't too big)
 - Any chunks that are too big get the recursive split called on them again
+- With chunk_overlap, each new chunk starts with as many whole splits from the end of the last one as fit in chunk_overlap
+
+Lengths are kept as running totals while combining (so length_function should add up over concatenation, like len does), and chunks are joined once at the end, which keeps it linear in the size of the text.
 
 Why a class instead of a function? Mostly just to match langchain behavior, or to specify args just once before passing same parametrized text splitter elsewhere, like in a retriever.
 
 """
+
+DEFAULT_SEPARATORS = [  # the point of the weird character codes is to support multiple languages. Recommended here: https://python.langchain.com/v0.1/docs/modules/data_connection/document_transformers/recursive_text_splitter/
+    "\n\n",
+    "\n",
+    "\t",
+    " ",
+    ".",
+    ",",
+    "\u200b",  # Zero-width space
+    "\uff0c",  # Fullwidth comma
+    "\u3001",  # Ideographic comma
+    "\uff0e",  # Fullwidth full stop
+    "\u3002",  # Ideographic full stop
+]
+
+STREAM_BLOCK_SIZE = 1 << 16  # characters read at a time by loaders that stream their text into the splitter
+STREAM_MAX_PENDING = 1 << 20  # characters of a stream held without seeing the first separator before cutting on a later one
+
+
 class TextSplitter():
     def __init__(self, max_chunk_size, length_function=len, chunk_overlap=0):
         self.max_chunk_size = max_chunk_size
         self.length_function=length_function
-        self.chunk_overlap = 0  # NOTE: doesn't yet support anything > 0 (in here for legacy langchain reasons)
+        if chunk_overlap >= max_chunk_size:
+            raise ValueError(f"Chunk overlap ({chunk_overlap}) must be smaller than the max chunk size ({max_chunk_size})")
+        self.chunk_overlap = chunk_overlap
 
     def split_text(self, txt, separators=None):
+        return list(self.split_stream([txt], separators=separators))
 
-        DEFAULT_SEPARATORS = [  # the point of the weird character codes is to support multiple languages. Recommended here: https://python.langchain.com/v0.1/docs/modules/data_connection/document_transformers/recursive_text_splitter/
-            "\n\n",
-            "\n",
-            "\t",
-            " ",
-            ".",
-            ",",
-            "\u200b",  # Zero-width space
-            "\uff0c",  # Fullwidth comma
-            "\u3001",  # Ideographic comma
-            "\uff0e",  # Fullwidth full stop
-            "\u3002",  # Ideographic full stop
-        ]
+    # Takes an iterable of strings (pieces of one text, e.g. blocks of a file) and yields chunks as it goes.
+    # Only about STREAM_MAX_PENDING characters of the text are held at once.
+    def split_stream(self, blocks, separators=None):
         separators = separators if separators else DEFAULT_SEPARATORS
+        blocks = iter(blocks)
+
+        # Texts that fit in one chunk are returned as is
+        buf = ""
+        for block in blocks:
+            buf += block
+            if self.length_function(buf) > self.max_chunk_size:
+                break
+        else:
+            if buf:
+                yield buf
+            return
+
+        sep = separators[0]
+
+        # Text between occurrences of sep, as the stream comes in
+        def get_splits(buf):
+            max_pending = max(STREAM_MAX_PENDING, 4 * self.max_chunk_size)
+            while True:
+                splits = buf.split(sep)
+                buf = splits.pop()  # might continue in the next block
+                yield from splits
+                # If sep doesn't show up for a long time, cut on the last of the next best separator.
+                # That piece would've been too big anyway, so it was going to be split on those.
+                if len(buf) > max_pending:
+                    for next_sep in separators[1:]:
+                        i = buf.rfind(next_sep)
+                        if i > 0:
+                            yield buf[:i]
+                            buf = buf[i+len(next_sep):]
+                            break
+                    else:
+                        yield buf
+                        buf = ""
+                block = next(blocks, None)
+                if block is None:
+                    break
+                buf += block
+            yield buf
+
+        yield from self._merge(get_splits(buf), sep, separators[1:])
+
+    # Takes splits (text between occurrences of sep) and combines them in order into chunks; ones that are too big on their own are split on the rest of the separators.
+    def _merge(self, splits, sep, seps):
+        sep_len = self.length_function(sep)
+        current = deque()  # (split, length) in the chunk being made
+        current_len = 0  # including separators
 
-        def recursive_split(text, seps):
-            max_chunks = []  # Holds chunks of their maximum size - not necessarily under max_chunk_size yet, though they'll never get bigger.
-
-            sep = ""
-            if not len(seps):
-                # Means that some chunk is too big even after exhausting separators
-                # Now just need to go in and dice it up without regard to separators
-                splitsville = [text[:self.max_chunk_size], text[self.max_chunk_size:]]
-            else:
-                sep = seps[0]
-                # Split on separator 
-                splitsville = text.split(sep)
-
-            # Max-combine chunks in order
-            for split in splitsville:
-                if not split:  # blanks are not allowed
-                    continue
-                if not len(max_chunks):  # first split creates new chunk 
-                    max_chunks.append(split)
-                elif self.length_function(max_chunks[len(max_chunks) - 1] + sep + split) < self.max_chunk_size:  # if we can add the current split to the previous without overflow, do it
-                    max_chunks[len(max_chunks) - 1] += sep + split
-                else:  # Otherwise, create a new chunk
-                    max_chunks.append(split)
-
-            # On any max_chunks that are not under max_chunk_size, split it again.
-            final_chunks = []
-            for max_chunk in max_chunks:
-                if self.length_function(max_chunk) > self.max_chunk_size:
-                    new_chunks = recursive_split(max_chunk, seps[1:])
-                    final_chunks.extend(new_chunks)
-                else:
-                    final_chunks.append(max_chunk)
-            
-            return final_chunks
-        
-        if self.length_function(txt) <= self.max_chunk_size:
-            if not txt:
-                return []
-            return [txt]
-        
-        return recursive_split(txt, separators)
+        for split in splits:
+            if not split:  # blanks are not allowed
+                continue
+            split_len = self.length_function(split)
+
+            if split_len > self.max_chunk_size:
+                if current:
+                    yield sep.join(x for x, _ in current)
+                current.clear()
+                current_len = 0
+                yield from self._split_further(split, seps)
+                continue
+
+            if current and current_len + sep_len + split_len >= self.max_chunk_size:  # the current chunk can't take this split
+                yield sep.join(x for x, _ in current)
+                # Keep the end of the chunk for overlap, as long as there's room for this split
+                while current and (current_len > self.chunk_overlap or current_len + sep_len + split_len >= self.max_chunk_size):
+                    _, dropped_len = current.popleft()
+                    current_len -= dropped_len + (sep_len if current else 0)
+
+            if current:
+                current_len += sep_len
+            current.append((split, split_len))
+            current_len += split_len
+
+        if current:
+            yield sep.join(x for x, _ in current)
+
+    def _split_further(self, txt, seps):
+        if not len(seps):
+            # Means that some chunk is too big even after exhausting separators
+            # Now just need to go in and dice it up without regard to separators
+            yield from self._merge((txt[i:i+self.max_chunk_size] for i in range(0, len(txt), self.max_chunk_size)), "", [])
+        else:
+            yield from self._merge(txt.split(seps[0]), seps[0], seps[1:])
 
 
 class FileLoader():
     def __init__(self, fname):
         self.fname = fname
 
+    # For loaders of plain text, so that the whole file doesn't need to be read into memory before splitting
+    def _stream_split(self, text_splitter: TextSplitter, separators=None):
+        with open(self.fname, 'r') as fhand:
+            blocks = iter(lambda: fhand.read(STREAM_BLOCK_SIZE), '')
+            for split in text_splitter.split_stream(blocks, separators=separators):
+                yield RawChunk(split, {})
+
     # Returns iterable of RawChunks
     def load_and_split(self, text_splitter: TextSplitter):
         raise NotImplementedError("Function load_and_split not implemented for some file loader.")
@@ -174,19 +244,101 @@ class TsvLoader(UnstructuredLoader):
 # Not using unstructured for CSV because it has a littany of bugs.
 class CsvLoader(UnstructuredLoader):
     def load_and_split(self, text_splitter: TextSplitter):
-        with open(self.fname, 'r') as file:
-            original_contents = file.read()
-        splitsville = text_splitter.split_text(original_contents)
-        for split in splitsville:
-            yield RawChunk(split, {})
+        return self._stream_split(text_splitter)
+
+
+PDF_PARALLEL_MIN_PAGES = 32  # PDFs with at least this many pages have their text extracted across processes
+PDF_PAGES_PER_TASK = 16
+PDF_EXTRACT_PROCESSES = min(8, os.cpu_count() or 1)
+PDF_OCR_MIN_CHARS = 300  # pages with images and fewer alphanumeric characters than this are probably scanned
+PDF_OCR_DPI = 200  # for rendering pages to send to OCR
+PDF_OCR_MAX_PARALLEL_PAGES = 8
+
+PDF_POOL = None
+PDF_POOL_LOCK = Lock()
+
+def get_pdf_pool():
+    global PDF_POOL
+    with PDF_POOL_LOCK:
+        if PDF_POOL is None:
+            # Spawned rather than forked: the process asking is likely full of threads (and maybe gevent)
+            PDF_POOL = ProcessPoolExecutor(max_workers=PDF_EXTRACT_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return PDF_POOL
+
+
+def page_needs_ocr(page, text):
+    if text.count('\ufffd') > len(text) // 10:  # garbled; the font has no usable text mapping
+        return True
+    return sum(c.isalnum() for c in text) < PDF_OCR_MIN_CHARS and len(page.get_images()) > 0
+
+
+# Runs in the PDF pool (or not). Returns a (text, path of a rendered image or None) for each page in [start, end).
+# Pages are only rendered if render_dir is given and they look like they need OCR.
+def extract_pdf_pages(fname, start, end, render_dir=None):
+    doc = fitz.open(fname)
+    try:
+        pages = []
+        for i in range(start, end):
+            page = doc[i]
+            text = page.get_text()  # In the future, we should get images as well.
+            image_path = None
+            if render_dir and page_needs_ocr(page, text):
+                image_path = os.path.join(render_dir, f"page_{i}.png")
+                page.get_pixmap(dpi=PDF_OCR_DPI).save(image_path)
+            pages.append((text, image_path))
+        return pages
+    finally:
+        doc.close()
 
 
 # Divides by page, and then splits within each page.
+# If given an OCR provider that takes images, pages that look scanned are sent to it individually (and in parallel) instead of the whole document being OCR'd after the fact.
 class PdfLoader(FileLoader):
-    def load_and_split(self, text_splitter: TextSplitter):
+    def __init__(self, fname, ocr=None):
+        super().__init__(fname)
+        self.ocr = ocr if ocr and 'png' in ocr.accept_formats else None
+
+    def _extract_pages(self, render_dir):
         doc = fitz.open(self.fname)
-        for i, page in enumerate(doc): # iterate the document pages
-            text = page.get_text()  # In the future, we should get images as well.
+        n_pages = len(doc)
+        doc.close()
+
+        ranges = [(start, min(start + PDF_PAGES_PER_TASK, n_pages)) for start in range(0, n_pages, PDF_PAGES_PER_TASK)]
+        if n_pages >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACT_PROCESSES > 1:
+            try:
+                pool = get_pdf_pool()
+                futures = [pool.submit(extract_pdf_pages, self.fname, start, end, render_dir) for start, end in ranges]
+                return [page for fut in futures for page in fut.result()]
+            except Exception as e:
+                # e.g., we're in a daemonic process (like a Celery worker) that can't have children
+                print(f"Couldn't extract PDF pages in parallel ({e}); extracting in this process.", file=sys.stderr)
+        return extract_pdf_pages(self.fname, 0, n_pages, render_dir)
+
+    # Returns the page's text from OCR, or None if OCR failed
+    def _ocr_page(self, image_path):
+        try:
+            out_path = self.ocr.do_ocr('png', image_path)
+            with open(out_path, 'r') as fhand:
+                text = fhand.read()
+            os.remove(out_path)
+            return text
+        except Exception as e:
+            print(f"Couldn't OCR page image {image_path}: {e}", file=sys.stderr)
+            return None
+
+    def load_and_split(self, text_splitter: TextSplitter):
+        with tempfile.TemporaryDirectory() as render_dir:
+            pages = self._extract_pages(render_dir if self.ocr else None)
+            to_ocr = [i for i, (_, image_path) in enumerate(pages) if image_path]
+            ocr_texts = {}
+            if to_ocr:
+                with ThreadPoolExecutor(max_workers=PDF_OCR_MAX_PARALLEL_PAGES) as executor:
+                    for i, text in zip(to_ocr, executor.map(self._ocr_page, [pages[i][1] for i in to_ocr])):
+                        if text is not None:
+                            ocr_texts[i] = text
+
+        for i, (text, _) in enumerate(pages):
+            text = ocr_texts.get(i, text)
             split_text = text_splitter.split_text(text)
             for split in split_text:
                 yield RawChunk(split, {'page': i})
@@ -207,48 +359,30 @@ class AbbeyJsonLoader(UnstructuredLoader):
 
 class JsonLoader(FileLoader):
     def load_and_split(self, text_splitter: TextSplitter):
-        with open(self.fname, 'r') as file:
-            original_contents = file.read()
-        splitsville = text_splitter.split_text(original_contents)
-        for split in splitsville:
-            yield RawChunk(split, {})
+        return self._stream_split(text_splitter)
 
 
 CODE_SUPPORTS = ['java', 'py', 'cpp', 'c', 'cs', 'js', 'ts', 'rs', 'swift', 'kt', 'm', 'scala', 'lua', 'sh', 'pl', 'sql', 'r']
 class CodeLoader(FileLoader):
     def load_and_split(self, text_splitter: TextSplitter):
-        all_code = ""
-        with open(self.fname, 'r') as fhand:
-            all_code = fhand.read()
         # TODO: use special text splitter for code.
-        splits = text_splitter.split_text(all_code)
-        for split in splits:
-            yield RawChunk(page_content=split, metadata={})
+        return self._stream_split(text_splitter)
 
 
 class TextLoader(FileLoader):
     def load_and_split(self, text_splitter):
-        content = ""
-        with open(self.fname, 'r') as file:
-            content = file.read()
-        splitsville = text_splitter.split_text(content)
-        for split in splitsville:
-            yield RawChunk(split, {})
+        return self._stream_split(text_splitter)
 
 
 class MarkdownLoader(FileLoader):
     def load_and_split(self, text_splitter):
-        content = ""
-        with open(self.fname, 'r') as file:
-            content = file.read()
-        splitsville = text_splitter.split_text(content, separators=['\n\n', '#', '##', '###', '\n', '.', ','])
-        for split in splitsville:
-            yield RawChunk(split, {})
+        return self._stream_split(text_splitter, separators=['\n\n', '#', '##', '###', '\n', '.', ','])
 
 
 # NOTE: banned filetypes are stored again on the frontend, so changes here should be reflected there as well!
 DISALLOWED_DOC_EXTENTIONS = ['pages', 'rtf', 'epub', 'key', 'mp4', 'mov', 'mpeg', 'flv', 'ico']
-def get_loader(filetype, path):
+# ocr (an OCR provider; see ocr.py) is optional, and only used by loaders that can OCR parts of a file themselves
+def get_loader(filetype, path, ocr=None):
     if filetype == 'docx':
         return DocxLoader(path)
     if filetype == 'doc':
@@ -260,7 +394,7 @@ def get_loader(filetype, path):
     elif filetype == 'json':
         return JsonLoader(path)
     elif filetype == 'pdf':
-        return PdfLoader(path)
+        return PdfLoader(path, ocr=ocr)
     elif filetype == 'abbeyjson':
         return AbbeyJsonLoader(path)
     elif filetype == 'txt':
@@ -29,7 +29,8 @@ class LM():
     context_length: int  # in tokens
     accepts_images: bool  # can run and stream use images?
     supports_json: bool  # Does inference give a guarantee of correct JSON if requested?
-    def __init__(self, model, code, name, desc, traits, context_length, accepts_images=False, supports_json=False) -> None:
+    tokens_per_minute: int  # Optional rate limit the batch scheduler stays under (see lm_scheduler.py); None = no limit
+    def __init__(self, model, code, name, desc, traits, context_length, accepts_images=False, supports_json=False, tokens_per_minute=None) -> None:
         self.model = model
         self.code = code
         self.name = name
@@ -38,6 +39,7 @@ class LM():
         self.context_length = context_length
         self.accepts_images=accepts_images
         self.supports_json = supports_json
+        self.tokens_per_minute = tokens_per_minute
 
     # Note that images is a list of base64 strings like data:image/png;base64,BLAHBLAHBLAH...
     def run(self, txt, system_prompt=None, context=[], make_json=False, temperature=None, images=[]):
@@ -464,6 +466,7 @@ lms:
       accepts_images: true  # optional
       desc: "One of the best models ever!"  # optional
       code: "gpt-4o"  # optional
+      tokens_per_minute: 30000  # optional - bulk calls (like applying a prompt to every chunk) stay under this
       disabled: false  # optional
 
 """
@@ -493,6 +496,7 @@ def generate_lms():
             context_length=context_length,
             supports_json=supports_json,
             accepts_images=accepts_images,
+            tokens_per_minute=lm.get('tokens_per_minute'),
             **({'args': lm['args']} if 'args' in lm else {})
         )
         to_return[code] = obj
@@ -1,6 +1,9 @@
 from .db import get_db, needs_special_db
+from .configs.user_config import JOB_WRITER_MAX_ROWS, JOB_WRITER_MAX_BYTES, JOB_WRITER_FLUSH_INTERVAL
+from threading import Lock
 import json
 import sys
+import time
 
 
 @needs_special_db(consistent_conn=True)
@@ -119,6 +122,94 @@ def store_in_job(job_id, name=None, text_data=None, metadata={}, db=None):
     curr.execute(sql, (job_id, name, text_data, json.dumps(metadata)))
     return curr.lastrowid
 
+# Items are dicts with (optionally) name, text_data, and metadata, like the arguments to store_in_job
+# Inserted with multi-row INSERTs of at most JOB_WRITER_MAX_ROWS rows / about JOB_WRITER_MAX_BYTES each
+@needs_special_db(consistent_conn=True)
+def store_many_in_job(job_id, items, db=None):
+    curr = db.cursor()
+
+    def insert(rows):
+        sql = f"""
+            INSERT INTO jobs_storage (`job_id`, `name`, `text_data`, `metadata`)
+            VALUES {", ".join(["(%s, %s, %s, %s)"] * len(rows))}
+        """
+        curr.execute(sql, [x for row in rows for x in row])
+
+    rows = []
+    nbytes = 0
+    for item in items:
+        row = (job_id, item.get('name'), item.get('text_data'), json.dumps(item.get('metadata', {})))
+        row_bytes = len(row[2] or "") + len(row[3])
+        if rows and (len(rows) >= JOB_WRITER_MAX_ROWS or nbytes + row_bytes > JOB_WRITER_MAX_BYTES):
+            insert(rows)
+            rows = []
+            nbytes = 0
+        rows.append(row)
+        nbytes += row_bytes
+    if rows:
+        insert(rows)
+
+
+# Buffers results and progress for a job, writing them in batches (see store_many_in_job) instead of a query per result.
+# Results are written once JOB_WRITER_MAX_ROWS are waiting or JOB_WRITER_FLUSH_INTERVAL seconds have passed; progress is written at most once per interval.
+# Use it as a context manager, or call flush() yourself, so that nothing's left behind when the job finishes or fails.
+# If db is None, each flush uses a new connection.
+class JobWriter():
+    def __init__(self, job_id, db=None, max_rows=None, interval=None) -> None:
+        self.job_id = job_id
+        self.db = db
+        self.max_rows = max_rows or JOB_WRITER_MAX_ROWS
+        self.interval = JOB_WRITER_FLUSH_INTERVAL if interval is None else interval
+        self.lock = Lock()
+        self.items = []
+        self.last_flush = time.time()
+        self.progress = None  # latest progress not yet written
+        self.last_progress = 0
+
+    def _db_kwargs(self):
+        return {'db': self.db} if self.db else {'new_conn': True}
+
+    def store(self, name=None, text_data=None, metadata={}):
+        with self.lock:
+            self.items.append({'name': name, 'text_data': text_data, 'metadata': metadata})
+            due = len(self.items) >= self.max_rows or time.time() - self.last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def update_progress(self, progress):
+        with self.lock:
+            self.progress = progress
+            due = time.time() - self.last_progress >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            items = self.items
+            self.items = []
+            progress = self.progress
+            self.progress = None
+            self.last_flush = time.time()
+            if progress is not None:
+                self.last_progress = self.last_flush
+        if items:
+            store_many_in_job(self.job_id, items, **self._db_kwargs())
+        if progress is not None:
+            update_job_progress(self.job_id, progress, **self._db_kwargs())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.flush()
+        except Exception as e:
+            if exc_type is None:
+                raise
+            print(f"Couldn't flush results for job {self.job_id} after an error: {e}", file=sys.stderr)
+        return False
+
+
 @needs_special_db(consistent_conn=True)
 def clear_job_storage(job_id, name="%", db=None):
     
@@ -174,15 +265,14 @@ def get_job_storage(job_id, name="%", order_by=[], db=None):
     """
     curr.execute(sql, (job_id, name, job_id, name))
 
-    first_res = curr.fetchone()
+    # Rows come over from the pooler in batches
+    rows = curr.stream()
+    first_res = next(rows, None)
     
     def row_gen():
         if first_res:
             yield first_res
-            while True:
-                res = curr.fetchone()
-                if not res:
-                    break
+            for res in rows:
                 yield res
 
     total = first_res['_count'] if first_res else 0
@@ -191,7 +281,8 @@ def get_job_storage(job_id, name="%", order_by=[], db=None):
 
 
 # order by uses same rules as above function
-@needs_special_db(consistent_conn=True)
+# Read only: job progress can be a moment behind; anything that needs it exact should pass its own db
+@needs_special_db(consistent_conn=True, read_only=True)
 def search_for_jobs(kind="%", title="%", asset_id=None, order_by=[], is_running=None, job_id=None, limit=100, offset=0, db=None):
     order_by_str = _get_order_by_str(order_by)
     sql = f"""
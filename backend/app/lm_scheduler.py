@@ -0,0 +1,196 @@
+import heapq
+import itertools
+import math
+import sys
+import time
+from collections import deque
+from threading import Lock, Condition
+from .integrations.lm import LM
+from .utils import get_token_estimate
+from .configs.user_config import (
+    LM_SCHEDULER_INITIAL_CONCURRENCY, LM_SCHEDULER_MAX_CONCURRENCY, LM_SCHEDULER_INTERACTIVE_RESERVE, LM_SCHEDULER_MAX_RETRIES
+)
+
+"""
+
+Process-wide scheduler for LM calls made in bulk (see batch_and_stream_lm.py).
+
+Every model (by LM code) gets one scheduler, shared by everything in the process that calls it, which decides how many calls are in flight at once:
+- Concurrency adapts AIMD-style: each success adds about one slot per window of calls; a rate limit error (429) halves it and pauses new calls for a bit,
+  and latency climbing well above its best recent level cuts it by a smaller factor.
+- If the model has a tokens_per_minute budget (in settings), calls wait until the last minute's tokens leave room for them.
+- Waiting calls go in priority order, and background work can't take the last few slots (LM_SCHEDULER_INTERACTIVE_RESERVE),
+  so a user waiting on a response doesn't queue behind a long job.
+
+"""
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+DECREASE_ON_RATE_LIMIT = .5
+DECREASE_ON_LATENCY = .8
+LATENCY_TOLERANCE = 3  # latency (smoothed) this many times its baseline counts as congestion
+LATENCY_SMOOTHING = .2  # weight of the newest sample in the smoothed latency
+DECREASE_COOLDOWN = 5  # seconds; at most one latency-based decrease per this interval
+MAX_PAUSE = 60  # seconds
+TOKEN_WINDOW = 60  # seconds
+
+
+def is_rate_limit_error(e):
+    status = getattr(e, 'status_code', None) or getattr(getattr(e, 'response', None), 'status_code', None)
+    if status == 429:
+        return True
+    return 'ratelimit' in type(e).__name__.lower() or 'rate limit' in str(e).lower()
+
+
+# Seconds the provider asked us to wait, if it said
+def _retry_after(e):
+    try:
+        return float(e.response.headers['retry-after'])
+    except Exception:
+        return None
+
+
+class LMScheduler():
+    def __init__(self, code, tokens_per_minute=None) -> None:
+        self.code = code
+        self.tokens_per_minute = tokens_per_minute
+        self.cond = Condition(Lock())
+        self.limit = float(LM_SCHEDULER_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.waiting = []  # heap of (priority, sequence number)
+        self.seq = itertools.count()
+        self.paused_until = 0
+        self.consecutive_rate_limits = 0
+        self.last_decrease = 0
+        self.latency = None  # smoothed
+        self.baseline_latency = None
+        self.token_log = deque()  # (time, tokens)
+        self.window_tokens = 0
+        self.n_calls = 0
+        self.n_rate_limited = 0
+
+    # Should be done with the lock
+    def _slots(self, priority):
+        slots = math.floor(self.limit)
+        if priority != INTERACTIVE:
+            slots -= math.ceil(slots * LM_SCHEDULER_INTERACTIVE_RESERVE)
+        return max(1, slots)
+
+    # Should be done with the lock
+    def _expire_tokens(self, now):
+        while self.token_log and self.token_log[0][0] < now - TOKEN_WINDOW:
+            _, tokens = self.token_log.popleft()
+            self.window_tokens -= tokens
+
+    # Should be done with the lock. Returns 0 if the call can start now, otherwise about how long to wait.
+    def _wait_time(self, entry, tokens):
+        now = time.time()
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.waiting[0] != entry or self.in_flight >= self._slots(entry[0]):
+            return 1  # woken up by notify anyway
+        if self.tokens_per_minute:
+            self._expire_tokens(now)
+            # A call bigger than the whole budget still gets to go once the window's empty
+            if self.window_tokens and self.window_tokens + tokens > self.tokens_per_minute:
+                return max(self.token_log[0][0] + TOKEN_WINDOW - now, .01)
+        return 0
+
+    def acquire(self, priority=BACKGROUND, tokens=0):
+        with self.cond:
+            entry = (priority, next(self.seq))
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    wait = self._wait_time(entry, tokens)
+                    if not wait:
+                        break
+                    self.cond.wait(timeout=wait)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()  # the new head might be able to go
+            self.in_flight += 1
+            if tokens:
+                self._add_tokens(tokens)
+
+    # Should be done with the lock
+    def _add_tokens(self, tokens):
+        self.token_log.append((time.time(), tokens))
+        self.window_tokens += tokens
+
+    # Should be done with the lock
+    def _decrease(self, factor):
+        self.limit = max(1, self.limit * factor)
+        self.last_decrease = time.time()
+
+    def release(self, latency=None, rate_limited=False, retry_after=None, output_tokens=0):
+        with self.cond:
+            self.in_flight -= 1
+            self.n_calls += 1
+            if output_tokens and self.tokens_per_minute:
+                self._add_tokens(output_tokens)
+            if rate_limited:
+                self.n_rate_limited += 1
+                self.consecutive_rate_limits += 1
+                self._decrease(DECREASE_ON_RATE_LIMIT)
+                pause = retry_after if retry_after else min(MAX_PAUSE, .25 * 2 ** self.consecutive_rate_limits)
+                self.paused_until = max(self.paused_until, time.time() + pause)
+            elif latency is not None:
+                self.consecutive_rate_limits = 0
+                self.latency = latency if self.latency is None else (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+                # The baseline follows the best (smoothed) latency seen, drifting up slowly so that it can recover from a lucky stretch
+                self.baseline_latency = self.latency if self.baseline_latency is None else min(self.baseline_latency * 1.01, self.latency)
+                congested = self.latency > LATENCY_TOLERANCE * self.baseline_latency
+                if congested and time.time() - self.last_decrease > DECREASE_COOLDOWN:
+                    self._decrease(DECREASE_ON_LATENCY)
+                elif not congested:
+                    self.limit = min(LM_SCHEDULER_MAX_CONCURRENCY, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    # Calls fn() once there's room for it, retrying on rate limit errors
+    def run(self, fn, priority=BACKGROUND, prompt_txt=""):
+        tokens = get_token_estimate(prompt_txt) if self.tokens_per_minute and prompt_txt else 0
+        for attempt in range(LM_SCHEDULER_MAX_RETRIES + 1):
+            self.acquire(priority=priority, tokens=tokens)
+            start = time.time()
+            try:
+                result = fn()
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    self.release(rate_limited=True, retry_after=_retry_after(e))
+                    if attempt < LM_SCHEDULER_MAX_RETRIES:
+                        print(f"Rate limited by {self.code}; concurrency is now {self.limit:.1f}", file=sys.stderr)
+                        continue
+                else:
+                    self.release()
+                raise
+            output_tokens = get_token_estimate(result) if self.tokens_per_minute and isinstance(result, str) else 0
+            self.release(latency=time.time() - start, output_tokens=output_tokens)
+            return result
+
+    def stats(self):
+        with self.cond:
+            return {
+                'code': self.code,
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'waiting': len(self.waiting),
+                'latency': self.latency,
+                'baseline_latency': self.baseline_latency,
+                'window_tokens': self.window_tokens,
+                'tokens_per_minute': self.tokens_per_minute,
+                'calls': self.n_calls,
+                'rate_limited': self.n_rate_limited
+            }
+
+
+SCHEDULERS_LOCK = Lock()
+SCHEDULERS = {}  # LM code -> LMScheduler
+
+def get_scheduler(lm: LM) -> LMScheduler:
+    with SCHEDULERS_LOCK:
+        if lm.code not in SCHEDULERS:
+            SCHEDULERS[lm.code] = LMScheduler(lm.code, tokens_per_minute=lm.tokens_per_minute)
+        return SCHEDULERS[lm.code]
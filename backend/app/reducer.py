@@ -10,7 +10,7 @@ from .integrations.lm import LM_PROVIDERS, FAST_CHAT_MODEL
 from .storage_interface import upload_asset_file
 from .configs.str_constants import *
 import os
-from .jobs import clear_job_storage, complete_job, get_job, get_job_storage, start_job, job_error_wrapper, update_job_progress, store_in_job
+from .jobs import clear_job_storage, complete_job, get_job, get_job_storage, start_job, job_error_wrapper, JobWriter
 
 
 # res source - where in the db entry can I find it? Within metadata or at the root?
@@ -134,6 +134,7 @@ class Reducer():
 
             progress = 1
             round_count = 0
+            writer = JobWriter(job_id)  # new connection per flush, like store_in_job before it
             while True:
                 
                 def get_lm_part(tup):
@@ -149,7 +150,7 @@ class Reducer():
                     metadata = {
                         'saw': get_lm_part(data)
                     }
-                    store_in_job(job_id, name=str(round_count), text_data=result, metadata=metadata)
+                    writer.store(name=str(round_count), text_data=result, metadata=metadata)
 
                 def get_data():
                     if round_count == 0:
@@ -183,11 +184,13 @@ class Reducer():
                 
                 this_round_count = 0
 
-                for _ in stream_progress_batched_lm(get_data(), get_lm_part=get_lm_part, streamingCallback=stream_cb, lm=LM_PROVIDERS[FAST_CHAT_MODEL]):
-                    this_round_count += 1
-                    new_val = round(progress/total, 2)
-                    update_job_progress(job_id, new_val, db=db)
-                    progress += 1
+                # Each round reads the last one's results from job storage, so they all need to be written by the end of it
+                with writer:
+                    for _ in stream_progress_batched_lm(get_data(), get_lm_part=get_lm_part, streamingCallback=stream_cb, lm=LM_PROVIDERS[FAST_CHAT_MODEL]):
+                        this_round_count += 1
+                        new_val = round(progress/total, 2)
+                        writer.update_progress(new_val)
+                        progress += 1
                 
                 round_count += 1
                 
@@ -240,8 +243,10 @@ class Reducer():
 
             total, results = get_job_storage(self.application_id, db=db)
 
+            writer = JobWriter(job_id)
+
             def cb(result, index, data):
-                store_in_job(job_id, text_data=result, metadata=json.loads(data['metadata']), new_conn=True)
+                writer.store(text_data=result, metadata=json.loads(data['metadata']))
 
             def get_lm_part(x):
                 txt = "Given text:\n\n"
@@ -251,9 +256,10 @@ class Reducer():
                 return txt
 
             progress = 1
-            for _ in stream_progress_batched_lm(results, get_lm_part=get_lm_part, streamingCallback=cb, lm=LM_PROVIDERS[FAST_CHAT_MODEL]):
-                update_job_progress(job_id, round(progress/total, 2), db=db)
-                progress += 1
+            with writer:
+                for _ in stream_progress_batched_lm(results, get_lm_part=get_lm_part, streamingCallback=cb, lm=LM_PROVIDERS[FAST_CHAT_MODEL]):
+                    writer.update_progress(round(progress/total, 2))
+                    progress += 1
 
         do_transform()
 
@@ -300,15 +306,15 @@ class Reducer():
         # Skip header
         next(csv_reader)
 
-        for row in csv_reader:
-            try:
-                metadata = {x['index']: row[i] for i, x in enumerate(APPLICATION_DATA) if x['res_source'] == 'metadata'}
-                root = {x['index']: row[i] for i, x in enumerate(APPLICATION_DATA) if x['res_source'] == ''}
-            except IndexError:
-                return MyResponse(False, reason="CSV not formatted correctly. Be sure to use a previously exported CSV of results rather than an arbitrary file.").to_json()
+        # Rows are inserted in batches rather than one query each
+        with JobWriter(self.application_id, db=db) as writer:
+            for row in csv_reader:
+                try:
+                    metadata = {x['index']: row[i] for i, x in enumerate(APPLICATION_DATA) if x['res_source'] == 'metadata'}
+                    root = {x['index']: row[i] for i, x in enumerate(APPLICATION_DATA) if x['res_source'] == ''}
+                except IndexError:
+                    return MyResponse(False, reason="CSV not formatted correctly. Be sure to use a previously exported CSV of results rather than an arbitrary file.").to_json()
 
-            # It used to be that we only executed a query one in every hundred times to reduce database calls
-            # Might be worth bringing that functionality back by adding a store_many_in_job function.
-            store_in_job(self.application_id, text_data=root['text_data'], metadata=metadata, db=db)
+                writer.store(text_data=root['text_data'], metadata=metadata)
 
         return MyResponse(True).to_json()
@@ -1,31 +1,36 @@
-from sklearn.metrics import pairwise
 import numpy as np
 from .auth import User
 from .exceptions import NoCreateError, RetrieverEmbeddingsError, ZipFileRetrieverError
-from .jobs import complete_job, mark_job_error, update_job_progress, store_in_job
+from .jobs import complete_job, mark_job_error, JobWriter
 from .batch_and_stream_lm import stream_batched_lm, stream_progress_batched_lm
 from .prompts.retrieval_prompts import guess_answer_prompt, guess_answer_prompt_backup
 import json
 import sys
 from .integrations.lm import LM, LM_PROVIDERS, get_safe_retrieval_context_length, FAST_CHAT_MODEL, DEFAULT_CHAT_MODEL
-from .integrations.file_loaders import get_loader, TextSplitter
+from .integrations.file_loaders import get_loader, TextSplitter, PdfLoader
 from .utils import make_json_serializable, ntokens_to_nchars, get_extension_from_path
 import tempfile
 import warnings
-from .storage_interface import download_file, upload_retriever
+from .storage_interface import download_file, upload_retriever, delete_resources_from_storage
+from .chunk_store import ChunkStore, ChunkStoreWriter, is_chunk_store, convert_pickle_file, rebuild_with_index
+from .ann import normalize_rows, probe
+from .configs.user_config import RETRIEVER_ANN_MIN_RESOURCE_CHUNKS, RETRIEVER_ANN_MIN_CHUNKS, RETRIEVER_ANN_PROBE_FRACTION
+from .retriever_cache import RESOURCE_RETRIEVER_CACHE, CachedResourceRetriever
 import os
 import pickle
 from .db import needs_special_db, get_db
 from .configs.str_constants import APPLIER_RESPONSE
 from .utils import remove_ext
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from threading import Lock
 import math
-from difflib import SequenceMatcher
 import random
 from .prompts.auto_label_prompts import get_auto_desc_system_prompt
 from .utils import get_token_estimate, convert_heic_to_jpg
 from .integrations.ocr import OCR_PROVIDERS, OCR
 from .integrations.embed import EMBED_PROVIDERS, Embed, DEFAULT_EMBEDDING_OPTION
+from .embedding_cache import cached_embed
 import time
 
 
@@ -46,6 +51,15 @@ class Chunk():
         }
 
 
+# Retriever options that must match for a stored retriever to be reused
+CONSISTENCY_OPTIONS = [
+    'chunk_size_tokens',
+    'chunk_overlap_tokens',
+    'skip_embedding',
+    'embedding_fn_code'
+]
+
+
 # Check of a retriever is consistent wrt its resources and options
 def consistency_check(old_res_ret_info, resource_manifest, retriever_options):
 
@@ -65,14 +79,8 @@ def consistency_check(old_res_ret_info, resource_manifest, retriever_options):
         if old_res[k] != v:
             return False
 
-    needed_comparisons = [
-        'chunk_size_tokens',
-        'chunk_overlap_tokens',
-        'skip_embedding',
-        'embedding_fn_code'
-    ]
     old_ret_options = old_res_ret_info['retriever_options']
-    for k in needed_comparisons:
+    for k in CONSISTENCY_OPTIONS:
         if k not in old_ret_options:
             return False
         if k not in retriever_options:
@@ -83,33 +91,6 @@ def consistency_check(old_res_ret_info, resource_manifest, retriever_options):
     return True
 
 
-def _dup_score(chunk1, chunk2, n=6):
-
-    chunk1_split = chunk1.split()
-    chunk2_split = chunk2.split()
-
-    while len(chunk1_split) % n != 0:
-        chunk1_split.append('')
-    while len(chunk2_split) % n != 0:
-        chunk2_split.append('')
-
-    chunk1_ngrams = [' '.join(chunk1_split[i:i+n]) for i in range(0, len(chunk1_split)-n)]
-    chunk2_ngrams = [' '.join(chunk2_split[i:i+n]) for i in range(0, len(chunk2_split)-n)]
-
-    set1 = set(chunk1_ngrams)
-    set2 = set(chunk2_ngrams)
-    
-    # Use the intersection method of a set to find overlapping elements
-    overlapping = set1.intersection(set2)
-
-    # Means some chunks have zero length - not great not terrible
-    if len(set1) == 0 and len(set2) == 0:
-        return 1
-
-    score = len(overlapping) / max(len(set1), len(set2))
-    return score
-
-
 # Asset level
 class Retriever():
     
@@ -117,7 +98,8 @@ class Retriever():
                 chunk_size_tokens=400, 
                 chunk_overlap_tokens=10, lm: LM=LM_PROVIDERS[DEFAULT_CHAT_MODEL],
                 embedding_fn_code=None,
-                skip_embedding=False, no_create=False, force_ocr=False, force_create=False):
+                skip_embedding=False, no_create=False, force_ocr=False, force_create=False,
+                progress_callback=None):
 
         self.user = user
 
@@ -144,6 +126,18 @@ class Retriever():
 
         self.resource_retrievers = []
 
+        # See _get_embedding_matrix
+        self._embedding_matrix = None
+        self._embedding_offsets = None
+        self._ann_lists = None
+        self._token_prefix = None  # see _get_token_prefix
+
+        # Called with overall progress (0 to 1) while resource retrievers are made; see _report_progress
+        self.progress_callback = progress_callback
+        self._resource_progress = {}
+        self._progress_lock = Lock()
+        self._last_progress_report = 0
+
         # Create resource retrievers in multi-threaded fashion.
         def create_retriever(res):
             return ResourceRetriever(
@@ -157,7 +151,8 @@ class Retriever():
                 retriever_type_name=self.retriever_type_name,
                 no_create=no_create,
                 force_ocr=force_ocr,
-                force_create=force_create
+                force_create=force_create,
+                progress_callback=self._report_progress if progress_callback else None
             )
 
         self.resource_retrievers = []
@@ -173,6 +168,7 @@ class Retriever():
                 for future in as_completed(futures):
                     ret = future.result()  # Will raise an exception if the retriever creation failed
                     self.resource_retrievers.append(ret)
+                    self._report_progress(ret, 'done', ret.size)
 
             except:
                 """
@@ -188,6 +184,46 @@ class Retriever():
                     ret.delete()
                 raise
         
+    # The stacked embeddings/indices are rebuilt wherever the retriever ends up (rather than pickled)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_embedding_matrix'] = None
+        state['_embedding_offsets'] = None
+        state['_ann_lists'] = None
+        state['_token_prefix'] = None
+        state['progress_callback'] = None
+        state['_progress_lock'] = None
+        return state
+
+    # Each resource counts equally; one that's being made is a quarter done once it's chunked, and the rest is embedding.
+    # Reports at most once a second (plus when everything's done).
+    def _report_progress(self, ret, stage, count):
+        if not self.progress_callback:
+            return
+        with self._progress_lock:
+            progress = self._resource_progress.setdefault(id(ret), {'chunked': 0, 'embedded': 0, 'done': False})
+            if stage in ('written', 'done'):
+                progress['done'] = True
+            else:
+                progress[stage] = count
+            
+            total = 0
+            for x in self._resource_progress.values():
+                if x['done']:
+                    total += 1
+                elif x['chunked']:
+                    total += .25 + .75 * min(x['embedded'] / x['chunked'], 1)
+            overall = total / max(len(self.resources), 1)
+
+            now = time.time()
+            if overall < 1 and now - self._last_progress_report < 1:
+                return
+            self._last_progress_report = now
+        try:
+            self.progress_callback(min(overall, 1))
+        except Exception as e:
+            print(f"Progress callback failed: {e}", file=sys.stderr)
+
     # Unfortunately __del__ wasn't getting called automatically at exit
     def delete_resource_retrievers(self):
         for ret in self.resource_retrievers:
@@ -213,68 +249,224 @@ class Retriever():
         return answers
 
 
-    # Yields each embeddings np array, for each resource
-    def _load_embeddings(self):
+    # Where each resource's chunks start, when all chunks are numbered together ("rows"):
+    # rows offsets[i]:offsets[i+1] belong to self.resource_retrievers[i].
+    def _get_offsets(self):
+        if self._embedding_offsets is None:
+            self._embedding_offsets = np.concatenate([[0], np.cumsum([ret.size for ret in self.resource_retrievers], dtype=int)]).astype(int)
+        return self._embedding_offsets
+
+    def _embedding_dim(self):
         for ret in self.resource_retrievers:
             ret: ResourceRetriever
-            embeddings = ret.load_embeddings()
-            yield embeddings
+            if ret.size:
+                return ret.load_embeddings().shape[1]
+        return 0
+
+    # Returns every resource's embeddings, L2-normalized and stacked into one float32 matrix.
+    # Kept around so that repeated queries on the same retriever don't redo it.
+    def _get_embedding_matrix(self):
+        if self._embedding_matrix is None:
+            parts = []
+            for ret in self.resource_retrievers:
+                ret: ResourceRetriever
+                if ret.size:
+                    parts.append(ret.load_embeddings())
 
-    def _name_dup_score(self, name1, name2):
-        return SequenceMatcher(None, name1, name2).ratio()
+            if not parts:
+                matrix = np.empty((0, 0), dtype=np.float32)
+            else:
+                try:
+                    matrix = np.concatenate(parts).astype(np.float32, copy=False)
+                except ValueError:
+                    raise RetrieverEmbeddingsError("Resources in this retriever have embeddings of different sizes.")
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                norms[norms == 0] = 1
+                matrix /= norms
+
+            self._embedding_matrix = matrix
+        return self._embedding_matrix
+
+    # Normalized embeddings for some rows; only those rows are read from the chunk files, unless the whole matrix is already loaded.
+    def _get_vectors(self, rows):
+        if self._embedding_matrix is not None:
+            return self._embedding_matrix[rows]
+        offsets = self._get_offsets()
+        resource_indices = self._resource_indices(rows)
+        vectors = np.empty((len(rows), self._embedding_dim()), dtype=np.float32)
+        for r in np.unique(resource_indices):
+            ret: ResourceRetriever = self.resource_retrievers[r]
+            mask = resource_indices == r
+            vectors[mask] = ret.load_embeddings()[rows[mask] - offsets[r]]
+        return normalize_rows(vectors)
+
+    # The first query embedding is the question itself; the rest (plausible answers, context) count for less.
+    # Since a chunk's score is a weighted sum of cosine similarities, the queries can be combined into one vector first.
+    def _get_query_vector(self, query_embeddings, dim):
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != dim:
+            raise RetrieverEmbeddingsError("Value error trying to compare embeddings; something went wrong with embeddings.")
+        weights = np.full(len(queries), 1 / max(len(queries), 3), dtype=np.float32)  # formula for weighting importance of queries/context
+        weights[0] = 1
+        return weights @ normalize_rows(queries)
+
+    # Stacks the ANN indices (IVF lists) of every resource that has one, so that they can be probed together.
+    # Resources without an index are always scanned in full.
+    def _get_ann_lists(self):
+        if self._ann_lists is None:
+            offsets = self._get_offsets()
+            centroids = []
+            lists = []  # (resource index, the resource's order array, start, end)
+            unindexed_rows = []
+            for r, ret in enumerate(self.resource_retrievers):
+                ret: ResourceRetriever
+                if not ret.size:
+                    continue
+                index = ret.get_index()
+                if index is None:
+                    unindexed_rows.append(np.arange(offsets[r], offsets[r+1]))
+                    continue
+                ret_centroids, order, list_offsets = index
+                centroids.append(ret_centroids)
+                lists.extend((r, order, list_offsets[j], list_offsets[j+1]) for j in range(len(ret_centroids)))
+            self._ann_lists = (
+                np.concatenate(centroids) if centroids else None,
+                lists,
+                np.concatenate(unindexed_rows) if unindexed_rows else np.empty(0, dtype=int)
+            )
+        return self._ann_lists
+
+    # Brute force for small retrievers (where it's fast anyway, and exact)
+    def _use_ann(self):
+        if self.size() < RETRIEVER_ANN_MIN_CHUNKS:
+            return False
+        centroids, _, _ = self._get_ann_lists()
+        return centroids is not None
+
+    # Rows in the best lists, enough to cover probe_fraction of all lists and at least min_candidates rows
+    def _get_ann_candidates(self, query, probe_fraction, min_candidates):
+        centroids, lists, unindexed_rows = self._get_ann_lists()
+        offsets = self._get_offsets()
+        n_probe = max(1, math.ceil(probe_fraction * len(lists)))
+        rows = [unindexed_rows]
+        n_rows = len(unindexed_rows)
+        for i, j in enumerate(probe(centroids, query, len(lists))):
+            if i >= n_probe and n_rows >= min_candidates:
+                break
+            r, order, start, end = lists[j]
+            rows.append(order[start:end].astype(int) + offsets[r])
+            n_rows += end - start
+        return np.concatenate(rows)
+
+    # Scores chunks against the query embeddings; returns (rows, points).
+    # Small retrievers score everything in one matrix product; large ones only score the chunks in the closest ANN lists.
+    # ann_probe is the recall/latency knob: the fraction of ANN lists searched (default RETRIEVER_ANN_PROBE_FRACTION).
+    def _score(self, query_embeddings, ann_probe=None, min_candidates=0):
+        if self._use_ann():
+            query = self._get_query_vector(query_embeddings, self._embedding_dim())
+            rows = self._get_ann_candidates(query, ann_probe or RETRIEVER_ANN_PROBE_FRACTION, min_candidates)
+            return rows, self._get_vectors(rows) @ query
+
+        matrix = self._get_embedding_matrix()
+        if not len(matrix):
+            return np.empty(0, dtype=int), np.empty(0, dtype=np.float32)
+        query = self._get_query_vector(query_embeddings, matrix.shape[1])
+        return np.arange(len(matrix)), matrix @ query
+
+    # Indices of the k highest points, best first
+    def _top_k(self, points, k):
+        k = min(k, len(points))
+        if k <= 0:
+            return np.empty(0, dtype=int)
+        if k < len(points):
+            candidates = np.argpartition(-points, k - 1)[:k]
+        else:
+            candidates = np.arange(len(points))
+        return candidates[np.argsort(-points[candidates], kind='stable')]
+
+    # token_prefix[i] is the number of tokens in the first i chunks (across resource retrievers, in order), so that token budgets are arithmetic
+    def _get_token_prefix(self):
+        if self._token_prefix is None:
+            counts = np.array(self.chunk_token_counts(), dtype=np.int64)
+            self._token_prefix = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return self._token_prefix
+
+    # Which resource retriever each row belongs to
+    def _resource_indices(self, rows):
+        return np.searchsorted(self._get_offsets(), rows, side='right') - 1
+
+    def _get_chunks_by_rows(self, rows):
+        offsets = self._get_offsets()
+        resource_indices = self._resource_indices(rows)
+        chunks = []
+        for g, r in zip(rows, resource_indices):
+            ret: ResourceRetriever = self.resource_retrievers[r]
+            chunks.append(ret.get_chunk(int(g - offsets[r])))
+        return chunks
+
+    # MMR-style selection over the candidate rows (given best first, with their points):
+    # repeatedly take the candidate with the best mix of relevance and distance from what's already been taken.
+    # Near-duplicates (cosine similarity above dup_cutoff to something taken) are skipped, and chunks from resources that aren't represented yet get a boost.
+    def _diverse_top_k(self, candidates, cand_points, k, dup_cutoff, diversity_reward, mmr_lambda):
+        cand_vecs = self._get_vectors(candidates)
+        cand_resources = self._resource_indices(candidates)
+
+        max_sim = np.zeros(len(candidates), dtype=np.float32)  # to anything chosen so far
+        available = np.ones(len(candidates), dtype=bool)
+        represented = np.zeros(len(self.resource_retrievers), dtype=bool)
+        chosen = []
+        while len(chosen) < k and available.any():
+            relevance = np.where(represented[cand_resources], cand_points, cand_points * diversity_reward)
+            mmr = mmr_lambda * relevance - (1 - mmr_lambda) * max_sim
+            mmr[~available] = -np.inf
+            best = int(np.argmax(mmr))
+            chosen.append(candidates[best])
+            available[best] = False
+            represented[cand_resources[best]] = True
+            np.maximum(max_sim, cand_vecs @ cand_vecs[best], out=max_sim)
+            available &= max_sim <= dup_cutoff
+        return np.array(chosen, dtype=int)
 
 
     # Get as many chunks as possible given the size of the model
+    # Token counts are precomputed (see ResourceRetriever.chunk_token_counts), so no chunk is read unless it's returned.
     def max_chunks(self, lm: LM, context="", safe_context_length=None, use_ends=False):
-        all_chunks = []
-        chunk_lengths = []
-        for chunk in self.get_chunks():
-            chunk: Chunk
-            all_chunks.append(chunk)
-            chunk_length = get_token_estimate(chunk.txt)
-            chunk_lengths.append(chunk_length)
-        n_tokens = sum(chunk_lengths)
+        prefix = self._get_token_prefix()
+        n = len(prefix) - 1
+        n_tokens = int(prefix[-1])
         len_limit = safe_context_length or get_safe_retrieval_context_length(lm)
-        if n_tokens > len_limit:
-            if use_ends:
-                # Use the beginning and end
-                first_half_chunks = []
-                second_half_chunks = []
-                len_so_far = 0
-                for i, chunk in enumerate(all_chunks):
-                    if len_so_far + chunk_lengths[i] > len_limit / 2:
-                        break
-                    else:
-                        first_half_chunks.append(chunk)
-                        len_so_far += chunk_lengths[i]
-                for i in range(len(all_chunks) - 1, -1, -1):
-                    if len_so_far + chunk_lengths[i] >= len_limit:
-                        break
-                    else:
-                        second_half_chunks.append(all_chunks[i])
-                        len_so_far += chunk_lengths[i]
-                all_chunks = first_half_chunks + second_half_chunks[::-1]
-            elif context:
-                max_results = int(safe_context_length // self.chunk_size_tokens)
-                all_chunks = self.query(context, max_results=max_results)
-            else:
-                # Remove random ~difference
-                ntok_to_remove = n_tokens - safe_context_length
-                nchunks_to_remove = ntok_to_remove // self.chunk_size_tokens + 1
-                while nchunks_to_remove:
-                    rand = random.randrange(0, len(all_chunks))
-                    del all_chunks[rand]
-                    nchunks_to_remove -= 1
-        return all_chunks
+        if n_tokens <= len_limit:
+            return list(self.get_chunks())
+
+        if use_ends:
+            # Use the beginning and end: as many chunks from the start as fit in half the limit, then as many from the end as fit in what's left
+            n_first = int(np.searchsorted(prefix, len_limit / 2, side='right')) - 1
+            first_tokens = prefix[n_first]
+            # The end chunks from j on have n_tokens - prefix[j] tokens, which has to stay under len_limit - first_tokens
+            start_of_end = int(np.searchsorted(prefix, n_tokens - len_limit + first_tokens, side='right'))
+            start_of_end = max(start_of_end, n_first)
+            rows = np.concatenate([np.arange(n_first), np.arange(start_of_end, n)]).astype(int)
+            return self._get_chunks_by_rows(rows)
+        elif context:
+            max_results = int(safe_context_length // self.chunk_size_tokens)
+            return self.query(context, max_results=max_results)
+        else:
+            # Remove random ~difference
+            ntok_to_remove = n_tokens - safe_context_length
+            nchunks_to_remove = min(n, ntok_to_remove // self.chunk_size_tokens + 1)
+            rows = np.sort(np.array(random.sample(range(n), n - nchunks_to_remove), dtype=int))
+            return self._get_chunks_by_rows(rows)
 
     def query(self, txt, additional_sources=[],
                 additional_source_names=[],
                 max_results=5,
                 enable_plausible_answers_scheme=False,  # increases time to response by 1 request
                 context=[],
-                enable_dup_and_diversity_scheme=False,  # can cause major performance issues
-                dup_cutoff=.5,
-                diversity_reward=1.5):
+                enable_dup_and_diversity_scheme=True,
+                dup_cutoff=.95,  # cosine similarity above which chunks are considered duplicates
+                diversity_reward=1.5,  # multiplier for chunks from resources not yet in the results
+                mmr_lambda=.75,  # 1 = pure relevance, lower = more weight on distance from already-chosen chunks
+                ann_probe=None):  # for large retrievers, the fraction of the ANN index to search (higher = better recall, slower)
 
         assert(len(additional_sources) == len(additional_source_names))
 
@@ -284,75 +476,24 @@ class Retriever():
 
         to_embed = [txt] + plausible_answers + context
         embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
-        query_embeddings = embed_obj.embed(to_embed)
+        query_embeddings = cached_embed(embed_obj, to_embed)
 
         extra_sources_chunks = [Chunk(-1, additional_source_names[i], additional_sources[i]) for i in range(len(additional_sources))]
-        extra_sources_scores = [float('inf') for _ in range(len(extra_sources_chunks))]
-
-        best_chunks = [*extra_sources_chunks]
-        best_scores = [*extra_sources_scores]
+        n_results = max_results - len(extra_sources_chunks)
 
-        for ret in self.resource_retrievers:
-            ret: ResourceRetriever
-            # a lot of the architecture of the retriever is to avoid this;
-            # but unfortunately I think this is the best way, barring improvements to the chunk file.
-            # it would be better to rely on mysqlite here or something like that instead. TODO
-            chunks_in_memory = [chunk for chunk in ret.get_chunks()]
-            if len(chunks_in_memory) == 0:
-                continue
-            embeddings = [c.embedding for c in chunks_in_memory]
-            embeddings = np.array(embeddings)
+        # The extra candidates leave room for what gets skipped as duplicates
+        n_candidates = n_results * 4 if enable_dup_and_diversity_scheme else n_results
+        rows, points = self._score(query_embeddings, ann_probe=ann_probe, min_candidates=n_candidates)
+        if n_results <= 0 or not len(points):
+            return extra_sources_chunks[:max_results]
 
-            try:
-                sims = pairwise.cosine_similarity(query_embeddings, embeddings, dense_output=True)
-            except:
-                raise RetrieverEmbeddingsError("Value error trying to compare embeddings; something went wrong with embeddings.")
-
-            # Assign points for each chunk (for now, just a sum of similarity scores)
-            points = np.array(sims[0])  # first one is original question
-            for i in range(1, len(sims)):
-                points += sims[i] / max(len(sims), 3)  # formula for weighting importance of queries/context
-
-            ranking = points.argsort()[::-1]
-            
-            # Get the deduplicated top k
-            for i, x in enumerate(ranking):
-                curr_source: Chunk = chunks_in_memory[x]
-
-                # Check similarity score for diversity
-                if enable_dup_and_diversity_scheme:
-                    is_duplicate_source = True
-                    for s in [x.source_name for x in best_chunks]:
-                        if self._name_dup_score(curr_source.source_name, s) > 0.90:
-                            is_duplicate_source = False
-                    
-                    if is_duplicate_source:
-                        points[x] *= diversity_reward
-
-                # The 1.5 is thrown in to look out for potential dup score benefits
-                if len(best_scores) and (len(best_scores) >= (max_results * 1.5) and best_scores[-1] > points[x]):
-                    break
-
-                if enable_dup_and_diversity_scheme:
-                    # If it's already in best_chunks, forget it!
-                    if any(_dup_score(curr_source.txt, y.txt) > dup_cutoff for y in best_chunks):
-                        continue
-
-                # Otherwise, put it in its proper place
-                for i in range(len(best_chunks) + 1):
-                    if i >= len(best_chunks):  # if we're at the end
-                        best_scores.append(points[x])
-                        best_chunks.append(curr_source)
-                        break
-                    if best_scores[i] < points[x]:
-                        best_scores.insert(i, points[x])
-                        best_chunks.insert(i, curr_source)
-                        break
+        best = self._top_k(points, n_candidates)
+        if enable_dup_and_diversity_scheme:
+            chosen = self._diverse_top_k(rows[best], points[best], n_results, dup_cutoff, diversity_reward, mmr_lambda)
+        else:
+            chosen = rows[best]
 
-                best_chunks = best_chunks[:max_results]
-                best_scores = best_scores[:max_results]
-        
-        return best_chunks
+        return extra_sources_chunks + self._get_chunks_by_rows(chosen)
 
     # In chunks
     def size(self):
@@ -375,6 +516,13 @@ class Retriever():
             ret: ResourceRetriever
             lengths.extend(ret.chunk_lengths)
         return lengths
+
+    def chunk_token_counts(self):
+        counts = []
+        for ret in self.resource_retrievers:
+            ret: ResourceRetriever
+            counts.extend(ret.chunk_token_counts)
+        return counts
     
     def get_chunks(self):
         for ret in self.resource_retrievers:
@@ -382,40 +530,12 @@ class Retriever():
             for chunk in ret.get_chunks():
                 yield chunk
 
-    # This isn't used much and should be merged with .query
+    # Plain top-k by similarity (no extra sources, context, or dedup)
     def search(self, txt, max_results=5):
-
         embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
-        query_embeddings = embed_obj.embed([txt])
-        
-        embeddings = self._load_embeddings()
-
-        best_chunks = []
-        best_scores = []
-
-        for i, ret_embed in enumerate(embeddings):
-            sims = pairwise.cosine_similarity(query_embeddings, ret_embed, dense_output=True)
-            points = np.array(sims[0])
-            ranking = points.argsort()[::-1]
-
-            chosen_indices = ranking[:max_results]
-            chunks = self.resource_retrievers[i].get_chunks_by_indices(chosen_indices)
-
-            for k, curr_source in enumerate(chunks):
-                for i in range(len(best_chunks) + 1):
-                    if i >= len(best_chunks):
-                        best_scores.append(points[chosen_indices[k]])
-                        best_chunks.append(curr_source)
-                        break
-                    if best_scores[i] < points[chosen_indices[k]]:
-                        best_scores.insert(i, points[chosen_indices[k]])
-                        best_chunks.insert(i, curr_source)
-                        break
-
-            best_chunks = best_chunks[:max_results]
-            best_scores = best_scores[:max_results]
-
-        return best_chunks
+        query_embeddings = cached_embed(embed_obj, [txt])
+        rows, points = self._score(query_embeddings, min_candidates=max_results)
+        return self._get_chunks_by_rows(rows[self._top_k(points, max_results)])
 
 
     @needs_special_db(consistent_conn=True)
@@ -456,6 +576,9 @@ class Retriever():
                 for chunk in self.get_chunks():
                     chunk_names.append(chunk.source_name)
                     chunk_texts.append(chunk.txt)
+
+                # Results and progress are written in batches; the writer flushes whatever's left when we leave the with (error or not)
+                writer = JobWriter(job_id, db=db)
                 
                 def streamingCallback(result, index, _):  # the underscore because we don't use the input data here
                     val = {
@@ -464,7 +587,7 @@ class Retriever():
                         'chunk_index': index,
                         'chunk_text': chunk_texts[index]
                     }
-                    store_in_job(job_id, name=APPLIER_RESPONSE, text_data=result, metadata=val, db=db)
+                    writer.store(name=APPLIER_RESPONSE, text_data=result, metadata=val)
 
                 progress = 0
 
@@ -472,10 +595,11 @@ class Retriever():
                 if model_code:
                     real_lm: LM = LM_PROVIDERS[model_code]
 
-                for i in stream_progress_batched_lm(get_data(), get_lm_part=lambda x: x['text'], get_sys_part=lambda x: x['sys'], streamingCallback=streamingCallback, lm=real_lm):
-                    yield i
-                    progress += 1
-                    update_job_progress(job_id, round(progress/size, 2), db=db)
+                with writer:
+                    for i in stream_progress_batched_lm(get_data(), get_lm_part=lambda x: x['text'], get_sys_part=lambda x: x['sys'], streamingCallback=streamingCallback, lm=real_lm):
+                        yield i
+                        progress += 1
+                        writer.update_progress(round(progress/size, 2))
             
                 complete_job(job_id, db=db)
 
@@ -491,26 +615,14 @@ class Retriever():
 
     # Get n random chunks
     def random(self, lm: LM, max_n, safe_context_length=None):
-        reservoir = []
-        for i, element in enumerate(self.get_chunks()):
-            if i < max_n:
-                reservoir.append(element)
-            else:
-                j = random.randint(0, i)
-                if j < max_n:
-                    reservoir[j] = element
+        prefix = self._get_token_prefix()
+        n = len(prefix) - 1
+        rows = np.array(random.sample(range(n), min(max_n, n)), dtype=int)
         # Make sure we're under the LM's safe context length
         len_limit = safe_context_length or get_safe_retrieval_context_length(lm)
-        tokens = 0
-        for i, chunk in enumerate(reservoir):
-            chunk: Chunk
-            new_token_len = get_token_estimate(chunk.txt)
-            if tokens + new_token_len > len_limit:
-                reservoir = reservoir[:i]
-                break
-            tokens += new_token_len
-
-        return reservoir
+        counts = prefix[rows + 1] - prefix[rows]
+        n_fit = int(np.searchsorted(np.cumsum(counts), len_limit, side='right'))
+        return self._get_chunks_by_rows(rows[:n_fit])
 
     # Used for sending requests the results of which should be an applier/retriever
     # Could potentially add more info
@@ -537,11 +649,157 @@ class Retriever():
 
 """
 
-NOTE: in the future, might make sense to give embeddings their own temp file within ResourceRetriever
-That file would be loaded all at once, and the index of an embedding would serve as an index into the more memory efficient chunk file
+Retriever status straight from asset_retrieval_storage, without downloading any chunk files (see /assets/get-retriever-status).
+
+find_stored_retrievers picks, for each resource, the row that loading a ResourceRetriever (without forcing anything) would use,
+in one query that leaves out the big parts of the stored info; stored_retriever_info then gets just the chunk names and lengths of those rows.
 
 """
 
+# Returns {resource id: asset_retrieval_storage id} for the stored retrievers of these resources that would be used as is,
+# or None if any resource is missing one (so a Retriever would have to make it).
+@needs_special_db(read_only=True)
+def find_stored_retrievers(resources, retriever_type_name="retriever", db=None):
+    if not len(resources):
+        return {}
+    manifests = {res['id']: res for res in resources}
+    sql = f"""
+    SELECT `id`, `resource_id`,
+        JSON_EXTRACT(`metadata`, '$.resource_manifest') AS `resource_manifest`,
+        JSON_EXTRACT(`metadata`, '$.retriever_options') AS `retriever_options`
+    FROM asset_retrieval_storage
+    WHERE `resource_id` IN ({','.join(['%s'] * len(manifests))})
+    AND JSON_UNQUOTE(JSON_EXTRACT(`metadata`, '$.retriever_type_name')) LIKE %s
+    ORDER BY `time_uploaded` DESC
+    """
+    curr = db.cursor()
+    curr.execute(sql, (*manifests.keys(), retriever_type_name))
+    chosen = {}
+    for row in curr.fetchall():
+        if row['resource_id'] in chosen or not row['resource_manifest'] or not row['retriever_options']:
+            continue
+        # Same as ResourceRetriever._choose_from_storage: the newest consistent one
+        meta = {'resource_manifest': json.loads(row['resource_manifest']), 'retriever_options': json.loads(row['retriever_options'])}
+        if consistency_check(meta, manifests[row['resource_id']], meta['retriever_options']):
+            chosen[row['resource_id']] = row['id']
+    if len(chosen) < len(manifests):
+        return None
+    return chosen
+
+
+# What Retriever(user, resources, no_create=True).info() would give, for the rows chosen by find_stored_retrievers.
+# Returns None if the stored info isn't enough (retrievers stored before chunk lengths were kept, or rows deleted since).
+@needs_special_db(read_only=True)
+def stored_retriever_info(resources, chosen, retriever_type_name="retriever", db=None):
+    rows = {}
+    if len(chosen):
+        sql = f"""
+        SELECT `id`,
+            JSON_EXTRACT(`metadata`, '$.chunk_names') AS `chunk_names`,
+            JSON_EXTRACT(`metadata`, '$.chunk_lengths') AS `chunk_lengths`,
+            JSON_EXTRACT(`metadata`, '$.retriever_options') AS `retriever_options`
+        FROM asset_retrieval_storage
+        WHERE `id` IN ({','.join(['%s'] * len(chosen))})
+        """
+        curr = db.cursor()
+        curr.execute(sql, tuple(chosen.values()))
+        rows = {row['id']: row for row in curr.fetchall()}
+
+    chunk_names = []
+    chunk_lengths = []
+    retriever_options = {}
+    for res in resources:
+        row = rows.get(chosen[res['id']])
+        if not row or not row['chunk_names'] or not row['chunk_lengths']:
+            return None
+        names = json.loads(row['chunk_names'])
+        lengths = json.loads(row['chunk_lengths'])
+        if len(names) != len(lengths):
+            return None
+        chunk_names.extend(names)
+        chunk_lengths.extend(lengths)
+        retriever_options = retriever_options or json.loads(row['retriever_options'])
+
+    return {
+        'chunk_names': chunk_names,
+        'resources': resources,
+        'chunk_lengths': chunk_lengths,
+        'retriever_type_name': retriever_type_name,
+        'retriever_options': retriever_options
+    }
+
+
+EMBEDDING_BATCH_SIZE = 500  # texts per embedding request
+EMBEDDING_MAX_IN_FLIGHT = 4  # embedding requests out at once, per resource
+
+
+# Ingestion for a ResourceRetriever, in one pass:
+# chunks are written to the chunk store as the loader produces them, and embedding requests go out in batches (a bounded number at a time) while the loader keeps going.
+# Embeddings are written in order as they come back, so nothing is read back from disk and the embeddings are never all held in memory.
+# progress_callback, if given, is called with (stage, count) as 'chunked' and 'embedded' counts go up, and with ('written', count) at the end.
+class ChunkPipeline():
+    def __init__(self, embed_fn=None, progress_callback=None, batch_size=EMBEDDING_BATCH_SIZE, max_in_flight=EMBEDDING_MAX_IN_FLIGHT):
+        self.writer = ChunkStoreWriter()
+        self.embed_fn = embed_fn  # None means don't embed
+        self.progress_callback = progress_callback
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight) if embed_fn else None
+        self.in_flight = deque()
+        self.batch = []
+        self.n_embedded = 0
+
+    def _report(self, stage, count):
+        if self.progress_callback:
+            try:
+                self.progress_callback(stage, count)
+            except Exception as e:
+                print(f"Progress callback failed: {e}", file=sys.stderr)
+
+    def add(self, txt, source_name):
+        self.writer.add(txt, source_name)
+        self._report('chunked', len(self.writer))
+        if self.embed_fn:
+            self.batch.append(txt)
+            if len(self.batch) >= self.batch_size:
+                self._submit()
+
+    def _submit(self):
+        while len(self.in_flight) >= self.max_in_flight:
+            self._collect()
+        self.in_flight.append(self.executor.submit(self.embed_fn, self.batch))
+        self.batch = []
+
+    # Waits on the oldest request, so that embeddings are written in order
+    def _collect(self):
+        embeddings = self.in_flight.popleft().result()
+        self.writer.add_embeddings(embeddings)
+        self.n_embedded += len(embeddings)
+        self._report('embedded', self.n_embedded)
+
+    # Returns the name of the finished chunk store file
+    def finish(self, index_min_chunks=None):
+        try:
+            if self.embed_fn:
+                if self.batch:
+                    self._submit()
+                while self.in_flight:
+                    self._collect()
+                self.executor.shutdown()
+            path = self.writer.finish(index_min_chunks=index_min_chunks if self.embed_fn else None)
+        except:
+            self.abort()
+            raise
+        self._report('written', len(self.writer))
+        return path
+
+    def abort(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.in_flight.clear()
+        self.writer.abort()
+
+
 # Resource level - one file
 class ResourceRetriever():
     def __init__(self, user: User, resource_manifest,
@@ -550,9 +808,10 @@ class ResourceRetriever():
                 chunk_overlap_tokens=10, lm: LM=None,
                 embedding_fn_code=None,
                 skip_embedding=False, no_create=False,
-                force_ocr=False, force_create=False):
+                force_ocr=False, force_create=False, progress_callback=None):
         
         self.user = user
+        self.progress_callback = progress_callback  # see ChunkPipeline
 
         self.retriever_type_name = retriever_type_name
         self.chunk_size_tokens = chunk_size_tokens
@@ -562,9 +821,12 @@ class ResourceRetriever():
         self.skip_embedding = skip_embedding
         self.force_ocr = force_ocr
 
-        self.chunk_filename = None
+        self.chunk_filename = None  # a chunk store file (see chunk_store.py)
+        self._store = None  # opened lazily
+        self._owns_chunk_file = True  # false when the chunk file belongs to RESOURCE_RETRIEVER_CACHE
         self.size = 0
         self.chunk_lengths = []
+        self.chunk_token_counts = []  # exact, computed once when chunking and stored with the retriever (see Retriever.max_chunks)
         self.chunk_names = []
 
         # Set embedding function
@@ -579,45 +841,122 @@ class ResourceRetriever():
         self._get_or_create_data(no_create=no_create, force_ocr=force_ocr, force_create=force_create)
 
 
+    # Resource retrievers get pickled to send to workers; open files/mmaps can't come along.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_store'] = None
+        state['progress_callback'] = None
+        return state
+
     # On clean up, get rid of the temporary chunk file
     # Would've been nice to use __del__, but it gets called too early with caching
     def delete(self):
+        self._close_store()
         try:
-            if self.chunk_filename:
+            if self.chunk_filename and self._owns_chunk_file:
                 os.remove(self.chunk_filename)
         except FileNotFoundError:
             pass
 
-    def _get_or_create_data(self, no_create=False, force_ocr=False, force_create=False):
-
-        # Just use a fresh connection here - this func could be run under different conditions inside the lifetime of the object
-        db = get_db(new_connection=True)
-        curr = db.cursor()
+    def _close_store(self):
+        if self._store:
+            self._store.close()
+            self._store = None
 
-        if self.chunk_filename:
+    # Swaps in a new chunk file, removing the old one
+    def _set_chunk_file(self, filename, owned=True):
+        self._close_store()
+        if self.chunk_filename and self.chunk_filename != filename and self._owns_chunk_file:
             try:
                 os.remove(self.chunk_filename)
-            except:
+            except FileNotFoundError:
                 pass
-            self.chunk_filename = None
-        
-        res = None
-        
-        # See if there's an existing retriever out there (type names have to match)
+        self.chunk_filename = filename
+        self._owns_chunk_file = owned
+
+    def _cache_key(self):
+        return (self.resource_manifest['id'], self.retriever_type_name, *[getattr(self, k) for k in CONSISTENCY_OPTIONS])
+
+    def _load_from_cache(self):
+        entry: CachedResourceRetriever = RESOURCE_RETRIEVER_CACHE.get(self._cache_key(), self.resource_manifest)
+        if not entry:
+            return False
+        self._set_chunk_file(entry.chunk_filename, owned=False)
+        self.chunk_names = entry.chunk_names
+        self.chunk_lengths = entry.chunk_lengths
+        self.chunk_token_counts = entry.chunk_token_counts
+        self.size = len(entry.chunk_names)
+        return True
+
+    # Hands the chunk file over to the cache
+    def _put_in_cache(self):
+        entry = CachedResourceRetriever(self.chunk_filename, self.resource_manifest, self.chunk_names, self.chunk_lengths, self.chunk_token_counts)
+        RESOURCE_RETRIEVER_CACHE.put(self._cache_key(), entry)
+        self._owns_chunk_file = False
+
+    def _get_store(self) -> ChunkStore:
+        if not self.chunk_filename:
+            raise Exception("Tried to use chunk file, but no chunk filename.")
 
+        if not self._store:
+            if not os.path.exists(self.chunk_filename):  # e.g., evicted from the cache
+                self._get_or_create_data()  # not the greatest... maybe raise an exception?
+            self._store = ChunkStore(self.chunk_filename)
+        return self._store
+
+    # Retrievers stored in the old format (a file of pickled Chunks) are converted on load,
+    # and the converted version replaces the old one in storage so that this only happens once.
+    # Returns the name of the converted local file.
+    def _migrate_legacy_chunk_file(self, legacy_filename, ret_row, db):
+        new_filename = convert_pickle_file(legacy_filename)
+        os.remove(legacy_filename)
+        self._replace_in_storage(new_filename, ret_row, db)
+        return new_filename
+
+    # Chunk files from before ANN indices existed get one on load, if they're big enough.
+    # Returns the name of the (possibly new) local file.
+    def _add_missing_index(self, filename, ret_row, db):
+        store = ChunkStore(filename)
+        needs_index = store.embeddings is not None and len(store) >= RETRIEVER_ANN_MIN_RESOURCE_CHUNKS and not store.has_index()
+        store.close()
+        if not needs_index:
+            return filename
+        new_filename = rebuild_with_index(filename, RETRIEVER_ANN_MIN_RESOURCE_CHUNKS)
+        os.remove(filename)
+        self._replace_in_storage(new_filename, ret_row, db)
+        return new_filename
+
+    # Uploads a new version of a stored retriever's chunk file and points its asset_retrieval_storage row at it
+    def _replace_in_storage(self, new_filename, ret_row, db):
+        try:
+            path, res_from = upload_retriever(self.resource_manifest, new_filename, self.retriever_type_name)
+            sql = """
+            UPDATE asset_retrieval_storage
+            SET `from`=%s, `path`=%s
+            WHERE `id`=%s
+            """
+            curr = db.cursor()
+            curr.execute(sql, (res_from, path, ret_row['id']))
+            db.commit(close_cursors=False, close=False)
+            delete_resources_from_storage([ret_row])
+        except Exception as e:
+            # We can still use the new file locally; we'll just redo it next time.
+            print(f"Couldn't replace stored retriever for resource with id {self.resource_manifest['id']}: {e}", file=sys.stderr)
+
+    # Rows in asset_retrieval_storage for this resource and type name, newest first
+    def _find_in_storage(self, curr):
         sql = """
         SELECT * FROM asset_retrieval_storage
         WHERE `resource_id`=%s
         AND JSON_UNQUOTE(JSON_EXTRACT(`metadata`, '$.retriever_type_name')) LIKE %s
         ORDER BY `time_uploaded` DESC
         """
+        curr.execute(sql, (self.resource_manifest['id'], self.retriever_type_name))
+        return curr.fetchall()
 
-        is_synthetic = self.resource_manifest['id'] == -1
-        results = []
-        if not is_synthetic:  # if it's synthetic, you're not going to find it!
-            curr.execute(sql, (self.resource_manifest['id'], self.retriever_type_name))
-            results = curr.fetchall()
-
+    # Returns (row to use or None, rows to delete)
+    def _choose_from_storage(self, results, force_ocr=False, force_create=False):
+        res = None
         to_del = []
         for ret_row in results:
 
@@ -657,7 +996,37 @@ class ResourceRetriever():
                     break
                 else:
                     to_del.append(ret_row)
+        return res, to_del
 
+    def _get_or_create_data(self, no_create=False, force_ocr=False, force_create=False):
+
+        is_synthetic = self.resource_manifest['id'] == -1
+
+        # Forcing anything means we need to go through storage
+        if not is_synthetic and not force_ocr and not force_create and self._load_from_cache():
+            return
+
+        # Just use a fresh connection here - this func could be run under different conditions inside the lifetime of the object
+        db = get_db(new_connection=True)
+        curr = db.cursor()
+
+        if self.chunk_filename:
+            self._set_chunk_file(None)
+        
+        # See if there's an existing retriever out there (type names have to match)
+        # The lookup goes to a read replica if there's a fresh one; if that doesn't find anything usable, it's double checked on the primary before anything gets made.
+        res = None
+        to_del = []
+        if not is_synthetic:  # if it's synthetic, you're not going to find it!
+            read_db = get_db(new_connection=True, read_only=True)
+            try:
+                results = self._find_in_storage(read_db.cursor())
+            finally:
+                read_db.close()
+            res, to_del = self._choose_from_storage(results, force_ocr=force_ocr, force_create=force_create)
+            if not res:
+                results = self._find_in_storage(curr)
+                res, to_del = self._choose_from_storage(results, force_ocr=force_ocr, force_create=force_create)
 
         # Delete the bad/old ones...
         if len(to_del) > 0:
@@ -678,18 +1047,29 @@ class ResourceRetriever():
             tmp = tempfile.NamedTemporaryFile(delete=False)
             try:
                 download_file(tmp.name, res)
-                self.chunk_filename = tmp.name
-                size = 0
-                chunk_lengths = []
-                chunk_names = []
-                for chunk in self.get_chunks():
-                    chunk_lengths.append(len(chunk.txt))
-                    chunk_names.append(chunk.source_name)
-                    size += 1
-                self.size = size
-                self.chunk_lengths = chunk_lengths
-                self.chunk_names = chunk_names
+                chunk_filename = tmp.name
+                if not is_chunk_store(chunk_filename):
+                    chunk_filename = self._migrate_legacy_chunk_file(chunk_filename, res, db)
+                chunk_filename = self._add_missing_index(chunk_filename, res, db)
+                self.chunk_filename = chunk_filename
+
+                # Names and lengths are in the stored info; no need to go through the chunks
+                store = self._get_store()
+                meta = json.loads(res['metadata'])
+                self.size = len(store)
+                if len(meta.get('chunk_lengths', [])) == self.size:
+                    self.chunk_lengths = meta['chunk_lengths']
+                else:
+                    self.chunk_lengths = [len(store.text(i)) for i in range(self.size)]
+                # Retrievers stored before token counts were kept have them counted here, once per load rather than per use
+                if len(meta.get('chunk_token_counts', [])) == self.size:
+                    self.chunk_token_counts = meta['chunk_token_counts']
+                else:
+                    self.chunk_token_counts = [get_token_estimate(store.text(i)) for i in range(self.size)]
+                self.chunk_names = list(store.names)
+                self._put_in_cache()
             except Exception as e:
+                self._set_chunk_file(None)
                 print(e, file=sys.stderr)
                 print(f"Couldn't load retriever for resource with id {self.resource_manifest['id']}; making instead.", file=sys.stderr)
 
@@ -699,9 +1079,8 @@ class ResourceRetriever():
             if no_create and not is_synthetic:
                 raise NoCreateError("Can't find existing chunks, and no_create flag was specified.")
 
-            self.chunk_filename = self._make_chunks(force_ocr=force_ocr, is_synthetic=is_synthetic)
-            if not self.skip_embedding and not (is_synthetic and no_create):
-                self.chunk_filename = self._embed_chunks()      
+            embed = not self.skip_embedding and not (is_synthetic and no_create)
+            self._set_chunk_file(self._make_chunks(force_ocr=force_ocr, is_synthetic=is_synthetic, embed=embed))
 
             if not is_synthetic:
 
@@ -720,121 +1099,87 @@ class ResourceRetriever():
                 """
                 meta = self.info()
                 curr.execute(sql, (self.resource_manifest['asset_id'], self.resource_manifest['id'], res_from, path, json.dumps(meta)))
+                self._put_in_cache()
             db.commit()
 
 
-    def get_chunks(self):
-        if not self.chunk_filename:
-            raise Exception("Tried to use chunk file, but no chunk filename.")
-
-        if not os.path.exists(self.chunk_filename):
-            self._get_or_create_data()  # not the greatest... maybe raise an exception?
-
-        with open(self.chunk_filename, 'rb') as fhand:
-            i = 0
-            while True:
-                try:
-                    chunk: Chunk = pickle.load(fhand)
-                    yield chunk
-                    # This loop can be pretty dense in places, and looping over chunks can hog CPU time from the server/other threads, affecting new connections.
-                    # the time.sleep(0) gives the server an entry to process new requests before returning here.
-                    # If this is a bottleneck, it usually means there are issues in other places that should be fixed
-                    # – as of writing, **known related issues have been fixed, and this is probably superfluous.**
-                    if i % 20 == 0:
-                        time.sleep(0)
-                    i += 1
-                except EOFError:
-                    break
-
+    def get_chunk(self, i):
+        store = self._get_store()
+        embedding = store.embeddings[i] if store.embeddings is not None else None
+        return Chunk(int(i), store.names[i], store.text(i), embedding=embedding)
 
-    # Loads embeddings into memory and returns np.array
-    # Uses the chunk temp file as serialized pickle file
+    def get_chunks(self):
+        store = self._get_store()
+        for i in range(len(store)):
+            yield self.get_chunk(i)
+            # This loop can be pretty dense in places, and looping over chunks can hog CPU time from the server/other threads, affecting new connections.
+            # the time.sleep(0) gives the server an entry to process new requests before returning here.
+            # If this is a bottleneck, it usually means there are issues in other places that should be fixed
+            # – as of writing, **known related issues have been fixed, and this is probably superfluous.**
+            if i % 20 == 0:
+                time.sleep(0)
+
+
+    # Returns the embeddings as an (n x dim) float32 array, memory-mapped from the chunk file
     def load_embeddings(self):
-        embeddings = []
+        store = self._get_store()
+        if store.embeddings is None:
+            if len(store) == 0:
+                return np.empty((0, 0), dtype=np.float32)
+            raise RetrieverEmbeddingsError(f"Trying to load un-embedded chunk in resource {self.resource_manifest['title']} with id {self.resource_manifest['id']}")
+        return store.embeddings
 
-        for chunk in self.get_chunks():
-            embedding = chunk.embedding
-            if embedding is None:
-                raise Exception(f"Trying to load un-embedded chunk in resource {self.resource_manifest['title']} with id {self.resource_manifest['id']}")
-            embeddings.append(embedding)
-        
-        return np.array(embeddings)
+    # Returns the ANN index as (centroids, order, list_offsets), or None if this resource doesn't have one (see ann.py)
+    def get_index(self):
+        store = self._get_store()
+        if not store.has_index():
+            return None
+        return store.ivf_centroids, store.ivf_order, store.ivf_list_offsets
 
 
     # Encourages batching, which is important performance-wise
-    # chunk_indices is a list of chunk_index's
-    # The performance here can be improved significantly in the future
+    # chunk_indices is a list of chunk_index's; chunks are returned in the same order
     def get_chunks_by_indices(self, chunk_indices):
-        # Could use an algorithmic improvement
-        chunks = []
-        for chunk in self.get_chunks():
-            if chunk.index in chunk_indices:
-                chunks.append(chunk)
-        return chunks
-
-
-    # Sets self.embeddings to embeddings, matched with chunks
-    # Makes a new chunk file that contains the embeddings with each chunk
-    def _embed_chunks(self):
-
-        EMBEDDING_BATCH_SIZE = 500
-
-        def _do_embedding(lst):
-            embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
-            embeddings = embed_obj.embed(lst)
-            try:
-                embeddings = np.array(embeddings)
-            except:
-                # Probably missed some of the txt and returned empty / wrong-sized vectors in places
-
-                # Find problematic ones
-                inds  = []
-                max_columns = max(len(row) for row in embeddings)
-                for i in range(len(embeddings)):
-                    if embeddings[i] is None or len(embeddings[i]) != max_columns:
-                        inds.append(i)
-
-                # Retry
-                retry_batch = [lst[i] for i in inds]
-                retry_embeds = embed_obj.embed(retry_batch)
-
-                # Re-insert problematic ones
-                for i, emb in zip(inds, retry_embeds):
-                    embeddings[i] = emb
-                
-                # Give np one more shot (if there's an error, there's an error!)
-                embeddings = np.array(embeddings)
-
-            return embeddings
-
-        total = []  # We're storing embeddings all in memory
-        batch = []
-        for i, chunk in enumerate(self.get_chunks()):
-            batch.append(chunk.txt)
+        return [self.get_chunk(i) for i in chunk_indices]
 
-            if len(batch) >= EMBEDDING_BATCH_SIZE:
-                total.extend(_do_embedding(batch))
-                batch = []
 
-        if len(batch) > 0:
-            total.extend(_do_embedding(batch))
+    # Embeds a batch of texts; returns an np array
+    def _embed_batch(self, lst):
+        embed_obj: Embed = EMBED_PROVIDERS[self.embedding_fn_code]
+        embeddings = cached_embed(embed_obj, lst)
+        try:
+            embeddings = np.array(embeddings)
+        except:
+            # Probably missed some of the txt and returned empty / wrong-sized vectors in places
+
+            # Find problematic ones
+            inds  = []
+            max_columns = max(len(row) for row in embeddings)
+            for i in range(len(embeddings)):
+                if embeddings[i] is None or len(embeddings[i]) != max_columns:
+                    inds.append(i)
+
+            # Retry
+            retry_batch = [lst[i] for i in inds]
+            retry_embeds = embed_obj.embed(retry_batch)
+
+            # Re-insert problematic ones
+            for i, emb in zip(inds, retry_embeds):
+                embeddings[i] = emb
+            
+            # Give np one more shot (if there's an error, there's an error!)
+            embeddings = np.array(embeddings)
 
-        # Now we put them in a new chunk file
+        return embeddings
 
-        new_chunk_file = tempfile.NamedTemporaryFile(delete=False)
+    def _make_pipeline(self, embed):
+        progress_callback = None
+        if self.progress_callback:
+            progress_callback = lambda stage, count: self.progress_callback(self, stage, count)
+        return ChunkPipeline(embed_fn=self._embed_batch if embed else None, progress_callback=progress_callback)
 
-        with open(new_chunk_file.name, 'wb') as fhand:
-            for i, chunk in enumerate(self.get_chunks()):
-                chunk.embedding = total[i]
-                pickle.dump(chunk, fhand)
-        
-        os.remove(self.chunk_filename)
-        self.chunk_filename = new_chunk_file
-        return new_chunk_file.name
-
-    
-    # Returns name of tempfile that stores chunks as pickle
-    def _make_chunks(self, force_ocr=False, is_synthetic=False):
+    # Returns name of tempfile that stores chunks (as a chunk store, with embeddings if embed is set)
+    def _make_chunks(self, force_ocr=False, is_synthetic=False, embed=True):
 
         MIN_CHAR_LENGTH_WARN = 100
 
@@ -854,22 +1199,23 @@ class ResourceRetriever():
             chunk_name = self.resource_manifest['title']
             splitsville = text_splitter.split_text(text)
             
-            serialized_file = tempfile.NamedTemporaryFile(delete=False)
-            with open(serialized_file.name, 'wb') as ser:
-                if not len(splitsville):
-                    self.size = 0
-                    self.chunk_lengths = []
-                    self.chunk_names = []
-                    return serialized_file.name
-                self.chunk_names = len(splitsville) * [chunk_name]
+            pipeline = self._make_pipeline(embed)
+            self.chunk_lengths = []
+            self.chunk_token_counts = []
+            self.chunk_names = len(splitsville) * [chunk_name]
+            try:
                 for txt in splitsville:
                     chunk = Chunk(self.size, chunk_name, txt)
                     self.chunks.append(chunk)
                     self.size += 1
                     self.chunk_lengths.append(len(txt))
-                    pickle.dump(chunk, ser)
+                    self.chunk_token_counts.append(get_token_estimate(txt))
+                    pipeline.add(txt, chunk_name)
+            except:
+                pipeline.abort()
+                raise
 
-                return serialized_file.name
+            return pipeline.finish(index_min_chunks=RETRIEVER_ANN_MIN_RESOURCE_CHUNKS)
 
         src = tempfile.NamedTemporaryFile(delete=False)
         download_file(src.name, self.resource_manifest)
@@ -914,34 +1260,42 @@ class ResourceRetriever():
         elif filetype == 'zip':
             raise ZipFileRetrieverError
         else:
-            loader = get_loader(filetype, using_name)
+            loader = get_loader(filetype, using_name, ocr=ocr)
             if not loader and filetype in ocr.accept_formats:
                 using_name = do_ocr(src.name)
                 attempted_ocr = True
                 loader = get_loader(get_extension_from_path(None, using_name), using_name)
             if not loader:
                 raise Exception(f"File type '{filetype}' not recognized in retriever.")
+            # PDFs send just the pages that look scanned to OCR themselves, so there's no need to OCR the whole thing after
+            if isinstance(loader, PdfLoader) and loader.ocr:
+                attempted_ocr = True
 
-        # The file we're storing the chunks and stuff in
-        serialized_file = tempfile.NamedTemporaryFile(delete=False)
+        # Writes the chunks (and embeddings) to the file we're storing them in.
+        # Embeddings start going out right away; in the rare case we need to OCR, they're thrown out, but they're cheap for unreadable text anyway.
+        pipeline = None
         satisfied = False
         tries = 0
-        while not satisfied and tries <= 1:
-            tries += 1
-            total_char_size = 0
-            size = 0
-            chunk_names = []
-            chunk_lengths = []  # in characters
+        try:
+            while not satisfied and tries <= 1:
+                tries += 1
+                total_char_size = 0
+                size = 0
+                chunk_names = []
+                chunk_lengths = []  # in characters
+                chunk_token_counts = []
 
-            data = loader.load_and_split(text_splitter=text_splitter)
+                data = loader.load_and_split(text_splitter=text_splitter)
 
-            bad_doc = False
-            with open(serialized_file.name, 'wb') as ser:
+                bad_doc = False
+                if pipeline:
+                    pipeline.abort()
+                pipeline = self._make_pipeline(embed)
                 for i, x in enumerate(data):
                     txt = x.page_content
                     if i < 3:  # Do some checks to see if the file is readable, in the first two chunks.
                         obfuscated = txt.count('�') > ntokens_to_nchars(self.chunk_size_tokens) // 10
-                        if obfuscated:
+                        if obfuscated and not attempted_ocr:  # otherwise there's nothing more to try, and we'd be left with only these chunks
                             bad_doc = True
                             # For PDFs, we can do something about it.
                             break
@@ -955,9 +1309,10 @@ class ResourceRetriever():
 
                     chunk = Chunk(i, chunk_name, x.page_content)
                     size += 1
-                    pickle.dump(chunk, ser)
+                    pipeline.add(chunk.txt, chunk_name)
                     total_char_size += sum(c.isalnum() for c in x.page_content)
                     chunk_lengths.append(len(x.page_content))
+                    chunk_token_counts.append(get_token_estimate(x.page_content))
                     chunk_names.append(chunk_name)
 
                 chars_per_page = total_char_size / max(len(chunk_names), 1)
@@ -970,9 +1325,14 @@ class ResourceRetriever():
                     attempted_ocr = True
                 else:
                     satisfied = True
-        
+        except:
+            if pipeline:
+                pipeline.abort()
+            raise
+
         self.size = size
         self.chunk_lengths = chunk_lengths
+        self.chunk_token_counts = chunk_token_counts
         self.chunk_names = chunk_names
 
         # Get rid of tempfile of resource
@@ -982,7 +1342,7 @@ class ResourceRetriever():
         if total_char_size < MIN_CHAR_LENGTH_WARN:
             warnings.warn(f"The document {self.resource_manifest['title']} may not be readable; only {total_char_size} characters.")
         
-        return serialized_file.name
+        return pipeline.finish(index_min_chunks=RETRIEVER_ANN_MIN_RESOURCE_CHUNKS)
     
     def make_new_desc(self):
         # Take first 5 chunks
@@ -1005,6 +1365,7 @@ class ResourceRetriever():
             'chunk_names': self.chunk_names,
             'resource_manifest': self.resource_manifest,
             'chunk_lengths': self.chunk_lengths,
+            'chunk_token_counts': self.chunk_token_counts,
             'retriever_type_name': self.retriever_type_name,
             'retriever_options':{
                 'chunk_size_tokens': self.chunk_size_tokens,
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from threading import Lock
+import os
+import sys
+from .utils import make_json_serializable
+from .configs.user_config import RETRIEVER_CACHE_MAX_ENTRIES, RETRIEVER_CACHE_MAX_BYTES
+
+"""
+
+Process-wide cache of loaded resource retrievers.
+
+Loading a ResourceRetriever means a query to asset_retrieval_storage, a download of its chunk file, and reading its names/lengths.
+Once that's done, the local chunk file is handed over to this cache so that the next ResourceRetriever for the same resource
+(with the same type name and options) can skip all of it.
+
+Keys are built by the ResourceRetriever (resource id, retriever_type_name, and the options that consistency_check compares).
+Each entry also remembers the resource manifest it was made from; if the manifest changes, the entry is thrown out.
+
+Entries are evicted least-recently-used first, once there are too many or their files take up too many bytes.
+The cache owns its files: they're deleted on eviction, and ResourceRetrievers using a cached file must not delete it themselves.
+
+"""
+
+
+class CachedResourceRetriever():
+    def __init__(self, chunk_filename, resource_manifest, chunk_names, chunk_lengths, chunk_token_counts) -> None:
+        self.chunk_filename = chunk_filename
+        self.resource_manifest = make_json_serializable(resource_manifest)
+        self.chunk_names = chunk_names
+        self.chunk_lengths = chunk_lengths
+        self.chunk_token_counts = chunk_token_counts
+        try:
+            self.nbytes = os.path.getsize(chunk_filename)
+        except OSError:
+            self.nbytes = 0
+
+    def matches(self, resource_manifest):
+        return self.resource_manifest == make_json_serializable(resource_manifest)
+
+
+class ResourceRetrieverCache():
+    def __init__(self, max_entries, max_bytes) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns a CachedResourceRetriever, or None
+    def get(self, key, resource_manifest):
+        with self.lock:
+            entry: CachedResourceRetriever = self.entries.get(key)
+            if entry is not None and not entry.matches(resource_manifest):
+                self._remove(key)
+                entry = None
+            if entry is None or not os.path.exists(entry.chunk_filename):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # Takes ownership of entry.chunk_filename
+    def put(self, key, entry: CachedResourceRetriever):
+        with self.lock:
+            if key in self.entries:
+                old = self.entries[key]
+                if old.chunk_filename == entry.chunk_filename:
+                    self.entries.move_to_end(key)
+                    return
+                self._remove(key)
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+            self._evict()
+
+    # Drops every entry for a resource (of any type name or options)
+    def invalidate(self, resource_id):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == resource_id]:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    # Should be done with the lock
+    def _evict(self):
+        # Always keep the most recent entry, even if it's too big by itself
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+            oldest_key = next(iter(self.entries))
+            self._remove(oldest_key)
+
+    # Should be done with the lock
+    def _remove(self, key):
+        entry: CachedResourceRetriever = self.entries.pop(key)
+        self.nbytes -= entry.nbytes
+        # Anyone still reading the file through an mmap keeps it alive until they're done
+        try:
+            os.remove(entry.chunk_filename)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Couldn't remove cached retriever file {entry.chunk_filename}: {e}", file=sys.stderr)
+
+
+RESOURCE_RETRIEVER_CACHE = ResourceRetrieverCache(RETRIEVER_CACHE_MAX_ENTRIES, RETRIEVER_CACHE_MAX_BYTES)
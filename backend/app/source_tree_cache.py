@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from threading import Lock
+import copy
+import time
+from .db import ProxyDB, escape_list
+from .configs.str_constants import RETRIEVAL_SOURCE
+from .configs.user_config import SOURCE_TREE_CACHE_MAX_ENTRIES, SOURCE_TREE_CACHE_TTL
+
+"""
+
+Process-wide cache of resolved retrieval source trees (see Template._get_asset_resources_include_retrieval_sources).
+
+Keys are (user id, asset id, excluded ids). An entry remembers which assets went into it:
+- the assets whose retrieval sources were read (the folders along the way),
+- every source the user was allowed to see, and their groups,
+- the sources whose main files were used.
+
+Before an entry is used, it's checked against a fingerprint of those rows in asset_metadata, asset_permissions and asset_resources (count and max id).
+Sources and permissions are only ever changed by deleting and inserting rows, so any change to them changes the fingerprint;
+that's how set_sources (or a permissions change) in any process invalidates the trees that include the asset.
+The fingerprint is one query, rather than a query or two per source.
+
+Entries also expire after SOURCE_TREE_CACHE_TTL, which bounds how long an asset moving between groups can go unnoticed.
+
+"""
+
+
+class CachedSourceTree():
+    def __init__(self, resources, walked_ids, source_ids, group_ids, leaf_ids) -> None:
+        self.resources = resources
+        self.walked_ids = list(walked_ids)
+        self.source_ids = list(source_ids)
+        self.group_ids = list(group_ids)
+        self.leaf_ids = list(leaf_ids)
+        self.fingerprint = None
+        self.time_created = time.time()
+
+    # One row: a count and max id for each table the tree was made from
+    def get_fingerprint(self, db: ProxyDB):
+        def id_list(ids):
+            return escape_list(ids) if len(ids) else "NULL"
+
+        sql = f"""
+        SELECT
+            (SELECT CONCAT(COUNT(*), ':', COALESCE(MAX(`id`), 0)) FROM asset_metadata
+                WHERE `key` = '{RETRIEVAL_SOURCE}' AND `asset_id` IN ({id_list(self.walked_ids)})) AS sources,
+            (SELECT CONCAT(COUNT(*), ':', COALESCE(MAX(`id`), 0)) FROM asset_permissions
+                WHERE `asset_id` IN ({id_list(self.walked_ids + self.source_ids)}) OR `group_id` IN ({id_list(self.group_ids)})) AS permissions,
+            (SELECT CONCAT(COUNT(*), ':', COALESCE(MAX(`id`), 0)) FROM asset_resources
+                WHERE `asset_id` IN ({id_list(self.leaf_ids)})) AS resources
+        """
+        curr = db.cursor()
+        curr.execute(sql)
+        res = curr.fetchone()
+        return (res['sources'], res['permissions'], res['resources'])
+
+
+class SourceTreeCache():
+    def __init__(self, max_entries, ttl) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns a copy of the cached resources, or None
+    def get(self, key, db: ProxyDB):
+        with self.lock:
+            entry: CachedSourceTree = self.entries.get(key)
+            if entry is not None and time.time() - entry.time_created > self.ttl:
+                self.entries.pop(key)
+                entry = None
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # Checked outside the lock, since it's a query
+        if entry.get_fingerprint(db) != entry.fingerprint:
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    self.entries.pop(key)
+                self.misses += 1
+            return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(entry.resources)
+
+    # The fingerprint is taken right after the tree is read, on the same connection; a change landing in between is only caught by the TTL
+    def put(self, key, entry: CachedSourceTree, db: ProxyDB):
+        entry.fingerprint = entry.get_fingerprint(db)
+        entry.resources = copy.deepcopy(entry.resources)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Drops the trees that read this asset's sources
+    def invalidate(self, asset_id):
+        asset_id = int(asset_id)
+        with self.lock:
+            for key in [k for k, v in self.entries.items() if asset_id in v.walked_ids]:
+                self.entries.pop(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+SOURCE_TREE_CACHE = SourceTreeCache(SOURCE_TREE_CACHE_MAX_ENTRIES, SOURCE_TREE_CACHE_TTL)
@@ -25,7 +25,7 @@ def replace_asset_file(from_key, path, tmp_path, use_data=None):
 def upload_retriever(resource_id, file_path, retriever_type_name):
     suggested_path = ["retriever_storage", str(resource_id['id']), retriever_type_name]
     fs: FileStorage = FS_PROVIDERS[DEFAULT_STORAGE_OPTION]
-    db_path = fs.upload_file(suggested_path, file_path, "pkl")
+    db_path = fs.upload_file(suggested_path, file_path, "chunks")  # see chunk_store.py
     return db_path, fs.code
 
 
@@ -7,9 +7,13 @@ import os
 from ..asset_actions import (
     add_asset_resource, upload_asset, get_asset_resource, get_asset, get_asset_resource_by_id,
     get_asset_resources_by_id, delete_asset_resources, get_asset_metadata, save_asset_metadata,
-    add_bulk_asset_metadata, delete_asset_metadata_by_id, set_sources
+    add_bulk_asset_metadata, delete_asset_metadata_by_ids, set_sources
+)
+from ..storage_interface import download_file, upload_asset_file, delete_resources_from_storage
+from ..configs.user_config import (
+    CRAWLER_DB_CACHE_DIR, CRAWLER_DB_CACHE_MAX_BYTES, CRAWLER_DB_MAX_PENDING_COMMITS,
+    CRAWL_MAX_IN_FLIGHT, CRAWL_MAX_PER_DOMAIN, CRAWL_DOMAIN_DELAY, CRAWL_CLAIM_BATCH, CRAWL_FLUSH_EVERY, CRAWL_FLUSH_INTERVAL
 )
-from ..storage_interface import download_file, replace_asset_file, upload_asset_file
 from ..configs.str_constants import MAIN_FILE
 from flask_cors import cross_origin
 from ..auth import token_required, SynthUser, token_optional
@@ -32,6 +36,13 @@ import traceback
 from .website import insert_meta_author, insert_meta_description, insert_meta_url
 from ..prompts.crawler_prompts import get_suggest_from_topic_system, get_scrape_quality_system, get_scrape_quality_user_text, get_scrape_quality_user, get_eval_system, get_eval_user
 import base64
+import hashlib
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
 
 
 bp = Blueprint('crawler', __name__, url_prefix="/crawler")
@@ -204,26 +215,154 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+"""
+
+Crawler databases can be big (tens of thousands of websites), and they're opened on just about every request to a crawler.
+So each machine keeps local copies in CRAWLER_DB_CACHE_DIR, shared by its processes.
+
+Every upload of a crawler database goes to a new path in storage (and its asset_resources row is pointed there), so the path doubles as a version:
+a copy in the cache is named after the path it came from, and so it's only re-downloaded when it's changed.
+
+"""
+class CrawlerDBCache():
+    def __init__(self, directory, max_bytes) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def _prefix(self, asset_id):
+        return f"{asset_id}_"
+
+    def _path_for(self, asset_id, asset_resource):
+        version = hashlib.sha1(f"{asset_resource['from']}:{asset_resource['path']}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{self._prefix(asset_id)}{version}.sqlite3")
+
+    # Files are written next to where they go and then moved into place, so nobody sees a partial copy
+    def _add(self, asset_id, asset_resource, fill):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path_for(asset_id, asset_resource)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            fill(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._clean_up(asset_id, keep=path)
+        return path
+
+    # Returns the path of a local copy of the database in asset_resource, downloading it if needed.
+    # The copy shouldn't be modified.
+    def get(self, asset_id, asset_resource):
+        path = self._path_for(asset_id, asset_resource)
+        try:
+            os.utime(path)  # for eviction
+            return path
+        except FileNotFoundError:
+            pass
+        return self._add(asset_id, asset_resource, lambda tmp_path: download_file(tmp_path, asset_resource))
+
+    # For a database that was just uploaded from local_path
+    def put(self, asset_id, asset_resource, local_path):
+        return self._add(asset_id, asset_resource, lambda tmp_path: shutil.copyfile(local_path, tmp_path))
+
+    # Removes old versions of this asset's database, and then the least recently used files if the cache is too big.
+    # Processes that have a removed file open can keep using it.
+    def _clean_up(self, asset_id, keep):
+        with self.lock:
+            try:
+                entries = []
+                for name in os.listdir(self.directory):
+                    path = os.path.join(self.directory, name)
+                    if path == keep or name.endswith('.part'):
+                        continue
+                    if name.startswith(self._prefix(asset_id)):
+                        os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                total = sum(x[1] for x in entries) + os.path.getsize(keep)
+                for _, size, path in sorted(entries):
+                    if total <= self.max_bytes:
+                        break
+                    os.remove(path)
+                    total -= size
+            except OSError as e:
+                # Another process probably got to it first
+                print(f"Couldn't clean up crawler database cache: {e}", file=sys.stderr)
+
+
+CRAWLER_DB_CACHE = CrawlerDBCache(CRAWLER_DB_CACHE_DIR, CRAWLER_DB_CACHE_MAX_BYTES)
+
+
+@needs_db
+def set_crawler_db_location(resource_id, from_val, path, db=None):
+    sql = """
+    UPDATE asset_resources
+    SET `from`=%s, `path`=%s
+    WHERE `id`=%s
+    """
+    curr = db.cursor()
+    curr.execute(sql, (from_val, path, resource_id))
+
+
+# Read-only opens use the cached copy directly.
+# Otherwise, changes go to a private copy, which is uploaded on close (or every CRAWLER_DB_MAX_PENDING_COMMITS commits) rather than on every commit.
 class CrawlerDB():
     def __init__(self, asset_id, read_only=False, db=None):  # Note that db is an argument, but the class doesn't use needs_db
-        # Somewhat inefficient in that there's no caching
-        # And requires downloading the entire DB
-        res = get_asset_resource(asset_id, MAIN_FILE, db=db)
+        self.asset_id = asset_id
+        self.read_only = read_only
+        self.db = db
+        self.pending_commits = 0  # commits that haven't been uploaded
+        self._open()
+
+    def _get_resource(self):
+        res = get_asset_resource(self.asset_id, MAIN_FILE, db=self.db)
         if res is None:
-            raise Exception(f"Couldn't find any existing crawler database for asset id {asset_id}")
+            raise Exception(f"Couldn't find any existing crawler database for asset id {self.asset_id}")
+        return res
+
+    def _open(self):
+        res = self._get_resource()
+        try:
+            cached_path = CRAWLER_DB_CACHE.get(self.asset_id, res)
+        except Exception as e:
+            # The version we looked up might've just been replaced (and deleted); try again with the latest.
+            print(f"Couldn't get crawler database for asset {self.asset_id} ({e}); trying again", file=sys.stderr)
+            res = self._get_resource()
+            cached_path = CRAWLER_DB_CACHE.get(self.asset_id, res)
         self.asset_resource = res
-        self.db = db
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        download_file(tmp.name, res)
-        self.path = tmp.name
-        conn = sqlite3.connect(self.path)
+
+        if self.read_only:
+            self.path = cached_path
+            self._owns_path = False
+            conn = sqlite3.connect(f"file:{cached_path}?mode=ro", uri=True)
+        else:
+            tmp = tempfile.NamedTemporaryFile(delete=False)
+            tmp.close()
+            shutil.copyfile(cached_path, tmp.name)
+            self.path = tmp.name
+            self._owns_path = True
+            conn = sqlite3.connect(self.path)
         conn.row_factory = dict_factory
         self.conn = conn
-        self.asset_id = asset_id
-        self.read_only = read_only
 
         self._check_version_and_update()
 
+    def _close_conn(self):
+        self.conn.close()
+        if self._owns_path:
+            os.remove(self.path)
+
+    # The database may have been opened before the lock was taken; if someone else changed it in the meantime, start over from theirs.
+    def _reopen_if_stale(self):
+        res = self._get_resource()
+        if res['path'] != self.asset_resource['path'] or res['from'] != self.asset_resource['from']:
+            if self.pending_commits:
+                raise Exception(f"Crawler database for asset {self.asset_id} changed underneath uncommitted changes")
+            self._close_conn()
+            self._open()
+
     def _check_version_and_update(self):
         sql = "PRAGMA user_version"
         res = self.execute(sql)
@@ -284,8 +423,9 @@ class CrawlerDB():
             old_cursor.close()
 
             # Remove the old database and attach new one
-            os.remove(self.path)
+            self._close_conn()
             self.path = db_path
+            self._owns_path = True
             self.conn = new_conn
 
             # Notably, will NOT reupload the DB unless the user commits.
@@ -295,15 +435,34 @@ class CrawlerDB():
         res = CrawlerDBResult(res)
         return res
     
-    # Also reuploads DB
+    # The upload happens later; see upload
     def commit(self, *args, **kwargs):
         self.conn.commit()
-        replace_asset_file(self.asset_resource['from'], self.asset_resource['path'], self.path)
+        self.pending_commits += 1
+        if self.pending_commits >= CRAWLER_DB_MAX_PENDING_COMMITS:
+            self.upload()
+
+    # Uploads the database as a new version, if there are commits that haven't been uploaded yet
+    def upload(self):
+        if not self.pending_commits:
+            return
+        path, from_val = upload_asset_file(self.asset_id, self.path, 'sqlite')
+        set_crawler_db_location(self.asset_resource['id'], from_val, path, db=self.db)
+        old_resource = self.asset_resource
+        self.asset_resource = {**old_resource, 'from': from_val, 'path': path}
+        self.pending_commits = 0
+        try:
+            CRAWLER_DB_CACHE.put(self.asset_id, self.asset_resource, self.path)
+            delete_resources_from_storage([old_resource])
+        except Exception as e:
+            print(f"Couldn't clean up after uploading crawler database for asset {self.asset_id}: {e}", file=sys.stderr)
 
-    # Deletes file in addition to closing connection
+    # Uploads committed changes and deletes the local copy (if it's not the cache's)
     def close(self, *args, **kwargs):
-        self.conn.close(*args, **kwargs)
-        os.remove(self.path)
+        try:
+            self.upload()
+        finally:
+            self._close_conn()
 
     def __enter__(self):
         # Returning the CrawlerDB object like "with CrawlerDB(...) as db:"
@@ -312,6 +471,11 @@ class CrawlerDB():
             has_lock = db_polling_lock(get_crawler_lock_name(self.asset_id), db=self.db)
             if not has_lock:
                 raise Exception(f"Couldn't acquire the lock for CrawlerDB on asset with id {self.asset_id}")
+            try:
+                self._reopen_if_stale()
+            except:
+                db_release_lock(get_crawler_lock_name(self.asset_id), db=self.db)
+                raise
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -399,27 +563,45 @@ class ScrapeEval():
 
 
 # Takes care of opening up the Crawler DB
+# For a crawler database that's already open for writing; the caller commits.
+def insert_crawler_error(crawler: CrawlerDB, website_id, traceback="", stage="", status: int=None):
+    sql = """
+        INSERT INTO errors (`website_id`, `traceback`, `stage`, `status`)
+        VALUES (?, ?, ?, ?)
+    """
+    crawler.execute(sql, (website_id, traceback, stage, status))
+
+
 @needs_db
 def record_error(asset_id, website_id, traceback="", stage="", status: int=None, db=None):
     with CrawlerDB(asset_id, db=db) as crawler:
-        sql = """
-            INSERT INTO errors (`website_id`, `traceback`, `stage`, `status`)
-            VALUES (?, ?, ?, ?)
-        """
-        crawler.execute(sql, (website_id, traceback, stage, status))
+        insert_crawler_error(crawler, website_id, traceback=traceback, stage=stage, status=status)
         crawler.commit()
 
 
-@needs_db
-def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):    
-    
-    item = website_data
-    if not item:
-        with CrawlerDB(asset_id, read_only=True, db=db) as crawler:
-            sql = "SELECT * FROM websites WHERE `id` = ?"
-            res = crawler.execute(sql, (website_id,))
-            item = res.fetchone()
+# What scrape_website found out about a site, to be saved with save_scrape
+class CrawlerScrapeResult():
+    def __init__(self, success, status, meta=None, text="", content_type=None, quality_code=None, eval=None, uploads=[]):
+        self.success = success
+        self.status = status
+        self.meta = meta
+        self.text = text
+        self.content_type = content_type
+        self.quality_code = quality_code
+        self.eval = eval
+        self.uploads = uploads  # (data_type, path, from) for each file uploaded
 
+
+def get_research_topic(user, asset_id, db=None):
+    topic_meta, _ = get_asset_metadata(user, asset_id, keys=[RESEARCH_TOPIC], for_all_users=True, get_total=False, db=db)
+    if len(topic_meta):
+        return topic_meta[0]['value']
+    return None
+
+
+# Scrapes, evaluates, and uploads the data for a website (a row of the websites table), but doesn't touch the crawler database or MySQL.
+# Safe to run in parallel.
+def scrape_website(user, asset_id, item, topic=None):
     # Scrape the site
     try:
         scrape: ScrapeResponse = scrape_with_service(item['url'])
@@ -428,13 +610,12 @@ def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):
         scrape: ScrapeResponse = scrape_with_requests(item['url'])
 
     if not scrape.success:
-        return scrape.success, scrape.status
+        return CrawlerScrapeResult(scrape.success, scrape.status)
 
     content_type = get_mimetype_from_headers(scrape.headers)
     meta: ScrapeMetadata = scrape.metadata
     ext = ext_from_mimetype(meta.content_type)
     MAX_TEXT_LENGTH = 100_000  # in characters
-    db = get_db()
     with scrape.consume_data() as data_path:
         with scrape.consume_screenshots() as (ss_paths, ss_types):
             loader = get_loader(ext, data_path)
@@ -513,11 +694,6 @@ def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):
                 # txt = get_scrape_eval_user_text(scrape.url, text)
                 # system_prompt = get_scrape_quality_system(SCRAPE_QUALITY)
                 try:
-                    topic = None
-                    topic_meta, _ = get_asset_metadata(user, asset_id, keys=[RESEARCH_TOPIC], for_all_users=True, get_total=False)
-                    if len(topic_meta):
-                        topic = topic_meta[0]['value']
-
                     MAX_TRUSTWORTHINESS = 5
                     MAX_RELEVANCE = 5
                     system_prompt = get_eval_system(SOURCE_TYPES, topic, 5, 5)
@@ -541,88 +717,318 @@ def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):
                 except Exception as _:
                     print(f"Comprehensive eval failed:\n {traceback.format_exc()}", file=sys.stderr)
                     quality_code = NO_JUDGEMENT.code
-            
-            # Lock and add to the database
-            with CrawlerDB(asset_id, db=db) as crawler:
-                sql = """
-                    UPDATE websites
-                    SET `title`=?,
-                        `author`=?,
-                        `desc`=?,
-                        `text`=?,
-                        `content_type`=?,
-                        `scrape_quality_code`=?,
-                        `scraped_at`=CURRENT_TIMESTAMP
-                    WHERE `id`=?
-                """
-                crawler.execute(sql, (meta.title, meta.author, meta.desc, text, content_type, quality_code, item['id']))
-
-                # Put in the latest evaluation
-                if eval is not None:
-                    sql = """
-                        DELETE FROM evaluations
-                        WHERE `website_id`=?
-                    """
-                    # Upload and insert the data
-                    sql = """
-                        INSERT INTO evaluations (
-                            `website_id`,
-                            `source_type`,
-                            `trustworthiness`,
-                            `max_trustworthiness`,
-                            `relevance`,
-                            `max_relevance`,
-                            `topic`,
-                            `title`,
-                            `author`,
-                            `desc`
-                        )
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """
-                    crawler.execute(sql, (item['id'], eval.source_type_code, eval.trustworthiness, eval.max_trustworthiness, eval.relevance, eval.max_relevance, eval.topic, eval.title, eval.author, eval.desc))
-
-                # Does old scrape data exist?
-                # If so, delete from storage, asset_resources, and from the crawler db
-                sql = """
-                    SELECT * FROM website_data
-                    WHERE `website_id`=?
-                """
-                res = crawler.execute(sql, (item['id'],))
-                existing_data = res.fetchall()
-                if len(existing_data):
-                    resources = get_asset_resources_by_id(asset_id, [x['resource_id'] for x in existing_data], db=db)
-                    delete_asset_resources(resources, db=db)
-                    sql = """
-                        DELETE FROM website_data
-                        WHERE `website_id`=?
-                    """
-                    crawler.execute(sql, (item['id'],))
-
-                # Upload and insert the data
-                path, from_val = upload_asset_file(asset_id, data_path, ext)
-                assoc_file_id = add_asset_resource(asset_id, 'website', from_val, path, None, db=db)
-
-                sql = """
-                    INSERT INTO website_data (`website_id`, `data_type`, `resource_id`)
-                    VALUES (?, ?, ?)
-                """
-                crawler.execute(sql, (item['id'], 'data', assoc_file_id))
-
-                # Upload any screenshots available
+
+            # Upload the data now, while we have it
+            uploads = []
+            try:
+                uploads.append(('data', *upload_asset_file(asset_id, data_path, ext)))
                 for ss_path in ss_paths:
-                    # Upload and insert the data
-                    path, from_val = upload_asset_file(asset_id, ss_path, 'jpg')
-                    assoc_file_id = add_asset_resource(asset_id, 'website', from_val, path, None, db=db)
+                    uploads.append(('screenshot', *upload_asset_file(asset_id, ss_path, 'jpg')))
+            except:
+                delete_resources_from_storage([{'from': from_val, 'path': path} for _, path, from_val in uploads])
+                raise
+
+    return CrawlerScrapeResult(scrape.success, scrape.status, meta=meta, text=text, content_type=content_type, quality_code=quality_code, eval=eval, uploads=uploads)
+
+
+# Deletes the files scrape_website uploaded for a scrape that won't be saved, along with any asset_resources rows made for them
+@needs_db
+def discard_scrape(result: CrawlerScrapeResult, resource_ids=[], db=None):
+    if len(resource_ids):
+        curr = db.cursor()
+        curr.execute("DELETE FROM asset_resources WHERE `id` IN %s", (tuple(resource_ids),))
+    try:
+        delete_resources_from_storage([{'from': from_val, 'path': path} for _, path, from_val in result.uploads])
+    except Exception as e:
+        print(f"Couldn't delete the uploads of an unsaved scrape: {e}", file=sys.stderr)
+    result.uploads = []
+
+
+# Writes what scrape_website found to the crawler database (which should be open for writing); the caller commits.
+# The crawler database is written first; the new asset_resources rows are only added once that's gone through.
+# Returns (new resource ids, old resources): the caller deletes the old resources once the crawler database is committed,
+# or discards the scrape (with the new ids) if it isn't. If this raises, the scrape has already been discarded.
+def save_scrape(crawler: CrawlerDB, asset_id, item, result: CrawlerScrapeResult, db=None):
+    new_resource_ids = []
+    try:
+        sql = """
+            UPDATE websites
+            SET `title`=?,
+                `author`=?,
+                `desc`=?,
+                `text`=?,
+                `content_type`=?,
+                `scrape_quality_code`=?,
+                `scraped_at`=CURRENT_TIMESTAMP
+            WHERE `id`=?
+        """
+        meta: ScrapeMetadata = result.meta
+        crawler.execute(sql, (meta.title, meta.author, meta.desc, result.text, result.content_type, result.quality_code, item['id']))
+
+        # Put in the latest evaluation
+        eval: ScrapeEval = result.eval
+        if eval is not None:
+            sql = """
+                DELETE FROM evaluations
+                WHERE `website_id`=?
+            """
+            # Upload and insert the data
+            sql = """
+                INSERT INTO evaluations (
+                    `website_id`,
+                    `source_type`,
+                    `trustworthiness`,
+                    `max_trustworthiness`,
+                    `relevance`,
+                    `max_relevance`,
+                    `topic`,
+                    `title`,
+                    `author`,
+                    `desc`
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """
+            crawler.execute(sql, (item['id'], eval.source_type_code, eval.trustworthiness, eval.max_trustworthiness, eval.relevance, eval.max_relevance, eval.topic, eval.title, eval.author, eval.desc))
+
+        # Does old scrape data exist?
+        # If so, it's taken out of the crawler db now, and from storage and asset_resources by the caller
+        sql = """
+            SELECT * FROM website_data
+            WHERE `website_id`=?
+        """
+        res = crawler.execute(sql, (item['id'],))
+        existing_data = res.fetchall()
+        old_resources = []
+        if len(existing_data):
+            old_resources = get_asset_resources_by_id(asset_id, [x['resource_id'] for x in existing_data], db=db)
+            sql = """
+                DELETE FROM website_data
+                WHERE `website_id`=?
+            """
+            crawler.execute(sql, (item['id'],))
 
-                    sql = """
-                        INSERT INTO website_data (`website_id`, `data_type`, `resource_id`)
-                        VALUES (?, ?, ?)
-                    """
-                    crawler.execute(sql, (item['id'], 'screenshot', assoc_file_id))
+        # Insert the (already uploaded) data and screenshots
+        for data_type, path, from_val in result.uploads:
+            assoc_file_id = add_asset_resource(asset_id, 'website', from_val, path, None, db=db)
+            new_resource_ids.append(assoc_file_id)
 
-                crawler.commit()
+            sql = """
+                INSERT INTO website_data (`website_id`, `data_type`, `resource_id`)
+                VALUES (?, ?, ?)
+            """
+            crawler.execute(sql, (item['id'], data_type, assoc_file_id))
+    except:
+        discard_scrape(result, new_resource_ids, db=db)
+        raise
 
-    return scrape.success, scrape.status
+    return new_resource_ids, old_resources
+
+
+@needs_db
+def scrape_for_crawler(user, asset_id, website_id, website_data=None, db=None):    
+    
+    item = website_data
+    if not item:
+        with CrawlerDB(asset_id, read_only=True, db=db) as crawler:
+            sql = "SELECT * FROM websites WHERE `id` = ?"
+            res = crawler.execute(sql, (website_id,))
+            item = res.fetchone()
+
+    result = scrape_website(user, asset_id, item, topic=get_research_topic(user, asset_id, db=db))
+    if not result.success:
+        return result.success, result.status
+
+    # Lock and add to the database
+    new_resource_ids = []
+    try:
+        with CrawlerDB(asset_id, db=db) as crawler:
+            new_resource_ids, old_resources = save_scrape(crawler, asset_id, item, result, db=db)
+            crawler.commit()
+    except:
+        discard_scrape(result, new_resource_ids, db=db)
+        raise
+    # The new data is in, so the old can go
+    delete_asset_resources(old_resources, db=db)
+
+    return result.success, result.status
+
+
+# Works through an asset's scrape queue with several scrapes going at once, since each one spends most of its time waiting on the network.
+# - At most CRAWL_MAX_IN_FLIGHT scrapes run at a time (CRAWL_MAX_PER_DOMAIN per domain), and scrapes of a domain start at least CRAWL_DOMAIN_DELAY seconds apart.
+# - Queue items are claimed CRAWL_CLAIM_BATCH at a time, and only removed from the queue once their results are saved, so a failed job leaves them for the next one.
+# - Results are saved CRAWL_FLUSH_EVERY at a time (or every CRAWL_FLUSH_INTERVAL seconds), in one write to the crawler database.
+class ScrapeQueueCrawler():
+    def __init__(self, user, asset_id, db=None) -> None:
+        self.user = user
+        self.asset_id = asset_id
+        self.db = db
+        self.topic = get_research_topic(user, asset_id, db=db)
+        self.executor = None
+        self.waiting = deque()  # (queue row, website row, domain) claimed but not started
+        self.claimed_ids = set()  # ids of queue rows claimed and not yet removed from the queue
+        self.in_flight = {}  # future -> (queue row, website row, domain)
+        self.domain_counts = {}  # domain -> scrapes in flight
+        self.domain_next_start = {}  # domain -> earliest time the next scrape can start
+        self.results = []  # (queue row, website row, CrawlerScrapeResult or None, traceback or None) not yet saved
+        self.last_flush = time.time()
+        self.queue_empty = False
+
+    def _claim(self):
+        queue, _ = get_asset_metadata(self.user, self.asset_id, keys=[SCRAPE_QUEUE], limit=CRAWL_CLAIM_BATCH + len(self.claimed_ids), get_total=False, for_all_users=True, db=self.db)
+        new_rows = [x for x in queue if x['id'] not in self.claimed_ids]
+        self.queue_empty = not new_rows
+        if not new_rows:
+            return
+
+        website_ids = [int(ScrapeQueueItem(**json.loads(x['value'])).website_id) for x in new_rows]
+        with CrawlerDB(self.asset_id, read_only=True, db=self.db) as crawler:
+            sql = f"SELECT * FROM websites WHERE `id` IN ({','.join(['?' for _ in website_ids])})"
+            res = crawler.execute(sql, website_ids)
+            websites = {x['id']: x for x in res.fetchall()}
+
+        for row, website_id in zip(new_rows, website_ids):
+            self.claimed_ids.add(row['id'])
+            website = websites.get(website_id)
+            if website is None:
+                # Removed from the crawler since it was queued; just take it off the queue.
+                self.results.append((row, None, None, None))
+            else:
+                self.waiting.append((row, website, urlparse(website['url']).netloc.lower()))
+
+    def _scrape(self, website):
+        try:
+            return scrape_website(self.user, self.asset_id, website, topic=self.topic), None
+        except Exception as e:
+            print(f"Error in scrape for crawler: {e}", file=sys.stderr)
+            return None, traceback.format_exc()
+
+    def _can_start(self, domain, now):
+        return self.domain_counts.get(domain, 0) < CRAWL_MAX_PER_DOMAIN and self.domain_next_start.get(domain, 0) <= now
+
+    def _start_ready(self):
+        now = time.time()
+        not_ready = deque()
+        while self.waiting and len(self.in_flight) < CRAWL_MAX_IN_FLIGHT:
+            row, website, domain = self.waiting.popleft()
+            if not self._can_start(domain, now):
+                not_ready.append((row, website, domain))
+                continue
+            self.domain_counts[domain] = self.domain_counts.get(domain, 0) + 1
+            self.domain_next_start[domain] = now + CRAWL_DOMAIN_DELAY
+            self.in_flight[self.executor.submit(self._scrape, website)] = (row, website, domain)
+        not_ready.extend(self.waiting)
+        self.waiting = not_ready
+
+    # How long to wait for a scrape to finish before something else needs doing (None = no limit)
+    def _wait_time(self):
+        now = time.time()
+        times = []
+        if self.results:
+            times.append(self.last_flush + CRAWL_FLUSH_INTERVAL)
+        if len(self.in_flight) < CRAWL_MAX_IN_FLIGHT:
+            for _, _, domain in self.waiting:
+                if self.domain_counts.get(domain, 0) < CRAWL_MAX_PER_DOMAIN:
+                    times.append(self.domain_next_start.get(domain, 0))
+        if not times:
+            return None
+        return max(min(times) - now, .05)
+
+    def _collect(self, timeout):
+        if not self.in_flight:
+            time.sleep(timeout)
+            return
+        done, _ = wait(self.in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+        for fut in done:
+            row, website, domain = self.in_flight.pop(fut)
+            self.domain_counts[domain] -= 1
+            result, tb = fut.result()
+            self.results.append((row, website, result, tb))
+
+    # Saves finished scrapes in one crawler database write, then takes them off the queue
+    def flush(self):
+        if not self.results:
+            return
+        to_save = [x for x in self.results if x[1] is not None]
+        if to_save:
+            saved = []  # (result, new resource ids, old resources)
+            try:
+                with CrawlerDB(self.asset_id, db=self.db) as crawler:
+                    for _, website, result, tb in to_save:
+                        if tb:
+                            insert_crawler_error(crawler, website['id'], stage='call_scrape_for_crawler', traceback=tb)
+                        elif not result.success:
+                            # Means scrape_website handled the error gracefully
+                            insert_crawler_error(crawler, website['id'], stage='scrape_for_crawler_returned_not_success', status=result.status)
+                        else:
+                            # One bad site shouldn't take down the rest of the batch
+                            crawler.execute("SAVEPOINT save_scrape")
+                            try:
+                                new_resource_ids, old_resources = save_scrape(crawler, self.asset_id, website, result, db=self.db)
+                                crawler.execute("RELEASE save_scrape")
+                                saved.append((result, new_resource_ids, old_resources))
+                            except Exception as e:
+                                # save_scrape has discarded the scrape's uploads
+                                print(f"Error saving scrape for crawler: {e}", file=sys.stderr)
+                                crawler.execute("ROLLBACK TO save_scrape")
+                                crawler.execute("RELEASE save_scrape")
+                                insert_crawler_error(crawler, website['id'], stage='save_scrape', traceback=traceback.format_exc())
+                    crawler.commit()
+            except:
+                # None of the batch made it into the crawler database
+                for result, new_resource_ids, _ in saved:
+                    discard_scrape(result, new_resource_ids, db=self.db)
+                raise
+
+            # The new data is in, so the old can go
+            for result, _, _ in saved:
+                result.uploads = []  # saved now; not to be discarded
+            for _, _, old_resources in saved:
+                delete_asset_resources(old_resources, db=self.db)
+
+        done_ids = [row['id'] for row, _, _, _ in self.results]
+        delete_asset_metadata_by_ids(done_ids, db=self.db)
+        self.claimed_ids.difference_update(done_ids)
+        self.results = []
+        self.last_flush = time.time()
+
+    # Deletes the uploads of scrapes that weren't saved (if the job is stopping early)
+    def _discard_unsaved(self):
+        results = [result for _, _, result, _ in self.results]
+        for fut in self.in_flight:
+            if fut.done():
+                results.append(fut.result()[0])
+        for result in results:
+            if result is not None and result.uploads:
+                discard_scrape(result, db=self.db)
+        self.results = []
+        self.in_flight = {}
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            self._discard_unsaved()
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=CRAWL_MAX_IN_FLIGHT) as executor:
+            self.executor = executor
+            while True:
+                if len(self.waiting) < CRAWL_MAX_IN_FLIGHT and not self.queue_empty:
+                    self._claim()
+                self._start_ready()
+
+                if not self.in_flight and not self.waiting:
+                    self.flush()
+                    # Sites might have been queued while we were working
+                    self._claim()
+                    if not self.waiting:
+                        self.flush()
+                        break
+                    continue
+
+                self._collect(self._wait_time())
+                if len(self.results) >= CRAWL_FLUSH_EVERY or (self.results and time.time() - self.last_flush >= CRAWL_FLUSH_INTERVAL):
+                    self.flush()
 
 
 @needs_db
@@ -630,33 +1036,7 @@ def scrape_from_queue_job(user_obj, job_id, asset_id, db=None):
     user = SynthUser(user_obj)
     @job_error_wrapper(job_id)
     def do_job():
-        # Get first job from queue
-        # Scrape the site
-        # Save into crawler DB
-        # Remove from the queue
-        # repeat until queue empty
-        queue, _ = get_asset_metadata(user, asset_id, keys=[SCRAPE_QUEUE], limit=100, get_total=False, for_all_users=True, db=db)
-        while len(queue):
-            to_scrape = queue[0]
-            to_scrape_obj = json.loads(to_scrape['value'])
-            queue_item = ScrapeQueueItem(**to_scrape_obj)
-            try:
-                # This not only scrapes but also saves the data in the crawler db
-                success, status = scrape_for_crawler(user, asset_id, queue_item.website_id, db=db)
-            except Exception as e:
-                print(f"Error in scrape for crawler: {e}", file=sys.stderr)
-                record_error(asset_id, queue_item.website_id, stage='call_scrape_for_crawler', traceback=traceback.format_exc(), db=db)
-                success = True
-            if not success:
-                # Means scrape_for_crawler handed error gracefully
-                record_error(asset_id, queue_item.website_id, stage='scrape_for_crawler_returned_not_success', status=status, db=db)
-
-            # Remove from the queue
-            delete_asset_metadata_by_id(to_scrape['id'], db=db)
-
-            queue, _ = get_asset_metadata(user, asset_id, keys=[SCRAPE_QUEUE], limit=100, get_total=False, for_all_users=True, db=db)
-            # Use the filter in case the change doesn't commit fast enough
-            queue = [x for x in filter(lambda x: x['id'] != to_scrape['id'], queue)]
+        ScrapeQueueCrawler(user, asset_id, db=db).run()
 
     do_job()
     complete_job(job_id)
@@ -1,8 +1,9 @@
-from ..configs.user_config import MAX_PDF_PAGES
+from ..configs.user_config import MAX_PDF_PAGES, FOLDER_EXPORT_MAX_WORKERS, FOLDER_EXPORT_CHUNK_SIZE
 from ..exceptions import PdfTooLongError
-from ..db import needs_db
+from ..db import needs_db, escape_string, escape_list
 from ..utils import get_extension_from_path, remove_ext, is_valid_email
-from ..asset_actions import upload_asset, set_sources, delete_asset_resources
+from ..asset_actions import upload_asset, set_sources, delete_asset_resources, get_assets
+from ..storage_interface import download_file
 from ..auth import get_permissioning_string, User, token_required
 from ..db import get_db
 from ..template_response import MyResponse
@@ -11,7 +12,9 @@ from flask import (
     request,
     request,
     send_file,
-    Blueprint
+    Blueprint,
+    Response,
+    stream_with_context
 )
 from flask_cors import cross_origin
 from ..asset_actions import get_asset
@@ -19,8 +22,12 @@ from ..configs.str_constants import *
 from .template import Template
 import json
 import tempfile
-import shutil
 import sys
+import io
+import unicodedata
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import quote
 from ..prompts.prompt_fragments import get_basic_ai_identity, get_citation_prompt
 
 
@@ -48,9 +55,9 @@ def manifest(user: User):
     else:
         limit = int(limit)
 
-    escaped_email = user.email
-    user_id = user.user_id
-    email_domain = db.escape_string(escaped_email.split("@")[1]) if is_valid_email(escaped_email) else "localhost"
+    escaped_email = escape_string(user.email)
+    user_id = escape_string(user.user_id)
+    email_domain = escape_string(user.email.split("@")[1]) if is_valid_email(user.email) else "localhost"
 
     sql = f"""
     WITH ass AS (
@@ -58,7 +65,7 @@ def manifest(user: User):
             MAX(
                 CASE
                     WHEN (
-                        a.creator_id = '{user.user_id}' OR a.id IN (
+                        a.creator_id = '{user_id}' OR a.id IN (
                             SELECT asset_id
                             FROM asset_permissions
                             WHERE (email_domain = '{escaped_email}' OR email_domain = '{email_domain}' OR user_id LIKE '{user_id}') AND can_edit = 1
@@ -70,7 +77,7 @@ def manifest(user: User):
             ) AS has_edit_permission
         FROM assets a
         WHERE a.template = 'folder' AND (
-            a.creator_id = '{user.user_id}'
+            a.creator_id = '{user_id}'
             OR a.id IN (
                 SELECT asset_id
                 FROM asset_permissions
@@ -145,6 +152,7 @@ class Folder(Template):
         self.chattable = True
         self.summarizable = False
         self.make_retriever_on_upload = False
+        self.resources_are_retrieval_sources = True
         self.code = "folder"
 
 
@@ -217,95 +225,232 @@ class Folder(Template):
 
         return True, asset_id
 
+    # Lists what goes in the zip, with subfolders as directories inside it (rec_calls cuts cycles, as before)
+    # Files are fetched later; this is just the queries.
     @needs_db
-    def get_file(self, user, asset_id, only_headers=False, rec_calls=[], ret_resp=True, name="", db=None):
+    def _list_zip_entries(self, user, asset_id, prefix="", rec_calls=[], used_names=None, db=None):
+        from .templates import get_template_by_code  # lazy importing to break circular dependency
 
-        rec_calls = rec_calls + [asset_id]
+        rec_calls = rec_calls + [int(asset_id)]
+        used_names = used_names if used_names is not None else set()
 
         curr = db.cursor()
-
-        this_asset = get_asset(user, asset_id)
-
-        dirpath = tempfile.mkdtemp()
-
-        # Just top level to start
-        rec_str =  f"AND (NOT `value` IN ({','.join([str(x) for x in rec_calls])}))" if len(rec_calls) > 0 else ""
         sql = f"""
-            SELECT * FROM asset_metadata
-            WHERE `key`='{RETRIEVAL_SOURCE}' AND `asset_id`=%s {rec_str}
+            SELECT `value` FROM asset_metadata
+            WHERE `key`='{RETRIEVAL_SOURCE}' AND `asset_id`=%s
+            ORDER BY `id`
         """
         curr.execute(sql, (asset_id,))
-        top_level = curr.fetchall()
-
-        permissioning_string = get_permissioning_string(user)
-    
-        for source_id in map(lambda x: x['value'], top_level):
+        source_ids = [int(x['value']) for x in curr.fetchall()]
+        source_ids = [x for x in source_ids if x not in rec_calls]
+        asset_rows = get_assets(user, source_ids, db=db, no_commit=True)
+
+        # Main files of everything that uses the default get_file, newest first like Template.get_file
+        plain_ids = [x['id'] for x in asset_rows if type(get_template_by_code(x['template'])).get_file is Template.get_file]
+        main_files = {}
+        if len(plain_ids):
             sql = f"""
-                    WITH a as (
-                        SELECT *
-                        FROM assets
-                        WHERE `id` = %s
-                    )
-                    SELECT DISTINCT a.* FROM a
-                    LEFT JOIN asset_permissions ap ON a.id = ap.asset_id OR a.group_id = ap.group_id
-                    WHERE {permissioning_string}
-                    """
-            curr.execute(sql, (source_id,))
-            asset_row = curr.fetchone()
-            if not asset_row:
-                continue
-
-            from .templates import get_template_by_code  # lazy importing to break circular dependency
+                SELECT * FROM asset_resources
+                WHERE `asset_id` IN ({escape_list(plain_ids)}) AND `name` LIKE '{MAIN_FILE}'
+                ORDER BY `time_uploaded` DESC
+            """
+            curr.execute(sql)
+            for res in curr.fetchall():
+                main_files.setdefault(res['asset_id'], res)
+
+        entries = []
+        for asset_row in asset_rows:
             tmp: Template = get_template_by_code(asset_row['template'])
-            
-            # It's possible that if get_file fails, it will return a Response 500 instead of a file
-            # This will cause an error in get_extension_from_path that yields the desired effect (error) anyway.
-            nested_fname = tmp.get_file(user, asset_row['id'], rec_calls=rec_calls, ret_resp=False, db=db)
-            if not nested_fname:  # if it couldn't find a file (and didn't through an error)
-                continue
+            if tmp.code == self.code:
+                dirname = _unique_zip_name(used_names, prefix + _zip_title(asset_row['title'])) + "/"
+                entries.append(ZipEntry(dirname))
+                entries.extend(self._list_zip_entries(user, asset_row['id'], prefix=dirname, rec_calls=rec_calls, used_names=used_names, db=db, no_commit=True))
+            elif asset_row['id'] in plain_ids:
+                res = main_files.get(asset_row['id'])
+                if not res:
+                    continue
+                ext = get_extension_from_path(None, res['path'])
+                entries.append(ZipEntry(_unique_zip_name(used_names, prefix + _zip_title(asset_row['title']), ext), resource=res))
+            else:
+                entries.append(ZipEntry(prefix + _zip_title(asset_row['title']), template=tmp, asset_row=asset_row, rec_calls=rec_calls))
+        return entries
+
+    # Yields after each piece written to fileobj, so that a caller streaming it can send what's there
+    def _write_zip(self, user, fileobj, entries):
+        used_names = set([x.name for x in entries if x.resource or x.is_dir])
+        with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for entry in [x for x in entries if x.is_dir]:
+                zf.writestr(entry.name, b"")
+            yield
+
+            # Downloads go a few at a time, and each one is written (and its temp file removed) as soon as it's in
+            to_download = [x for x in entries if x.resource]
+            others = [x for x in entries if x.template]
+            pending = set()
+            next_i = 0
+            with ThreadPoolExecutor(max_workers=FOLDER_EXPORT_MAX_WORKERS) as executor:
+                try:
+                    while next_i < len(to_download) or len(pending):
+                        while next_i < len(to_download) and len(pending) < FOLDER_EXPORT_MAX_WORKERS:
+                            pending.add(executor.submit(_download_zip_entry, to_download[next_i]))
+                            next_i += 1
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            entry, path = future.result()
+                            if path:
+                                yield from _write_zip_file(zf, path, entry.name)
+                finally:
+                    # Stopped early (like if the client went away): don't leave downloads behind
+                    for future in pending:
+                        if not future.cancel():
+                            _, path = future.result()
+                            if path:
+                                os.remove(path)
+
+            # Templates with their own get_file make their files here, where there's a database connection
+            for entry in others:
+                path = entry.template.get_file(user, entry.asset_row['id'], rec_calls=entry.rec_calls, ret_resp=False)
+                if not path:  # if it couldn't find a file (and didn't through an error)
+                    continue
+                name = _unique_zip_name(used_names, entry.name, get_extension_from_path(None, path))
+                yield from _write_zip_file(zf, path, name)
+        yield
+
+    # The zip is streamed out as it's made: the response starts right away, and only a few files are on disk at a time
+    # With ret_resp=False, it's written to a temporary file whose path is returned
+    @needs_db
+    def get_file(self, user, asset_id, only_headers=False, rec_calls=[], ret_resp=True, name="", db=None):
 
-            # Extracting file information, such as the name:
-            filename = asset_row['title'] + "." + get_extension_from_path(None, nested_fname)
+        this_asset = get_asset(user, asset_id)
+        if not this_asset:
+            if ret_resp:
+                return MyResponse(False, reason=f"No folder found with id {asset_id}", status=404).to_json()
+            return None
 
-            path = os.path.join(dirpath, filename)
+        download_name = this_asset['title'] + ".zip"
+        if ret_resp and only_headers:
+            response = send_file(io.BytesIO(b''), mimetype="application/zip", download_name=download_name)
+            response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition'
+            return response
 
-            # Copy into our directory
-            with open(nested_fname, 'rb') as fhand:
-                with open(path, 'wb') as temp_fhand:
-                    shutil.copyfileobj(fhand, temp_fhand)
+        entries = self._list_zip_entries(user, asset_id, rec_calls=rec_calls, db=db, no_commit=True)
 
-            # Remove the source
-            os.remove(nested_fname)
+        if not ret_resp:
+            zip_tmp_path = tempfile.mktemp(suffix=".zip")
+            try:
+                with open(zip_tmp_path, 'wb') as fhand:
+                    for _ in self._write_zip(user, fhand, entries):
+                        pass
+            except Exception:
+                os.remove(zip_tmp_path)
+                raise
+            return zip_tmp_path
 
-            if filename[-4:] == ".zip":
-                try:
-                    shutil.unpack_archive(path, path[:-4])
-                    os.remove(path)
-                except Exception as e:
-                    print(f"Error unzipping file. Details: {e}", file=sys.stderr)
+        def generate():
+            output = _ZipOutput()
+            for _ in self._write_zip(user, output, entries):
+                data = output.take()
+                if data:
+                    yield data
 
-        zip_tmp_path = tempfile.mktemp(suffix=".zip")
+        response = Response(stream_with_context(generate()), mimetype="application/zip")
+        response.headers.set('Content-Disposition', 'attachment', **_attachment_filename(download_name))
+        response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition'
+        return response
 
-        shutil.make_archive(zip_tmp_path[:-4], 'zip', dirpath)
 
-        shutil.rmtree(dirpath)
+    def get_asset_resources(self, *args, **kwargs):
+        return super()._get_asset_resources_include_retrieval_sources(*args, **kwargs)
 
-        if ret_resp:
-            try:
-                response = send_file(zip_tmp_path, mimetype="application/zip", download_name=this_asset['title']+".zip")
-                response.headers['Access-Control-Expose-Headers'] = 'Content-Disposition'
 
-                # I used to have cleanup code here, but I got errors saying that there were no files to cleanup
-                # So I suppose I don't need it.
+"""
 
-                return response
-            finally:
-                os.remove(zip_tmp_path)
-        
-        # Return filename
-        return zip_tmp_path
+Helpers for downloading a folder as a zip (Folder.get_file)
 
+"""
+
+# A file or directory in a folder's zip
+class ZipEntry():
+    def __init__(self, name, resource=None, template=None, asset_row=None, rec_calls=[]) -> None:
+        self.name = name  # path inside the zip; for template entries, without the extension (it comes from the file)
+        self.resource = resource  # asset_resources row to download
+        self.template = template  # or, a template whose get_file makes the file
+        self.asset_row = asset_row
+        self.rec_calls = rec_calls
+        self.is_dir = name.endswith("/")
 
-    def get_asset_resources(self, *args, **kwargs):
-        return super()._get_asset_resources_include_retrieval_sources(*args, **kwargs)
 
+# Writable end of a streamed zip: holds what's been written until the generator takes it
+class _ZipOutput(io.RawIOBase):
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        return len(b)
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+# A title as a file or directory name (a slash would make a directory)
+def _zip_title(title):
+    return str(title).replace("/", "-")
+
+
+# Zips don't like two entries with the same path (titles aren't unique), so later ones get a number
+def _unique_zip_name(used_names, base, ext=""):
+    suffix = "." + ext if ext else ""
+    name = base + suffix
+    i = 2
+    while name in used_names or name + "/" in used_names:
+        name = f"{base} ({i}){suffix}"
+        i += 1
+    used_names.add(name)
+    return name
+
+
+# Runs in a worker thread; returns (entry, temp file path or None)
+def _download_zip_entry(entry: ZipEntry):
+    ext = get_extension_from_path(None, entry.resource['path'])
+    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix="."+ext)
+    temp_file.close()
+    try:
+        download_file(temp_file.name, entry.resource)
+        return entry, temp_file.name
+    except Exception as e:
+        print(f"Couldn't download {entry.name} for zip: {e}", file=sys.stderr)
+        os.remove(temp_file.name)
+        return entry, None
+
+
+# Copies the file into the zip a chunk at a time (yielding after each), then removes it
+def _write_zip_file(zf: zipfile.ZipFile, path, name):
+    try:
+        zinfo = zipfile.ZipInfo.from_file(path, arcname=name)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        with open(path, 'rb') as src:
+            with zf.open(zinfo, 'w') as dest:
+                while True:
+                    chunk = src.read(FOLDER_EXPORT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield
+    finally:
+        os.remove(path)
+
+
+# Content-Disposition parameters, as send_file makes them (RFC 5987 for non-ASCII names)
+def _attachment_filename(filename):
+    try:
+        filename.encode("ascii")
+        return {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='!#$&+^`|~')}"}
@@ -21,9 +21,12 @@ from ..storage_interface import make_synthetic_resource
 import sys
 from flask_socketio import Namespace, emit, join_room, leave_room, rooms
 import hashlib
+import copy
+from collections import OrderedDict
+from threading import Lock
 from ..utils import text_from_html, get_token_estimate, get_current_utc_time
 from ..integrations.lm import LM, LM_PROVIDERS, FAST_CHAT_MODEL, get_safe_retrieval_context_length
-from ..configs.user_config import APP_NAME
+from ..configs.user_config import APP_NAME, NOTEBOOK_COMPACT_EVERY, NOTEBOOK_CACHE_MAX_ENTRIES
 from ..prompts.prompt_fragments import get_basic_ai_identity, get_citation_prompt
 from ..utils import get_unique_id
 
@@ -172,14 +175,212 @@ def hash_state(state):
     return hashlib.sha256(state_str.encode('utf-8')).hexdigest()
 
 
+"""
+
+Notebooks are saved as block operations.
+
+A notebook is a snapshot (ASSET_STATE in asset_metadata, which records the version it's at) plus the ops saved since then, in notebook_ops.
+Each save is a list of ops made against a version the client has seen, and becomes the next version:
+- {'type': 'insert', 'block': block, 'after': block id, or None for the top}
+- {'type': 'update', 'block': block}  (replaces the block with the same id)
+- {'type': 'delete', 'id': block id}
+- {'type': 'move', 'id': block id, 'after': block id or None}
+- {'type': 'set', 'key': 'keyPoints' or 'outline', 'value': ...}
+
+If a block (or key) an op touches was changed after the client's version, the whole save is refused and the client gets the notebook to merge, as before.
+Otherwise only the ops are written and broadcast to the room (ops_update); every NOTEBOOK_COMPACT_EVERY versions the snapshot is rewritten.
+Each process keeps recently used notebooks in memory, checked against the latest version in notebook_ops before use, so saves don't reread the notebook.
+
+"""
+
+NOTEBOOK_KEYS = ['keyPoints', 'outline']  # the parts of the state besides blocks that ops can set
+NOTEBOOK_LOAD_ATTEMPTS = 3
+
+
+def _block_index(blocks, block_id):
+    for i, block in enumerate(blocks):
+        if block['id'] == block_id:
+            return i
+    return None
+
+
+# Puts the block after the one with id "after" (at the top if None, at the bottom if that block's gone)
+def _place_block(blocks, block, after):
+    if after is None:
+        blocks.insert(0, block)
+        return
+    i = _block_index(blocks, after)
+    if i is None:
+        blocks.append(block)
+    else:
+        blocks.insert(i + 1, block)
+
+
+class LoadedNotebook():
+    def __init__(self, state, snapshot_version) -> None:
+        self.state = state
+        self.version = snapshot_version
+        self.snapshot_version = snapshot_version
+        self.history_from = snapshot_version  # changed_at only knows about changes after this version
+        self.changed_at = {}  # ('block', id) or ('key', name) -> the version that last changed it
+        self.lock = Lock()  # for changing state in this process; saves across processes use with_lock
+
+    # Whether ops made against base_version can go in without undoing changes the client hasn't seen
+    def can_apply(self, ops, base_version):
+        if base_version > self.version:
+            return False
+        ids = set([x['id'] for x in self.state['blocks']])
+        for op in ops:
+            op_type = op['type']
+            if op_type == 'insert':
+                if op['block']['id'] in ids:
+                    return False
+                ids.add(op['block']['id'])
+                continue
+            elif op_type == 'set':
+                if op['key'] not in NOTEBOOK_KEYS:
+                    return False
+                target = ('key', op['key'])
+            elif op_type == 'update':
+                if op['block']['id'] not in ids:
+                    return False  # deleted by someone else
+                target = ('block', op['block']['id'])
+            elif op_type in ('delete', 'move'):
+                if op['id'] not in ids:
+                    continue  # already gone
+                target = ('block', op['id'])
+            else:
+                return False
+            changed = self.changed_at.get(target, 0 if base_version >= self.history_from else self.history_from)
+            if changed > base_version:
+                return False
+        return True
+
+    # Returns whether the notebook's sources might have changed
+    def apply(self, ops, version):
+        blocks = self.state['blocks']
+        sources_changed = False
+        for op in ops:
+            op_type = op['type']
+            if op_type == 'set':
+                self.state[op['key']] = op['value']
+                self.changed_at[('key', op['key'])] = version
+                continue
+
+            block_id = op['block']['id'] if op_type in ('insert', 'update') else op['id']
+            i = _block_index(blocks, block_id) if op_type != 'insert' else None
+            if op_type == 'insert':
+                _place_block(blocks, op['block'], op.get('after'))
+                sources_changed = sources_changed or get_block_by_type(op['block']['type']).has_sources
+            elif op_type == 'update' and i is not None:
+                sources_changed = sources_changed or get_block_by_type(op['block']['type']).has_sources
+                blocks[i] = op['block']
+            elif op_type == 'delete' and i is not None:
+                sources_changed = sources_changed or get_block_by_type(blocks[i]['type']).has_sources
+                blocks.pop(i)
+            elif op_type == 'move' and i is not None:
+                _place_block(blocks, blocks.pop(i), op.get('after'))
+            self.changed_at[('block', block_id)] = version
+        self.version = version
+        return sources_changed
+
+
+# Block ops that turn one notebook state into another; for clients that still save the whole notebook
+def diff_notebook_states(old, new):
+    ops = []
+    old_blocks = {x['id']: x for x in old['blocks']}
+    new_ids = set([x['id'] for x in new['blocks']])
+    for block in old['blocks']:
+        if block['id'] not in new_ids:
+            ops.append({'type': 'delete', 'id': block['id']})
+
+    order = [x['id'] for x in old['blocks'] if x['id'] in new_ids]
+    after = None
+    for i, block in enumerate(new['blocks']):
+        if i >= len(order) or order[i] != block['id']:
+            if block['id'] in old_blocks:
+                order.remove(block['id'])
+                ops.append({'type': 'move', 'id': block['id'], 'after': after})
+            else:
+                ops.append({'type': 'insert', 'block': block, 'after': after})
+            order.insert(i, block['id'])
+        if block['id'] in old_blocks and old_blocks[block['id']] != block:
+            ops.append({'type': 'update', 'block': block})
+        after = block['id']
+
+    for key in NOTEBOOK_KEYS:
+        if key in new and new[key] != old.get(key):
+            ops.append({'type': 'set', 'key': key, 'value': new[key]})
+    return ops
+
+
+NOTEBOOK_CACHE_LOCK = Lock()
+NOTEBOOK_CACHE = OrderedDict()  # asset id -> LoadedNotebook
+
+
+# Not permissioned!
+# The notebook at its latest version (snapshot + ops), or None if it doesn't have any state yet
+# The LoadedNotebook is shared; use its lock when reading or changing the state.
+@needs_db
+def load_notebook(asset_id, db=None) -> LoadedNotebook:
+    asset_id = int(asset_id)
+    curr = db.cursor()
+    curr.execute("SELECT MAX(`version`) AS version FROM notebook_ops WHERE `asset_id`=%s", (asset_id,))
+    latest = curr.fetchone()['version'] or 0
+    with NOTEBOOK_CACHE_LOCK:
+        cached: LoadedNotebook = NOTEBOOK_CACHE.get(asset_id)
+        if cached is not None and cached.version == latest:
+            NOTEBOOK_CACHE.move_to_end(asset_id)
+            return cached
+
+    loaded = None
+    for _ in range(NOTEBOOK_LOAD_ATTEMPTS):
+        sql = """
+        SELECT `value` FROM asset_metadata
+        WHERE `asset_id`=%s AND `key`=%s
+        ORDER BY `time_uploaded` DESC, `id` DESC
+        LIMIT 1
+        """
+        curr.execute(sql, (asset_id, ASSET_STATE))
+        res = curr.fetchone()
+        if not res and not latest:
+            return None
+        state = json.loads(res['value']) if res else copy.deepcopy(get_notebook_state(blocks=[]))
+        loaded = LoadedNotebook(state, state.pop('version', 0))
+
+        curr.execute("SELECT `version`, `ops` FROM notebook_ops WHERE `asset_id`=%s AND `version`>%s ORDER BY `version`", (asset_id, loaded.version))
+        rows = curr.fetchall()
+        if len(rows) and rows[0]['version'] != loaded.version + 1:
+            loaded = None  # compacted between the two reads
+            continue
+        for row in rows:
+            loaded.apply(json.loads(row['ops']), row['version'])
+        break
+
+    if loaded is None:
+        raise Exception(f"Couldn't load a consistent version of notebook {asset_id}")
+
+    with NOTEBOOK_CACHE_LOCK:
+        NOTEBOOK_CACHE[asset_id] = loaded
+        NOTEBOOK_CACHE.move_to_end(asset_id)
+        while len(NOTEBOOK_CACHE) > NOTEBOOK_CACHE_MAX_ENTRIES:
+            NOTEBOOK_CACHE.popitem(last=False)
+    return loaded
+
+
 # no_update determines whether get_notebook will try to update the sources (sometimes not important)
+# Returns (state, version) with with_version=True
 @needs_db
-def get_notebook(user: User, asset_id, no_update=False, db=None):
-    results, _ = get_asset_metadata(user, asset_id, [ASSET_STATE], get_total=False, db=db, no_commit=True)
-    if not results or not len(results):
-        return None
-    
-    res = json.loads(results[0]['value'])
+def get_notebook(user: User, asset_id, no_update=False, with_version=False, db=None):
+    if not get_asset(user, asset_id, db=db, no_commit=True):
+        return (None, 0) if with_version else None
+
+    loaded = load_notebook(asset_id, db=db, no_commit=True)
+    if not loaded:
+        return (None, 0) if with_version else None
+    with loaded.lock:
+        res = copy.deepcopy(loaded.state)
+        version = loaded.version
 
     # Update asset manifests for potentially updated assets
     if not no_update:
@@ -206,10 +407,12 @@ def get_notebook(user: User, asset_id, no_update=False, db=None):
 
             res['blocks'] = new_blocks
             
-    return res
+    return (res, version) if with_version else res
 
+
+# Saves a list of ops made against base_version (see above). For clients that send the whole notebook, legacy_value is that, and prev_hash is its hash_state.
 @needs_special_db(exclusive_conn=True)
-def save_notebook_socket(user: User, asset_id, val, prev_hash, db=None):
+def save_notebook_socket(user: User, asset_id, ops, base_version, legacy_value=None, prev_hash=None, db=None):
     
     def callback(data):
         emit('save_response', data)
@@ -217,7 +420,7 @@ def save_notebook_socket(user: User, asset_id, val, prev_hash, db=None):
     if not asset_id:
         callback({'status': 'failed', 'reason': 'Missing asset id'})
         return
-    if not val:
+    if ops is None and not legacy_value:
         callback({'status': 'failed', 'reason': 'Missing value'})
         return
     
@@ -225,30 +428,82 @@ def save_notebook_socket(user: User, asset_id, val, prev_hash, db=None):
     if not asset_row:
         return MyResponse(False, reason=f"Cannot find asset with id {asset_id}").to_json()
 
+    # What a client that's behind gets back to merge with; same as /notebook/get
+    def fail():
+        res, version = get_notebook(user, asset_id, with_version=True, db=db, no_commit=True)
+        callback({'status': 'failed', 'value': res, 'hash': hash_state(res), 'version': version})
+
     @with_lock(f'nb_save_{asset_id}', db=db)
     def do_save():
-        # Check previous version / hash TODO
-        res = get_notebook(user, asset_id, db=db)  # don't need latest versions of assets honestly tho
-        hashed = hash_state(res) if res else ""
-
-        if hashed and prev_hash != hashed:
-            callback({'status': 'failed', 'value': res, 'hash': hashed})
+        nonlocal ops, base_version
+        if legacy_value is not None:
+            # Whole notebook: the client has to have the latest version, as before, and it's saved as the difference
+            res, version = get_notebook(user, asset_id, with_version=True, db=db, no_commit=True)
+            hashed = hash_state(res) if res else ""
+            if hashed and prev_hash != hashed:
+                callback({'status': 'failed', 'value': res, 'hash': hashed, 'version': version})
+                return
+
+        loaded = load_notebook(asset_id, db=db, no_commit=True)
+        if loaded is None:
+            loaded = LoadedNotebook(copy.deepcopy(get_notebook_state(blocks=[])), 0)
+
+        with loaded.lock:
+            if legacy_value is not None:
+                ops = diff_notebook_states(loaded.state, legacy_value)
+                base_version = loaded.version
+
+            can_apply = loaded.can_apply(ops, base_version)
+            if can_apply and not len(ops):
+                callback({'status': 'success', 'version': loaded.version, 'hash': hash_state(legacy_value) if legacy_value is not None else None})
+                return
+            if can_apply:
+                try:
+                    version = loaded.version + 1
+                    sources_changed = loaded.apply(ops, version)
+
+                    curr = db.cursor()
+                    sql = """
+                    INSERT INTO notebook_ops (`asset_id`, `version`, `user_id`, `ops`)
+                    VALUES (%s, %s, %s, %s)
+                    """
+                    curr.execute(sql, (asset_id, version, user.user_id, json.dumps(ops)))
+
+                    if sources_changed:
+                        # Go through blocks and pick out assets to set sources
+                        source_ids = []
+                        for block in loaded.state['blocks']:
+                            block_type: BlockType = get_block_by_type(block['type'])
+                            if block_type.has_sources:
+                                source_ids.extend([x['id'] for x in block_type.get_sources(block)])
+                        set_sources(user, asset_id, source_ids, db=db, no_commit=True)
+
+                    if version - loaded.snapshot_version >= NOTEBOOK_COMPACT_EVERY:
+                        # Ops up to the previous snapshot can go; the ones after it are kept for anyone who read that snapshot a moment ago
+                        save_asset_metadata(user, asset_id, ASSET_STATE, json.dumps({**loaded.state, 'version': version}), replace_all=True, db=db, no_commit=True)
+                        curr.execute("DELETE FROM notebook_ops WHERE `asset_id`=%s AND `version`<=%s", (asset_id, loaded.snapshot_version))
+                        loaded.snapshot_version = version
+
+                    db.commit()  # the writes above are only sent now, so this is where they'd fail
+                except:
+                    # The cached state has ops that weren't saved
+                    with NOTEBOOK_CACHE_LOCK:
+                        NOTEBOOK_CACHE.pop(int(asset_id), None)
+                    raise
+
+                hashed_val = hash_state(legacy_value) if legacy_value is not None else None
+
+        if not can_apply:
+            fail()
             return
 
-        # Go through blocks in val and pick out assets to set sources
-        source_ids = []
-        for block in val['blocks']:
-            block_type: BlockType = get_block_by_type(block['type'])
-            if block_type.has_sources:
-                source_ids.extend([x['id'] for x in block_type.get_sources(block)])
+        with NOTEBOOK_CACHE_LOCK:
+            NOTEBOOK_CACHE[int(asset_id)] = loaded
+            NOTEBOOK_CACHE.move_to_end(int(asset_id))
 
-        set_sources(user, asset_id, source_ids, db=db, no_commit=True)
-
-        save_asset_metadata(user, asset_id, ASSET_STATE, json.dumps(val), replace_all=True, db=db)  # commits
-        hashed_val = hash_state(val)
-        callback({'status': 'success', 'hash': hashed_val})
-        # Send update to the room
-        emit('value_update', {'value': val, 'hash': hashed_val}, include_self=False, room=str(asset_id))
+        callback({'status': 'success', 'version': version, 'hash': hashed_val})
+        # Send the ops to the room
+        emit('ops_update', {'ops': ops, 'base_version': version - 1, 'version': version}, include_self=False, room=str(asset_id))
 
     do_save()
 
@@ -283,10 +538,10 @@ def get_notebook_endpoint(user: User):
     if not asset_row:
         return MyResponse(False, reason=f'Asset with id "{asset_id}" not found').to_json()
     
-    res = get_notebook(user, asset_id)
+    res, version = get_notebook(user, asset_id, with_version=True)
     hashed = hash_state(res)
     
-    return MyResponse(True, {'result': res, 'hash': hashed}).to_json()
+    return MyResponse(True, {'result': res, 'hash': hashed, 'version': version}).to_json()
 
 
 @needs_db
@@ -447,6 +702,11 @@ class Notebook(Template):
         
         return attached_resources
 
+    def delete(self, curr, asset_manifest):
+        curr.execute("DELETE FROM notebook_ops WHERE `asset_id`=%s", (asset_manifest['id'],))
+        with NOTEBOOK_CACHE_LOCK:
+            NOTEBOOK_CACHE.pop(int(asset_manifest['id']), None)
+
 
     def build_chat_system_prompt(self, question, sources, extra_instructions="", src_title="", source_names=None):
         if source_names:
@@ -468,10 +728,13 @@ class Notebook(Template):
         return prompt
 
     def process_collab_action(self, user, asset_row, action_type, action_data):
-        if action_type == 'save':
+        if action_type == 'save_ops':
+            asset_id = asset_row['id']
+            save_notebook_socket(user, asset_id, action_data['ops'], action_data['version'])
+        elif action_type == 'save':  # the whole notebook, from older clients
             asset_id = asset_row['id']
             val = action_data['value']
             prev_hash = action_data['last_saved_hash']
-            save_notebook_socket(user, asset_id, val, prev_hash)
+            save_notebook_socket(user, asset_id, None, None, legacy_value=val, prev_hash=prev_hash)
         else:
             print(f"Action type {action_type} unrecognized", file=sys.stderr)
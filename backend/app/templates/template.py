@@ -3,14 +3,15 @@ from abc import ABC
 from ..auth import token_optional, get_permissioning_string, User, token_required
 
 from ..template_response import MyResponse
-from ..db import get_db, needs_db, ProxyDB
+from ..db import get_db, needs_db, ProxyDB, escape_string, escape_list
 from ..utils import get_extension_from_path, mimetype_from_ext
 from ..configs.str_constants import *
 from ..template_response import response_from_resource
 import tempfile
 from ..storage_interface import download_file
 from ..prompts.detached_chat_prompts import mixed_detached_chat_system_prompt
-from ..asset_actions import get_asset
+from ..asset_actions import get_asset, get_assets
+from ..source_tree_cache import SOURCE_TREE_CACHE, CachedSourceTree
 from ..retriever import Chunk
 from ..utils import deduplicate
 from ..prompts.prompt_fragments import get_basic_ai_identity, get_citation_prompt, get_web_citation_prompt
@@ -45,6 +46,8 @@ class Template(ABC):
 
     make_retriever_on_upload: bool = True  # Need to be chattable and this true to make retriever on upload
 
+    resources_are_retrieval_sources: bool = False  # get_asset_resources returns just the resources of its retrieval sources (like a folder)
+
     # Allowed endpoints is like, ['reminder', ...] - see /email blueprint.
     # Allowed endpoints needs implemented associated functions (see class methods below)
     email_rules: EmailRules = EmailRules()
@@ -145,7 +148,7 @@ class Template(ABC):
     def get_file(self, user, asset_id, only_headers=False, rec_calls=[], name=MAIN_FILE, ret_resp=True, db=None):
 
         curr = db.cursor()
-        sql = f"SELECT * FROM asset_resources WHERE asset_id = %s AND name LIKE '{db.escape_string(name)}' ORDER BY `time_uploaded` DESC"
+        sql = f"SELECT * FROM asset_resources WHERE asset_id = %s AND name LIKE '{escape_string(name)}' ORDER BY `time_uploaded` DESC"
         curr.execute(sql, (asset_id,))
         res = curr.fetchone()
         if not res and ret_resp:
@@ -204,38 +207,81 @@ class Template(ABC):
 
         return total_results
     
+    # Walks the retrieval sources a level at a time: one query for the sources of the whole level, one to check which the user can see,
+    # and (at the end) one for the main files of all the plain sources.
+    # Templates that do something else in get_asset_resources (notebooks, chats, ...) still get asked one by one.
+    # Trees with only folders and plain sources are cached per user (see source_tree_cache.py).
     @needs_db
     def _get_asset_resources_include_retrieval_sources(self, user: User, asset_id, exclude=[], db=None):
-        curr = db.cursor()
-        total_results = []
-        visited_asset_ids = list(exclude)
+        from .templates import get_template_by_code
 
-        def rec(x):
-            visited_asset_ids.append(x)
-            asset_row = get_asset(user, x)
-            if asset_row:
-                from .templates import get_template_by_code
-                tmp: Template = get_template_by_code(asset_row['template'])
-                resources = tmp.get_asset_resources(user, x, exclude=visited_asset_ids)
-                total_results.extend(resources)
+        cache_key = (user.user_id if user else None, int(asset_id), tuple(sorted([str(x) for x in exclude])))
+        cached = SOURCE_TREE_CACHE.get(cache_key, db)
+        if cached is not None:
+            return cached
 
+        curr = db.cursor()
+        visited_asset_ids = set(exclude)
+        visited_asset_ids.add(int(asset_id))
+        walked_ids = []
+        source_ids = []
+        group_ids = set()
+        leaf_ids = []  # sources that just have their main files
+        other_rows = []  # sources whose templates have their own get_asset_resources
+
+        level = [int(asset_id)]
+        while len(level):
+            walked_ids.extend(level)
+            sql = f"""
+            SELECT `value` FROM asset_metadata
+            WHERE `key` = '{RETRIEVAL_SOURCE}' AND `asset_id` IN ({escape_list(level)})
+            ORDER BY `id`
+            """
+            curr.execute(sql)
+            new_ids = []
+            for meta in curr.fetchall():
+                val = int(meta['value'])
+                if val not in visited_asset_ids:
+                    visited_asset_ids.add(val)
+                    new_ids.append(val)
+
+            level = []
+            for asset_row in get_assets(user, new_ids, db=db, no_commit=True):
+                source_ids.append(asset_row['id'])
+                if asset_row['group_id'] is not None:
+                    group_ids.add(asset_row['group_id'])
+                tmp: Template = get_template_by_code(asset_row['template'])
+                if tmp.resources_are_retrieval_sources:
+                    level.append(asset_row['id'])
+                elif type(tmp).get_asset_resources is Template.get_asset_resources:
+                    leaf_ids.append(asset_row['id'])
+                else:
+                    other_rows.append((tmp, asset_row))
 
-        sql = f"""
-        SELECT * FROM asset_metadata
-        WHERE `key` = '{RETRIEVAL_SOURCE}' AND `asset_id` = %s
-        """
-        curr.execute(sql, (asset_id,))
+        total_results = []
+        if len(leaf_ids):
+            # Permissions were already checked when the sources were fetched
+            sql = f"""
+            SELECT asset_resources.*, assets.creator_id, assets.group_id
+            FROM asset_resources
+            JOIN assets ON asset_resources.asset_id = assets.id
+            WHERE asset_resources.asset_id IN ({escape_list(leaf_ids)}) AND `name` LIKE '{MAIN_FILE}'
+            """
+            curr.execute(sql)
+            order = {x: i for i, x in enumerate(leaf_ids)}
+            total_results.extend(sorted(curr.fetchall(), key=lambda x: order[x['asset_id']]))
 
-        results = curr.fetchall()
+        for tmp, asset_row in other_rows:
+            # Not every get_asset_resources takes no_commit (crawlers' aren't wrapped in needs_db)
+            resources = tmp.get_asset_resources(user, asset_row['id'], exclude=list(visited_asset_ids), db=db)
+            if not resources:
+                continue
+            total_results.extend(resources)
 
-        if results:
-            for meta in results:
-                val = int(meta['value'])
-                if val not in visited_asset_ids:
-                    rec(val)
-        
         # Deduplicate asset resources as necessary
         deduplicated = deduplicate(total_results, key=lambda x: x['id'])
+        if not len(other_rows):
+            SOURCE_TREE_CACHE.put(cache_key, CachedSourceTree(deduplicated, walked_ids, source_ids, group_ids, leaf_ids), db)
         return deduplicated
 
     # Any extra delete cleanup that needs to be template specific
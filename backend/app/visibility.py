@@ -0,0 +1,231 @@
+import click
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+from flask.cli import with_appcontext
+from .auth import User
+from .db import needs_db, escape_string, escape_list, ProxyDB
+from .exceptions import UserIsNoneError
+from .utils import is_valid_email
+from .configs.user_config import PERMISSIONING, ASSET_VISIBILITY_INDEX, LISTING_TOTAL_CACHE_TTL, LISTING_TOTAL_CACHE_MAX_ENTRIES
+
+"""
+
+Materialized visibility of assets and groups, so that listing what a user can see (search_assets, search_groups) is an index range scan
+instead of a join on asset_permissions through a chain of ORs.
+
+asset_visibility has a row for each (principal, asset) that some asset_permissions row grants, with group permissions expanded to every asset in the group.
+via_group says which: listings treat the asset's own permissions and its group's separately (see search_assets).
+group_visibility is the same for groups themselves.
+
+A principal is 'public', 'user:<user id>', or 'email:<email or domain>' (what's in asset_permissions.email_domain).
+Creators aren't in either table; creator_id is already indexed, and is checked directly.
+The conditions built here (get_visibility_string) mean the same as get_permissioning_string's.
+
+Rows are recomputed from asset_permissions whenever permissions or group membership change:
+- every change to an asset's own permissions goes through propagate_joint_permissions, which refreshes the assets it visits;
+- changes to a group's permissions refresh the group and its assets (refresh_group_visibility);
+- an asset being put into or taken out of a group refreshes that asset.
+
+Run "flask rebuild-visibility" to fill the tables from scratch (needed once, before ASSET_VISIBILITY_INDEX is turned on).
+
+"""
+
+PUBLIC_PRINCIPAL = 'public'
+REFRESH_BATCH_SIZE = 500  # assets per refresh query
+
+
+# Whether listings should use the visibility tables (in demo mode, everyone sees everything anyway)
+def visibility_index_enabled():
+    return ASSET_VISIBILITY_INDEX and PERMISSIONING != 'demo'
+
+
+# The principals a user's permissions can come through; matches get_permissioning_string
+def get_user_principals(user: User, get_public=True):
+    principals = [PUBLIC_PRINCIPAL] if get_public else []
+    if user:
+        email_domain = user.email.split("@")[1] if is_valid_email(user.email) else "localhost"
+        principals.extend([f"user:{user.user_id}", f"email:{user.email}", f"email:{email_domain}"])
+    return principals
+
+
+# Joins the rows of asset_visibility (or group_visibility, for groups=True) that apply to the user
+# via_group: None for both kinds of asset rows, otherwise only those from the group's permissions (True) or the asset's own (False)
+def get_visibility_join(user: User, get_public=True, via_group=None, groups=False, assets_alias="a", visibility_alias="av"):
+    if groups:
+        on = f"{visibility_alias}.group_id = {assets_alias}.id"
+        table = "group_visibility"
+    else:
+        on = f"{visibility_alias}.asset_id = {assets_alias}.id"
+        table = "asset_visibility"
+        if via_group is not None:
+            on += f" AND {visibility_alias}.via_group = {int(via_group)}"
+    principals = get_user_principals(user, get_public=get_public)
+    if not len(principals):
+        on += " AND 1 = 0"
+    else:
+        on += f" AND {visibility_alias}.principal IN ({escape_list(principals)})"
+    return f"LEFT JOIN {table} {visibility_alias} ON {on}"
+
+
+# The counterpart of get_permissioning_string for queries using get_visibility_join (with the same get_public)
+# The line follows the "WHERE " clause
+def get_visibility_string(user: User, get_public=True, user_uploads_only=False, edit_permission=False, assets_alias="a", visibility_alias="av"):
+
+    if PERMISSIONING == 'demo':
+        return "1 = 1"
+    if not user and get_public:
+        if edit_permission:
+            return "1 = 0"
+        return f"{visibility_alias}.principal IS NOT NULL"  # only the public principal is joined
+    elif not user:
+        raise UserIsNoneError("Request for non-public data but no user")
+
+    user_id = escape_string(user.user_id)
+    if user_uploads_only:
+        return f"{assets_alias}.creator_id = '{user_id}'"
+    if edit_permission:
+        return f"{assets_alias}.creator_id = '{user_id}' OR {visibility_alias}.can_edit = 1"
+    return f"{assets_alias}.creator_id = '{user_id}' OR {visibility_alias}.principal IS NOT NULL"
+
+
+# Selects (principal, can_edit) for each asset_permissions row in the grants subquery, which needs public, user_id, email_domain and can_edit
+def _principal_rows_sql(grants_sql, key_columns):
+    keys = ", ".join(key_columns)
+    return f"""
+        SELECT {keys}, principal, MAX(can_edit) AS can_edit FROM (
+            SELECT {keys}, '{PUBLIC_PRINCIPAL}' AS principal, 0 AS can_edit FROM ({grants_sql}) g WHERE g.public != 0
+            UNION ALL
+            SELECT {keys}, CONCAT('user:', g.user_id), COALESCE(g.can_edit, 0) FROM ({grants_sql}) g WHERE g.user_id IS NOT NULL
+            UNION ALL
+            SELECT {keys}, CONCAT('email:', g.email_domain), COALESCE(g.can_edit, 0) FROM ({grants_sql}) g WHERE g.email_domain IS NOT NULL
+        ) p
+        GROUP BY {keys}, principal
+    """
+
+
+# Recomputes asset_visibility for these assets from asset_permissions (assets that don't exist anymore just lose their rows)
+@needs_db
+def refresh_asset_visibility(asset_ids, db: ProxyDB=None):
+    asset_ids = list(set([int(x) for x in asset_ids if x is not None]))
+    curr = db.cursor()
+    for start in range(0, len(asset_ids), REFRESH_BATCH_SIZE):
+        id_list = escape_list(asset_ids[start:start+REFRESH_BATCH_SIZE])
+        curr.execute(f"DELETE FROM asset_visibility WHERE `asset_id` IN ({id_list})")
+        grants_sql = f"""
+            SELECT a.id AS asset_id, 0 AS via_group, ap.public, ap.user_id, ap.email_domain, ap.can_edit
+            FROM assets a
+            JOIN asset_permissions ap ON ap.asset_id = a.id
+            WHERE a.id IN ({id_list})
+            UNION ALL
+            SELECT a.id AS asset_id, 1 AS via_group, ap.public, ap.user_id, ap.email_domain, ap.can_edit
+            FROM assets a
+            JOIN asset_permissions ap ON ap.group_id = a.group_id
+            WHERE a.id IN ({id_list})
+        """
+        sql = f"""
+        INSERT INTO asset_visibility (`asset_id`, `via_group`, `principal`, `can_edit`)
+        {_principal_rows_sql(grants_sql, ['asset_id', 'via_group'])}
+        """
+        curr.execute(sql)
+
+
+# Recomputes group_visibility for these groups, and asset_visibility for their assets
+@needs_db
+def refresh_group_visibility(group_ids, db: ProxyDB=None):
+    group_ids = list(set([int(x) for x in group_ids if x is not None]))
+    if not len(group_ids):
+        return
+    id_list = escape_list(group_ids)
+    curr = db.cursor()
+    curr.execute(f"DELETE FROM group_visibility WHERE `group_id` IN ({id_list})")
+    grants_sql = f"""
+        SELECT ap.group_id, ap.public, ap.user_id, ap.email_domain, ap.can_edit
+        FROM asset_permissions ap
+        WHERE ap.group_id IN ({id_list})
+    """
+    sql = f"""
+    INSERT INTO group_visibility (`group_id`, `principal`, `can_edit`)
+    {_principal_rows_sql(grants_sql, ['group_id'])}
+    """
+    curr.execute(sql)
+
+    curr.execute(f"SELECT `id` FROM assets WHERE `group_id` IN ({id_list})")
+    asset_ids = [x['id'] for x in curr.fetchall()]
+    refresh_asset_visibility(asset_ids, db=db, no_commit=True)
+
+
+@needs_db
+def delete_asset_visibility(asset_id, db: ProxyDB=None):
+    curr = db.cursor()
+    curr.execute("DELETE FROM asset_visibility WHERE `asset_id`=%s", (asset_id,))
+
+
+# Fills both tables from scratch, a batch at a time
+def rebuild_visibility():
+    from .db import get_db
+    db = get_db(new_connection=True)
+    try:
+        curr = db.cursor()
+        curr.execute("SELECT `id` FROM asset_groups")
+        group_ids = [x['id'] for x in curr.fetchall()]
+        curr.execute("DELETE FROM group_visibility")
+        refresh_group_visibility(group_ids, db=db)  # commits
+
+        last_id = 0
+        n = 0
+        while True:
+            curr.execute("SELECT `id` FROM assets WHERE `id` > %s ORDER BY `id` LIMIT %s", (last_id, REFRESH_BATCH_SIZE))
+            asset_ids = [x['id'] for x in curr.fetchall()]
+            if not asset_ids:
+                break
+            refresh_asset_visibility(asset_ids, db=db)  # commits
+            last_id = asset_ids[-1]
+            n += len(asset_ids)
+        # Rows for assets that were deleted before visibility was kept up to date
+        curr.execute("DELETE av FROM asset_visibility av LEFT JOIN assets a ON a.id = av.asset_id WHERE a.id IS NULL")
+        db.commit()
+        return n
+    finally:
+        db.close()
+
+
+@click.command('rebuild-visibility')
+@with_appcontext
+def rebuild_visibility_command():
+    """Recompute asset_visibility and group_visibility from asset_permissions."""
+    n = rebuild_visibility()
+    click.echo(f'Rebuilt visibility for {n} assets.')
+
+
+"""
+
+Totals for listings, counted with a separate query (rather than SQL_CALC_FOUND_ROWS + FOUND_ROWS(), which needs the connection to itself)
+and kept for a little while (LISTING_TOTAL_CACHE_TTL), since paging through a listing asks for the same total over and over.
+
+"""
+
+_TOTALS_LOCK = Lock()
+_TOTALS = OrderedDict()  # hash of the counted sql -> (time, total)
+
+
+def get_listing_total(sql, db: ProxyDB):
+    key = hashlib.sha1(sql.encode()).hexdigest()
+    now = time.time()
+    with _TOTALS_LOCK:
+        entry = _TOTALS.get(key)
+        if entry and now - entry[0] < LISTING_TOTAL_CACHE_TTL:
+            _TOTALS.move_to_end(key)
+            return entry[1]
+
+    curr = db.cursor()
+    curr.execute(f"SELECT COUNT(*) AS total FROM ({sql}) AS counted")
+    total = curr.fetchone()['total']
+
+    with _TOTALS_LOCK:
+        _TOTALS[key] = (now, total)
+        _TOTALS.move_to_end(key)
+        while len(_TOTALS) > LISTING_TOTAL_CACHE_MAX_ENTRIES:
+            _TOTALS.popitem(last=False)
+    return total
@@ -14,7 +14,6 @@ from .configs.settings import SETTINGS
 from .configs.secrets import SCRAPER_API_KEY
 from .exceptions import ScraperUnavailable
 import json
-from requests_toolbelt.multipart.decoder import MultipartDecoder
 import os
 
 
@@ -167,6 +166,17 @@ class ScrapeResponse():
             if tmp:
                 tmp.close()
 
+    # Like set_data, for content that's already in a file (which the response now owns)
+    def set_data_path(self, path):
+        if self.metadata.content_type == 'text/html':
+            with open(path, 'rb') as f:
+                self._set_metadata_from_html(f.read())
+        self.data_path = path
+
+    def add_screenshot_path(self, path, mimetype):
+        self.screenshot_paths.append(path)
+        self.screenshot_mimetypes.append(mimetype)
+
     def add_screenshot(self, content, mimetype):
         try:
             tmp = tempfile.NamedTemporaryFile(delete=False)
@@ -242,6 +252,106 @@ def scrape_with_requests(url, use_html=None):
             return ScrapeResponse(False, status=None, url=url, headers={})
 
 
+"""
+
+Incremental parser for the multipart/mixed responses of the scraper service (scraper/app.py).
+
+Takes the body as an iterable of byte chunks and yields ('headers', dict), then ('data', bytes) any number of times, then ('end', None), for each part.
+If a part has a Content-Length, its body is passed through without being searched; otherwise, it ends at the next boundary.
+Only a boundary's worth of bytes is ever held back, so a part never has to fit in memory.
+
+"""
+
+MULTIPART_STREAM_CHUNK_SIZE = 256 * 1024
+
+
+def get_multipart_boundary(content_type: str):
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.strip().lower() == 'boundary':
+            return value.strip().strip('"')
+    return None
+
+
+def iter_multipart(chunks, boundary):
+    delimiter = b"\r\n--" + boundary.encode()
+    buf = bytearray(b"\r\n")  # so that the first boundary looks like the rest
+    state = 'preamble'
+    remaining = None  # bytes left in a part with a Content-Length
+    chunks = iter(chunks)
+    exhausted = False
+
+    def fill():
+        nonlocal exhausted
+        for chunk in chunks:
+            if chunk:
+                buf.extend(chunk)
+                return
+        exhausted = True
+
+    while True:
+        if state == 'preamble':  # skipping to the next boundary
+            i = buf.find(delimiter)
+            if i == -1:
+                del buf[:max(0, len(buf) - len(delimiter) + 1)]
+            else:
+                del buf[:i + len(delimiter)]
+                state = 'boundary'
+                continue
+        elif state == 'boundary':  # just after a boundary: either "--" to close, or the end of the line
+            if len(buf) >= 2 and buf[:2] == b"--":
+                return
+            i = buf.find(b"\r\n")
+            if i != -1:
+                del buf[:i + 2]
+                state = 'headers'
+                continue
+        elif state == 'headers':
+            i = buf.find(b"\r\n\r\n")
+            if i != -1:
+                headers = {}
+                for line in bytes(buf[:i]).decode('latin-1').split("\r\n"):
+                    key, sep, value = line.partition(':')
+                    if sep:
+                        headers[key.strip().lower()] = value.strip()
+                del buf[:i + 4]
+                remaining = int(headers['content-length']) if headers.get('content-length', '').isdigit() else None
+                state = 'body'
+                yield 'headers', headers
+                continue
+        elif state == 'body':
+            if remaining is not None:
+                n = min(remaining, len(buf))
+                if n:
+                    data = bytes(buf[:n])
+                    del buf[:n]
+                    remaining -= n
+                    yield 'data', data
+                if not remaining:
+                    state = 'preamble'  # the body is followed by the delimiter
+                    yield 'end', None
+                    continue
+            else:
+                i = buf.find(delimiter)
+                if i != -1:
+                    if i:
+                        yield 'data', bytes(buf[:i])
+                    del buf[:i + len(delimiter)]
+                    state = 'boundary'
+                    yield 'end', None
+                    continue
+                keep = len(delimiter) - 1  # might be the start of the delimiter
+                if len(buf) > keep:
+                    yield 'data', bytes(buf[:-keep])
+                    del buf[:-keep]
+
+        if exhausted:
+            if state == 'preamble':
+                return  # a missing closing boundary is tolerated
+            raise ValueError(f"Multipart stream ended early (while reading {state})")
+        fill()
+
+
 def scrape_with_service(url: str):
     if 'scraper'  not in SETTINGS:
         raise ScraperUnavailable()
@@ -255,31 +365,54 @@ def scrape_with_service(url: str):
     data = {
         'url': url
     }
+    resp = None
+    part_file = None
     try:
-        response = requests.post(scraper_url + '/scrape', json=data, headers=headers, timeout=30)
-        response.raise_for_status()
-        decoder = MultipartDecoder.from_response(response)
-
-        resp = None
-        for i, part in enumerate(decoder.parts):
-            if i == 0:  # First is some JSON
-                json_part = json.loads(part.content)
-                status = json_part['status']
-                headers = json_part['headers']
-                resp = ScrapeResponse(False, status, url, headers)
-            elif i == 1:  # Next is the actual content of the
-                if part.content:
-                    resp.success = True
-                    resp.set_data(part.content)
-            else:  # Other parts are screenshots, if they exist
-                # Annoyingly the headers are bytes not strings for some reason
-                mimetype: bytes = part.headers[b'Content-Type']
-                mimetype: str = mimetype.decode()
-                resp.add_screenshot(part.content, mimetype)
-        
+        with requests.post(scraper_url + '/scrape', json=data, headers=headers, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            boundary = get_multipart_boundary(response.headers.get('content-type', ''))
+            if not boundary:
+                raise ValueError("Scraper response is not multipart")
+
+            # Parts are written straight to temporary files as they arrive (except the first, which is some JSON)
+            i = -1
+            json_content = b""
+            part_type = None
+            for event, value in iter_multipart(response.iter_content(chunk_size=MULTIPART_STREAM_CHUNK_SIZE), boundary):
+                if event == 'headers':
+                    i += 1
+                    part_type = value.get('content-type', '')
+                    if i > 0:
+                        part_file = tempfile.NamedTemporaryFile(delete=False)
+                elif event == 'data':
+                    if i == 0:
+                        json_content += value
+                    else:
+                        part_file.write(value)
+                else:
+                    if i == 0:  # First is some JSON
+                        json_part = json.loads(json_content)
+                        status = json_part['status']
+                        headers = json_part['headers']
+                        resp = ScrapeResponse(False, status, url, headers)
+                        continue
+                    path = part_file.name
+                    size = part_file.tell()
+                    part_file.close()
+                    part_file = None
+                    if i == 1:  # Next is the actual content of the page
+                        if size:
+                            resp.success = True
+                            resp.set_data_path(path)
+                        else:
+                            os.remove(path)
+                    else:  # Other parts are screenshots, if they exist
+                        resp.add_screenshot_path(path, part_type)
+
         return resp
 
     except requests.RequestException as e:
+        _clean_up_partial_scrape(resp, part_file)
         if e.response:
             try:
                 my_json = e.response.json()
@@ -288,6 +421,21 @@ def scrape_with_service(url: str):
             except:
                 print(e, file=sys.stderr)
         return ScrapeResponse(False, status=None, url=url, headers={})
+    except:
+        _clean_up_partial_scrape(resp, part_file)
+        raise
+
+
+def _clean_up_partial_scrape(resp: ScrapeResponse, part_file):
+    if part_file:
+        part_file.close()
+        os.remove(part_file.name)
+    if resp:
+        with resp.consume_screenshots():
+            pass
+        if resp.data_path:
+            with resp.consume_data():
+                pass
 
 
 def get_web_chunks(user: User, search_query, available_context, max_n=5):
@@ -0,0 +1,128 @@
+from app.integrations.file_loaders import TextSplitter
+import random
+import time
+import sys
+
+"""
+
+Micro-benchmark of TextSplitter against the implementation it replaced (LegacyTextSplitter, below).
+
+Run from the backend directory (/app in the container):
+
+    python3 -m benchmarks.text_splitter [size in MB]
+
+The inputs are the shapes that were slow before: long single-"page" text like CSVs, JSON, code, and paragraphs that go on forever.
+Only times; the outputs differ once there's overlap (the legacy splitter ignored it), and a little on inputs with no paragraph breaks (see STREAM_MAX_PENDING).
+
+"""
+
+# The splitter as it was, kept here only to compare against.
+class LegacyTextSplitter():
+    def __init__(self, max_chunk_size, length_function=len, chunk_overlap=0):
+        self.max_chunk_size = max_chunk_size
+        self.length_function=length_function
+        self.chunk_overlap = 0
+
+    def split_text(self, txt, separators=None):
+        separators = separators if separators else ["\n\n", "\n", "\t", " ", ".", ",", "\u200b", "\uff0c", "\u3001", "\uff0e", "\u3002"]
+
+        def recursive_split(text, seps):
+            max_chunks = []
+            sep = ""
+            if not len(seps):
+                splitsville = [text[:self.max_chunk_size], text[self.max_chunk_size:]]
+            else:
+                sep = seps[0]
+                splitsville = text.split(sep)
+
+            for split in splitsville:
+                if not split:
+                    continue
+                if not len(max_chunks):
+                    max_chunks.append(split)
+                elif self.length_function(max_chunks[len(max_chunks) - 1] + sep + split) < self.max_chunk_size:
+                    max_chunks[len(max_chunks) - 1] += sep + split
+                else:
+                    max_chunks.append(split)
+
+            final_chunks = []
+            for max_chunk in max_chunks:
+                if self.length_function(max_chunk) > self.max_chunk_size:
+                    final_chunks.extend(recursive_split(max_chunk, seps[1:]))
+                else:
+                    final_chunks.append(max_chunk)
+            return final_chunks
+
+        if self.length_function(txt) <= self.max_chunk_size:
+            if not txt:
+                return []
+            return [txt]
+        return recursive_split(txt, separators)
+
+
+def make_csv(n_chars):
+    rows = []
+    total = 0
+    while total < n_chars:
+        row = ",".join(str(random.randint(0, 10**6)) for _ in range(12))
+        rows.append(row)
+        total += len(row) + 1
+    return "\n".join(rows)
+
+
+def make_json(n_chars):
+    items = []
+    total = 0
+    while total < n_chars:
+        item = '{"id": %d, "name": "item %d", "tags": ["a", "b", "c"]}' % (random.randint(0, 10**6), len(items))
+        items.append(item)
+        total += len(item) + 2
+    return "[" + ", ".join(items) + "]"
+
+
+def make_paragraph(n_chars):
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+    return " ".join(random.choice(words) for _ in range(n_chars // 6))
+
+
+def make_unbroken(n_chars):
+    return "x" * n_chars
+
+
+INPUTS = [
+    ('csv', make_csv),
+    ('json', make_json),
+    ('one paragraph', make_paragraph),
+    ('no separators', make_unbroken),
+]
+
+# (max_chunk_size, chunk_overlap) in characters: what retrievers use (400 and 10 tokens), and a larger chunk
+SETTINGS = [(1600, 40), (16000, 400)]
+
+
+def time_split(splitter, txt):
+    start = time.time()
+    try:
+        n = len(splitter.split_text(txt))
+    except RecursionError:
+        return None, None
+    return time.time() - start, n
+
+
+def main():
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    n_chars = int(size_mb * 1024 * 1024)
+    random.seed(0)
+    print(f"{'input':<16}{'chunk size':>12}{'legacy (s)':>14}{'new (s)':>10}{'new + overlap (s)':>20}{'chunks':>10}")
+    for name, make in INPUTS:
+        txt = make(n_chars)
+        for max_chunk_size, overlap in SETTINGS:
+            legacy_time, _ = time_split(LegacyTextSplitter(max_chunk_size), txt)
+            new_time, n_chunks = time_split(TextSplitter(max_chunk_size), txt)
+            overlap_time, _ = time_split(TextSplitter(max_chunk_size, chunk_overlap=overlap), txt)
+            legacy = f"{legacy_time:.3f}" if legacy_time is not None else "recursion"
+            print(f"{name:<16}{max_chunk_size:>12}{legacy:>14}{new_time:>10.3f}{overlap_time:>20.3f}{n_chunks:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# So that the backend's package imports as "app", like it does under gunicorn
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
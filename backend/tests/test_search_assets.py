@@ -0,0 +1,128 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('pymysql')
+
+from flask import Flask
+from app import db as db_module
+from app.asset_actions import search_assets, uses_default_asset_order
+from app.assets import bp as assets_bp
+
+
+class FakeCursor():
+    def __init__(self, rows) -> None:
+        self.rows = rows
+        self.executed = []
+
+    def execute(self, sql, args=None):
+        self.executed.append(sql)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return {'FOUND_ROWS()': len(self.rows), 'total': len(self.rows)}
+
+
+# Stands in for ProxyDB; every query returns the same rows
+class FakeDB():
+    def __init__(self, rows=[]) -> None:
+        self.rows = rows
+        self.cursors = []
+        self.commits = 0
+
+    def cursor(self):
+        curr = FakeCursor(self.rows)
+        self.cursors.append(curr)
+        return curr
+
+    def commit(self, close_cursors=True, close=False):
+        self.commits += 1
+
+    def close_cursors(self, exempt=[]):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_rows(n):
+    return [{'id': 100 - i, 'time_uploaded': f'2024-01-01 00:00:{59 - i:02d}', 'title': f'Asset {i}'} for i in range(n)]
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    fake = FakeDB(make_rows(3))
+    monkeypatch.setattr(db_module, 'get_db', lambda *args, **kwargs: fake)
+    return fake
+
+
+def test_search_assets_is_wrapped_for_the_db():
+    # Connection options are the decorator's, not search_assets'
+    assert hasattr(search_assets, '__wrapped__')
+
+
+def test_search_assets_gets_its_own_db(fake_db):
+    results, total = search_assets(None, limit=3)
+    assert len(results) == 3
+    assert total == 3
+    assert fake_db.commits == 1
+
+
+def test_search_assets_takes_connection_options(fake_db):
+    results, _ = search_assets(None, limit=3, exclusive_conn=True, no_commit=True, db=fake_db)
+    assert len(results) == 3
+    assert fake_db.commits == 0
+
+
+def test_search_assets_pages_by_key(fake_db):
+    results, _ = search_assets(None, limit=3, after=['2024-01-01 00:00:57', 98], ignore_total=True)
+    assert len(results) == 3
+    assert any('assets.id < 98' in sql for curr in fake_db.cursors for sql in curr.executed)
+
+
+def test_search_assets_refuses_key_paging_in_other_orders(fake_db):
+    with pytest.raises(ValueError):
+        search_assets(None, limit=3, alphabetical=True, after=['2024-01-01 00:00:57', 98])
+
+
+def test_uses_default_asset_order():
+    assert uses_default_asset_order()
+    assert uses_default_asset_order(folders_first='0')
+    assert not uses_default_asset_order(search="cats")
+    assert not uses_default_asset_order(alphabetical=True)
+    assert not uses_default_asset_order(recent_activity=True)
+    assert not uses_default_asset_order(folders_first='1')
+
+
+@pytest.fixture
+def client(fake_db):
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(assets_bp)
+    return flask_app.test_client()
+
+
+def test_manifest_returns_next_after_for_default_order(client):
+    resp = client.get('/assets/manifest?limit=3&get_total=1')
+    data = resp.get_json()
+    assert resp.status_code == 200
+    assert len(data['results']) == 3
+    assert data['total'] == 3
+    assert data['next_after'] == ['2024-01-01 00:00:57', 98]
+
+
+def test_manifest_pages_with_after(client):
+    resp = client.get('/assets/manifest?limit=3&after=["2024-01-01 00:00:57", 98]')
+    assert resp.status_code == 200
+    assert resp.get_json()['next_after'] is not None
+
+
+def test_manifest_has_no_next_after_for_other_orders(client):
+    resp = client.get('/assets/manifest?limit=3&alphabetical=1')
+    assert resp.status_code == 200
+    assert resp.get_json()['next_after'] is None
+
+
+def test_manifest_refuses_after_for_other_orders(client):
+    resp = client.get('/assets/manifest?limit=3&alphabetical=1&after=["2024-01-01 00:00:57", 98]')
+    assert resp.status_code == 400
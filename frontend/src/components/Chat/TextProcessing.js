@@ -14,17 +14,13 @@ export default function TextProcessing({ id, canEdit, retrieverIssue, setRetriev
     async function getRetrieverStatus(loadAttempt){
         try {
             setRetrieverLoadState(1)
-            const url = process.env.NEXT_PUBLIC_BACKEND_URL + `/assets/get-retriever-status`
-            const data = {
-                'id': id
-            }
+            // A GET so that the browser can revalidate with the ETag rather than downloading the whole status again
+            const url = process.env.NEXT_PUBLIC_BACKEND_URL + `/assets/get-retriever-status?id=${id}`
             const response = await fetch(url, {
                 'headers': {
-                    'x-access-token': await getToken(),
-                    'Content-Type': 'application/json'
+                    'x-access-token': await getToken()
                 },
-                'method': 'POST',
-                'body': JSON.stringify(data)
+                'method': 'GET'
             })
 
             const myJson = await response.json()
@@ -28,6 +28,7 @@ import Tooltip from "../Tooltip/Tooltip";
 import ChatIcon from '../../../public/icons/ChatIcon.png'
 import NotebookIcon from '../../../public/icons/NotebookIcon.png'
 import { getBlockTypeByCode } from "./BlockTypes";
+import { applyNotebookOps, getNotebookOps } from "./NotebookOps";
 import AttachIcon from '../../../public/icons/AttachIcon.png'
 import { getUserName } from "@/utils/user";
 import CurvedArrow from "../CurvedArrow/CurvedArrow";
@@ -135,25 +136,29 @@ export default function Notebook({ manifestRow, canEdit, collabSocket }) {
     const [showOnlyBlockType, setShowOnlyBlockType] = useState(undefined)
 
     const lastSavedVersion = useRef(undefined)
-    const savedHashRef = useRef("")
+    const savedVersionRef = useRef(0)  // The server's version of lastSavedVersion
     const saveQueue = useRef([])
 
     const { getToken, isSignedIn } = Auth.useAuth()
 
+    async function fetchState(){
+        const url = process.env.NEXT_PUBLIC_BACKEND_URL + `/notebook/get?id=${manifestRow['id']}`
+        const response = await fetch(url, {
+            'headers': {
+                'x-access-token': await getToken(),
+            },
+            'method': 'GET'
+        })
+        return await response.json()
+    }
+
     async function getState(){
         try {
             setNotebookLoadState(1)
-            const url = process.env.NEXT_PUBLIC_BACKEND_URL + `/notebook/get?id=${manifestRow['id']}`
-            const response = await fetch(url, {
-                'headers': {
-                    'x-access-token': await getToken(),
-                },
-                'method': 'GET'
-            })
-            const myJson = await response.json()
+            const myJson = await fetchState()
             if (myJson['result']){
                 lastSavedVersion.current = myJson['result']
-                savedHashRef.current = myJson['hash']
+                savedVersionRef.current = myJson['version'] || 0
                 setNotebookState(getNotebookState({ ...myJson['result'] }))
             }
             else {
@@ -366,6 +371,15 @@ export default function Notebook({ manifestRow, canEdit, collabSocket }) {
         }
     }
 
+    // For when we've missed some ops: get the whole notebook and merge it with ours
+    async function resync(clientVersion){
+        const myJson = await fetchState()
+        if (myJson['result'] && (myJson['version'] || 0) > savedVersionRef.current){
+            savedVersionRef.current = myJson['version'] || 0
+            mergeVersions(myJson['result'], clientVersion)
+        }
+    }
+
     const saveNotebook = useCallback(async (notebook) => {
         if (!collabSocket){
             return
@@ -377,16 +391,25 @@ export default function Notebook({ manifestRow, canEdit, collabSocket }) {
             await new Promise(r => setTimeout(r, 100));
         }
         try {
+            // Only the changes since the last save are sent
+            const ops = getNotebookOps(lastSavedVersion.current, notebook)
+            if (!ops.length){
+                setNotebookSaveState(2)
+                saveQueue.current.shift()
+                return
+            }
             setNotebookSaveState(1)
+            const baseVersion = savedVersionRef.current
             const data = {
-                'type': 'save',
+                'type': 'save_ops',
                 'id': manifestRow.id,
                 'token': await getToken(),
                 'data': {
-                    'last_saved_hash': savedHashRef.current,
-                    'value': notebook
+                    'version': baseVersion,
+                    'ops': ops
                 }
             }
+            let needsResync = false
 
             // Create a promise that resolves when the server confirms the save
             const savePromise = new Promise((resolve, reject) => {
@@ -398,15 +421,20 @@ export default function Notebook({ manifestRow, canEdit, collabSocket }) {
                 collabSocket.once('save_response', (response) => {
                     clearTimeout(timeoutId);
                     if (response.status === 'success') {
-                        savedHashRef.current = response.hash
-                        lastSavedVersion.current = notebook
+                        if (response.version == baseVersion + 1){
+                            savedVersionRef.current = response.version
+                            lastSavedVersion.current = applyNotebookOps(lastSavedVersion.current, ops)
+                        }
+                        else if (response.version > savedVersionRef.current) {
+                            // Someone else's ops went in first and we haven't seen them
+                            needsResync = true
+                        }
                         resolve();
                     }
                     else if (response.value){  // server is returning a new version for us to merge
-                        if (savedHashRef.current != response.hash){
-                            // The server just told us that our hash is out of date. So why check?
-                            // Because we might've gotten an update and merged already.
-                            savedHashRef.current = response.hash
+                        if (response.version > savedVersionRef.current){
+                            // Why check? Because we might've gotten the ops and merged already.
+                            savedVersionRef.current = response.version
                             mergeVersions(response.value, notebook)
                         }
                         resolve()
@@ -423,6 +451,9 @@ export default function Notebook({ manifestRow, canEdit, collabSocket }) {
         
             // Wait for the server response
             await savePromise
+            if (needsResync){
+                await resync(notebook)
+            }
             setNotebookSaveState(2) // Save successful
         }
         catch(e) {
@@ -434,23 +465,27 @@ export default function Notebook({ manifestRow, canEdit, collabSocket }) {
     useSaveDataEffect(notebookState, canEdit && notebookLoadState == 2 && collabSocket, saveNotebook, 250)
 
     useEffect(() => {
-        // Handler for "value_update" events
+        // Handler for "ops_update" events (someone else saved)
         if (!collabSocket){
             return
         }
 
-        const handleValueUpdate = (data) => {
-            if (data.hash != savedHashRef.current){
-                savedHashRef.current = data.hash
-                mergeVersions(data.value, notebookState)
+        const handleOpsUpdate = (data) => {
+            if (data.base_version == savedVersionRef.current){
+                savedVersionRef.current = data.version
+                mergeVersions(applyNotebookOps(lastSavedVersion.current, data.ops), notebookState)
+            }
+            else if (data.version > savedVersionRef.current){
+                // We missed some
+                resync(notebookState)
             }
         };
     
-        // Add event listener for "value_update" events
-        collabSocket.on('value_update', handleValueUpdate);
+        // Add event listener for "ops_update" events
+        collabSocket.on('ops_update', handleOpsUpdate);
     
         return () => {
-            collabSocket.off('value_update', handleValueUpdate);
+            collabSocket.off('ops_update', handleOpsUpdate);
         };
     }, [collabSocket, notebookState]);
 
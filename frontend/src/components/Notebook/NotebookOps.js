@@ -0,0 +1,93 @@
+// Notebooks are saved as block operations (see backend/app/templates/notebook.py for the format).
+// These two have to stay in line with diff_notebook_states and LoadedNotebook.apply there.
+
+export const NOTEBOOK_KEYS = ['keyPoints', 'outline']  // the parts of the state besides blocks that ops can set
+
+
+function placeBlock(blocks, block, after){
+    // At the top if after is null, at the bottom if that block's gone
+    if (after === null || after === undefined){
+        blocks.unshift(block)
+        return
+    }
+    const i = blocks.findIndex((x) => x.id == after)
+    if (i == -1){
+        blocks.push(block)
+    }
+    else {
+        blocks.splice(i + 1, 0, block)
+    }
+}
+
+
+// The ops that turn oldState into newState
+export function getNotebookOps(oldState, newState){
+    const ops = []
+    const oldBlocks = {}
+    for (const block of (oldState?.blocks || [])){
+        oldBlocks[block.id] = block
+    }
+    const newIds = new Set((newState?.blocks || []).map((x) => x.id))
+    for (const block of (oldState?.blocks || [])){
+        if (!newIds.has(block.id)){
+            ops.push({'type': 'delete', 'id': block.id})
+        }
+    }
+
+    const order = (oldState?.blocks || []).filter((x) => newIds.has(x.id)).map((x) => x.id)
+    let after = null
+    const newBlocks = newState?.blocks || []
+    for (let i = 0; i < newBlocks.length; i++){
+        const block = newBlocks[i]
+        if (i >= order.length || order[i] != block.id){
+            if (oldBlocks[block.id]){
+                order.splice(order.indexOf(block.id), 1)
+                ops.push({'type': 'move', 'id': block.id, 'after': after})
+            }
+            else {
+                ops.push({'type': 'insert', 'block': block, 'after': after})
+            }
+            order.splice(i, 0, block.id)
+        }
+        if (oldBlocks[block.id] && JSON.stringify(oldBlocks[block.id]) != JSON.stringify(block)){
+            ops.push({'type': 'update', 'block': block})
+        }
+        after = block.id
+    }
+
+    for (const key of NOTEBOOK_KEYS){
+        if (newState && newState[key] !== undefined && JSON.stringify(newState[key]) != JSON.stringify(oldState?.[key])){
+            ops.push({'type': 'set', 'key': key, 'value': newState[key]})
+        }
+    }
+    return ops
+}
+
+
+// Returns a new state; doesn't change the one given
+export function applyNotebookOps(state, ops){
+    const blocks = [...(state?.blocks || [])]
+    const newState = {...state, 'blocks': blocks}
+    for (const op of ops){
+        if (op.type == 'set'){
+            newState[op.key] = op.value
+            continue
+        }
+        const blockId = (op.type == 'insert' || op.type == 'update') ? op.block.id : op.id
+        const i = blocks.findIndex((x) => x.id == blockId)
+        if (op.type == 'insert'){
+            placeBlock(blocks, op.block, op.after)
+        }
+        else if (op.type == 'update' && i != -1){
+            blocks[i] = op.block
+        }
+        else if (op.type == 'delete' && i != -1){
+            blocks.splice(i, 1)
+        }
+        else if (op.type == 'move' && i != -1){
+            const [moved] = blocks.splice(i, 1)
+            placeBlock(blocks, moved, op.after)
+        }
+    }
+    return newState
+}
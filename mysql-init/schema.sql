@@ -56,6 +56,43 @@ CREATE TABLE asset_permissions (
 );
 
 
+DROP TABLE IF EXISTS asset_visibility;
+
+/* Who can see each asset, kept up to date from asset_permissions (see visibility.py) */
+CREATE TABLE asset_visibility (
+    `principal` VARCHAR(320) NOT NULL,  /* 'public', 'user:<user id>', or 'email:<email or domain>' */
+    `asset_id` INT NOT NULL,
+    `via_group` TINYINT NOT NULL DEFAULT 0,  /* 1 if from a permission on the asset's group, 0 if from one on the asset */
+    `can_edit` TINYINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (`principal`, `asset_id`, `via_group`)
+);
+
+
+DROP TABLE IF EXISTS group_visibility;
+
+/* Same as asset_visibility, for asset groups */
+CREATE TABLE group_visibility (
+    `principal` VARCHAR(320) NOT NULL,
+    `group_id` INT NOT NULL,
+    `can_edit` TINYINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (`principal`, `group_id`)
+);
+
+
+DROP TABLE IF EXISTS notebook_ops;
+
+/* Changes to notebooks since their last snapshot in asset_metadata (see templates/notebook.py) */
+CREATE TABLE notebook_ops (
+    `id` INT PRIMARY KEY AUTO_INCREMENT,
+    `asset_id` INT NOT NULL,
+    `version` INT NOT NULL,  /* The notebook's version after these ops */
+    `user_id` VARCHAR(255),
+    `ops` LONGTEXT,  /* JSON list of block operations */
+    `timestamp` DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (`asset_id`, `version`)
+);
+
+
 DROP TABLE IF EXISTS asset_retrieval_storage;
 
 CREATE TABLE asset_retrieval_storage (
@@ -280,8 +317,12 @@ CREATE INDEX idx_asset_id ON asset_permissions (asset_id);
 CREATE INDEX idx_group_id ON asset_permissions (group_id);
 CREATE INDEX idx_email_domain ON asset_permissions (email_domain(9));
 
+CREATE INDEX idx_asset_id ON asset_visibility (asset_id);
+CREATE INDEX idx_group_id ON group_visibility (group_id);
+
 CREATE INDEX idx_asset_id ON asset_retrieval_storage (asset_id);
 CREATE INDEX idx_time_uploaded ON asset_retrieval_storage (`time_uploaded`);
+CREATE INDEX idx_resource_id_x_time_uploaded ON asset_retrieval_storage (resource_id, `time_uploaded`);
 
 CREATE INDEX idx_user_id ON user_metadata (user_id(9));
 
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import sys
 import os
 from dotenv import load_dotenv
@@ -29,6 +29,58 @@ load_dotenv()  # Load in API keys
 SCRAPER_API_KEYS = [value for key, value in os.environ.items() if key.startswith('SCRAPER_API_KEY')]
 
 MAX_SCREENSHOT_SIZE_MB = 500
+STREAM_BLOCK_SIZE = 256 * 1024  # bytes per write when streaming files back
+
+
+"""
+
+A mixed multipart response (see https://www.w3.org/Protocols/rfc1341/7_2_Multipart.html) made of in-memory bytes and files.
+
+Files are sent in fixed-size blocks, each part says its Content-Length (so the reader doesn't need to search the data for the boundary),
+and every file is removed once it's been sent – or when the response is closed early, for example because the client went away.
+
+"""
+
+class MultipartStream():
+    def __init__(self, boundary, parts) -> None:
+        self.boundary = boundary
+        self.parts = parts  # list of (content type, bytes or file path)
+        self.to_remove = [x for _, x in parts if isinstance(x, str)]
+
+    def _remove(self, path):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Could not remove {path}: {e}", file=sys.stderr)
+        if path in self.to_remove:
+            self.to_remove.remove(path)
+
+    def _part_header(self, content_type, length):
+        return f"--{self.boundary}\r\nContent-Type: {content_type}\r\nContent-Length: {length}\r\n\r\n".encode()
+
+    def __iter__(self):
+        for content_type, content in self.parts:
+            if isinstance(content, bytes):
+                yield self._part_header(content_type, len(content)) + content + b"\r\n"
+                continue
+            try:
+                with open(content, 'rb') as f:
+                    yield self._part_header(content_type, os.fstat(f.fileno()).st_size)
+                    while True:
+                        block = f.read(STREAM_BLOCK_SIZE)
+                        if not block:
+                            break
+                        yield block
+                yield b"\r\n"
+            finally:
+                self._remove(content)
+        yield f"--{self.boundary}--\r\n".encode()
+
+    # Called by the server when the response is done, including if it never started
+    def close(self):
+        for path in list(self.to_remove):
+            self._remove(path)
 
 
 @app.route('/')
@@ -122,37 +174,17 @@ def scrape():
 
     if successful:
         boundary = 'Boundary712sAM12MVaJff23NXJ'  # typed out some random digits
-        # Generate a mixed multipart response
-        # See details on the standard here: https://www.w3.org/Protocols/rfc1341/7_2_Multipart.html
-        def stream():
-            # Start with headers and status as json
-            yield f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode()  # beginning of content
-            yield json.dumps({
+        parts = [
+            ('application/json', json.dumps({
                 'status': status,
                 'headers': headers,
                 'metadata': metadata
-            })
-            yield "\r\n".encode()  # end of content
-
-            # Give content as it was received
-            yield f"--{boundary}\r\nContent-Type: {headers['content-type']}\r\n\r\n".encode()  # beginning of content
-            with open(content_file, 'rb') as content:
-                for line in content:
-                    yield line
-            yield "\r\n".encode()  # end of content
-
-            # Give screenshot images
-            for ss in screenshot_files:
-                yield f"--{boundary}\r\nContent-Type: image/jpeg\r\n\r\n".encode()  # beginning of content
-                with open(ss, 'rb') as content:
-                    for line in content:
-                        yield line
-                yield "\r\n".encode()  # end of content
-            
-            # End boundary
-            yield f"--{boundary}--\r\n".encode()
-
-        return stream(), 200, {'Content-Type': f'multipart/mixed; boundary="{boundary}"'}
+            }).encode()),
+            (headers.get('content-type', 'application/octet-stream'), content_file)
+        ]
+        parts.extend([('image/jpeg', ss) for ss in screenshot_files])
+        # Flask would take a plain iterable for a WSGI app, so make the Response here
+        return Response(MultipartStream(boundary, parts), status=200, headers={'Content-Type': f'multipart/mixed; boundary="{boundary}"'})
 
     else:
         return jsonify({
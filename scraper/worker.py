@@ -1,5 +1,7 @@
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
 from playwright.sync_api import sync_playwright, Error as PlaywrightError
+from contextlib import contextmanager
 import resource
 import math
 import tempfile
@@ -11,6 +13,10 @@ import sys
 MEM_LIMIT_MB = 4_000  # 4 GB memory threshold for child scraping process
 MAX_SCREENSHOTS = 5
 SCREENSHOT_JPEG_QUALITY = 85
+BROWSER_HEIGHT = 2000
+BROWSER_WIDTH = 1280
+BROWSER_MAX_PAGES = 200  # a worker's browser is replaced after this many scrapes...
+BROWSER_MAX_MEM_MB = 1_500  # ...or once it (all its processes together) holds more than this much memory
 
 CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
 CELERY_BROKER_URL = "redis://localhost:6379/0"
@@ -22,19 +28,151 @@ def make_celery():
     )
     celery.conf.update(
         worker_concurrency=3,  # Limit number of concurrent tasks
+        worker_proc_alive_timeout=30,  # worker processes launch their browser on startup (see BrowserPool)
     )
 
     return celery
 
 celery = make_celery()
 
-@celery.task
-def scrape_task(url, wait):
 
-    # Memory limits for the task process
+def set_memory_limit():
+    # Memory limits for the worker process
     soft, hard = (MEM_LIMIT_MB * 1024 * 1024, MEM_LIMIT_MB * 1024 * 1024)
     resource.setrlimit(resource.RLIMIT_AS, (soft, hard))  # Browser should inherit this limit
 
+
+# Total resident memory of every process descended from pid (for a worker, that's the Playwright driver and the browser's processes)
+def get_descendants_rss_mb(pid):
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue  # process exited
+        fields = stat.rsplit(')', 1)[1].split()  # the process name is in parentheses and can contain spaces
+        ppid = int(fields[1])
+        children.setdefault(ppid, []).append(int(entry))
+        rss[int(entry)] = int(fields[21])  # in pages
+    total = 0
+    to_visit = list(children.get(pid, []))
+    while to_visit:
+        child = to_visit.pop()
+        total += rss.get(child, 0)
+        to_visit.extend(children.get(child, []))
+    return total * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+"""
+
+Each worker process keeps one browser running and gives every scrape a fresh browser context within it.
+Contexts share nothing (cookies, storage, cache), so scrapes stay isolated from one another, but they skip the browser's startup.
+
+The browser is replaced when it has done BROWSER_MAX_PAGES scrapes, when it's using more than BROWSER_MAX_MEM_MB, or when it has crashed.
+The memory limit is set on the worker process before the browser is launched, so that the browser inherits it like before.
+
+"""
+
+class BrowserPool():
+    def __init__(self, max_pages, max_mem_mb) -> None:
+        self.max_pages = max_pages
+        self.max_mem_mb = max_mem_mb
+        self.playwright = None
+        self.browser = None
+        self.n_pages = 0
+
+    def _launch(self):
+        set_memory_limit()
+        if self.playwright is None:
+            self.playwright = sync_playwright().start()
+        # Should be resilient to untrusted websites
+        self.browser = self.playwright.firefox.launch(headless=True, timeout=10_000)  # 10s startup timeout
+        self.n_pages = 0
+
+    def close_browser(self):
+        if self.browser is None:
+            return
+        try:
+            self.browser.close()
+        except Exception as e:
+            print(f"Error closing browser: {e}", file=sys.stderr)
+        self.browser = None
+
+    def close(self):
+        self.close_browser()
+        if self.playwright is not None:
+            try:
+                self.playwright.stop()
+            except Exception as e:
+                print(f"Error stopping playwright: {e}", file=sys.stderr)
+            self.playwright = None
+
+    def _should_recycle(self):
+        if not self.browser.is_connected():
+            return True
+        if self.n_pages >= self.max_pages:
+            return True
+        try:
+            mem = get_descendants_rss_mb(os.getpid())
+        except Exception as e:
+            print(f"Could not measure browser memory: {e}", file=sys.stderr)
+            return False
+        if mem > self.max_mem_mb:
+            print(f"Recycling browser using {mem:.0f} MB after {self.n_pages} pages", file=sys.stderr)
+            return True
+        return False
+
+    def warm(self):
+        if self.browser is None or not self.browser.is_connected():
+            self.close_browser()
+            self._launch()
+
+    # A new browser context, closed when done
+    @contextmanager
+    def new_context(self, **kwargs):
+        self.warm()
+        try:
+            context = self.browser.new_context(**kwargs)
+        except PlaywrightError:
+            self.close_browser()  # next scrape gets a new one
+            raise
+        try:
+            yield context
+        finally:
+            self.n_pages += 1
+            try:
+                context.close()
+            except Exception as e:
+                print(f"Error closing browser context; closing browser: {e}", file=sys.stderr)
+                self.close_browser()
+            if self.browser is not None and self._should_recycle():
+                self.close_browser()
+
+
+BROWSER_POOL = BrowserPool(BROWSER_MAX_PAGES, BROWSER_MAX_MEM_MB)
+
+
+# Playwright's sync API has to be used from the thread that started it; that's the worker process's main thread, same as for tasks.
+@worker_process_init.connect
+def launch_browser(**kwargs):
+    try:
+        BROWSER_POOL.warm()
+    except Exception as e:
+        print(f"Could not launch browser on worker start (will retry on first scrape): {e}", file=sys.stderr)
+
+
+@worker_process_shutdown.connect
+def close_browser(**kwargs):
+    BROWSER_POOL.close()
+
+
+@celery.task
+def scrape_task(url, wait):
+
     content_file_tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
     content_file = content_file_tmp.name
 
@@ -47,13 +185,7 @@ def scrape_task(url, wait):
     status = None
     headers = None
     try:
-        with sync_playwright() as p:
-            # Should be resilient to untrusted websites
-            browser = p.firefox.launch(headless=True, timeout=10_000)  # 10s startup timeout
-            BROWSER_HEIGHT = 2000
-            BROWSER_WIDTH = 1280
-            context = browser.new_context(viewport={"width": BROWSER_WIDTH, "height": BROWSER_HEIGHT}, accept_downloads=True)
-            
+        with BROWSER_POOL.new_context(viewport={"width": BROWSER_WIDTH, "height": BROWSER_HEIGHT}, accept_downloads=True) as context:
             page = context.new_page()
 
             # Set various security headers and limits
@@ -161,7 +293,6 @@ def scrape_task(url, wait):
                 # Note that if not text/html, might've been caught by the download stuff above
                 file_bytes = response.body()
                 content_file_tmp.write(file_bytes)
-                browser.close()
 
     except Exception as e:
         for ss in raw_screenshot_files: